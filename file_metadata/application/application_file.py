@@ -9,5 +9,5 @@ from file_metadata.generic_file import GenericFile
 class ApplicationFile(GenericFile):
 
     @classmethod
-    def create(cls, *args, **kwargs):
-        return cls(*args, **kwargs)
+    def create_from(cls, cls_file):
+        return cls_file.cast(cls)
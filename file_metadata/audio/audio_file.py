@@ -11,9 +11,8 @@ class AudioFile(FFProbeMixin, GenericFile):
     mimetypes = ()
 
     @classmethod
-    def create(cls, *args, **kwargs):
-        cls_file = cls(*args, **kwargs)
+    def create_from(cls, cls_file):
         if cls_file.is_type('ogg'):
             from file_metadata.audio.ogg_file import OGGFile
-            return OGGFile.create(*args, **kwargs)
-        return cls(*args, **kwargs)
+            return OGGFile.create_from(cls_file)
+        return cls_file.cast(cls)
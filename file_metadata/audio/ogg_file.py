@@ -9,8 +9,8 @@ from file_metadata.audio.audio_file import AudioFile
 class OGGFile(AudioFile):
 
     @classmethod
-    def create(cls, *args, **kwargs):
-        return cls(*args, **kwargs)
+    def create_from(cls, cls_file):
+        return cls_file.cast(cls)
 
     def analyze_file_format(self):
         """
@@ -0,0 +1,213 @@
+import com.google.zxing.BarcodeFormat;
+import com.google.zxing.BinaryBitmap;
+import com.google.zxing.DecodeHintType;
+import com.google.zxing.LuminanceSource;
+import com.google.zxing.MultiFormatReader;
+import com.google.zxing.NotFoundException;
+import com.google.zxing.RGBLuminanceSource;
+import com.google.zxing.Result;
+import com.google.zxing.ResultPoint;
+import com.google.zxing.client.j2se.BufferedImageLuminanceSource;
+import com.google.zxing.client.result.ResultParser;
+import com.google.zxing.common.HybridBinarizer;
+import com.google.zxing.multi.GenericMultipleBarcodeReader;
+
+import java.awt.image.BufferedImage;
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.EOFException;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.PrintStream;
+import java.net.URI;
+import java.nio.charset.StandardCharsets;
+import java.util.Base64;
+import java.util.EnumMap;
+import java.util.EnumSet;
+import java.util.Map;
+import javax.imageio.ImageIO;
+
+/**
+ * A long running ZXing decoder used by file_metadata/zxing.py. It reads one
+ * request per line from stdin:
+ *
+ *   file URI               - Decode the image at the URI.
+ *   pixels WIDTH HEIGHT    - Decode the WIDTH * HEIGHT * 3 bytes of RGB
+ *                            pixels which follow the line.
+ *
+ * and answers with a "result" line for every barcode found, or an "error"
+ * line, followed by a "done" line. The fields of a line are separated by
+ * tabs and texts are encoded with base64. The barcodes are found like
+ * "CommandLineRunner --multi" does.
+ *
+ * The pixels of a request are always read or skipped before answering, so
+ * that the next request is found in the input. A "pixels" line whose size
+ * cannot be parsed is answered with an error and the server exits.
+ */
+public final class ZXingServer {
+
+  /** The most pixels a request can have, as they are kept in arrays. */
+  private static final long MAX_PIXELS = Integer.MAX_VALUE / 3;
+
+  private static final Map<DecodeHintType, Object> HINTS =
+      new EnumMap<>(DecodeHintType.class);
+
+  static {
+    HINTS.put(DecodeHintType.POSSIBLE_FORMATS, EnumSet.of(
+        BarcodeFormat.UPC_A, BarcodeFormat.UPC_E, BarcodeFormat.EAN_13,
+        BarcodeFormat.EAN_8, BarcodeFormat.RSS_14,
+        BarcodeFormat.RSS_EXPANDED, BarcodeFormat.CODE_39,
+        BarcodeFormat.CODE_93, BarcodeFormat.CODE_128, BarcodeFormat.ITF,
+        BarcodeFormat.QR_CODE, BarcodeFormat.DATA_MATRIX,
+        BarcodeFormat.AZTEC, BarcodeFormat.PDF_417, BarcodeFormat.CODABAR,
+        BarcodeFormat.MAXICODE));
+  }
+
+  private ZXingServer() {
+  }
+
+  public static void main(String[] args) throws IOException {
+    DataInputStream in =
+        new DataInputStream(new BufferedInputStream(System.in));
+    PrintStream out = new PrintStream(
+        new BufferedOutputStream(System.out), false, "UTF-8");
+    out.println("ready");
+    out.flush();
+
+    String line;
+    while ((line = readLine(in)) != null) {
+      String[] request = line.split(" ", 3);
+      long width = 0;
+      long height = 0;
+      long payload = 0;
+      if (request[0].equals("pixels")) {
+        try {
+          width = Long.parseLong(request[1]);
+          height = Long.parseLong(request[2]);
+          payload = Math.multiplyExact(Math.multiplyExact(width, height), 3);
+        } catch (RuntimeException e) {
+          payload = -1;
+        }
+        if (width < 0 || height < 0 || payload < 0) {
+          // The number of bytes which follow the line is unknown, hence the
+          // next requests cannot be found in the input any more.
+          out.println("error\t" + encode("Invalid request: " + line));
+          out.println("done");
+          out.flush();
+          return;
+        }
+      }
+      try {
+        LuminanceSource source;
+        if (request[0].equals("file")) {
+          source = readFile(line.substring("file ".length()));
+        } else if (request[0].equals("pixels")) {
+          int[] pixels = readPixels(in, width, height);
+          payload = 0;
+          source = new RGBLuminanceSource((int) width, (int) height, pixels);
+        } else {
+          throw new IllegalArgumentException("Unknown request: " + line);
+        }
+        for (Result result : decode(source)) {
+          out.println("result\t" + result.getBarcodeFormat() + "\t" +
+                      encode(result.getText()) + "\t" +
+                      encode(ResultParser.parseResult(result)
+                             .getDisplayResult()) + "\t" +
+                      points(result));
+        }
+      } catch (Exception | OutOfMemoryError e) {
+        // The pixels are only read once they fit in memory, skip them.
+        skipFully(in, payload);
+        out.println("error\t" + encode(e.toString()));
+      }
+      out.println("done");
+      out.flush();
+    }
+  }
+
+  private static String readLine(InputStream in) throws IOException {
+    ByteArrayOutputStream line = new ByteArrayOutputStream();
+    int c;
+    while ((c = in.read()) != '\n') {
+      if (c == -1) {
+        return line.size() == 0 ? null : line.toString("UTF-8");
+      }
+      line.write(c);
+    }
+    return line.toString("UTF-8");
+  }
+
+  private static LuminanceSource readFile(String uri) throws IOException {
+    BufferedImage image = ImageIO.read(URI.create(uri).toURL());
+    if (image == null) {
+      throw new IOException("Could not load file " + uri);
+    }
+    return new BufferedImageLuminanceSource(image);
+  }
+
+  private static void skipFully(InputStream in, long count)
+      throws IOException {
+    while (count > 0) {
+      long skipped = in.skip(count);
+      if (skipped <= 0) {
+        if (in.read() == -1) {
+          throw new EOFException();
+        }
+        skipped = 1;
+      }
+      count -= skipped;
+    }
+  }
+
+  private static int[] readPixels(DataInputStream in, long width,
+                                  long height) throws IOException {
+    if (width * height > MAX_PIXELS) {
+      throw new IllegalArgumentException(
+          "Too many pixels: " + width + "x" + height);
+    }
+    // Both arrays are allocated before reading, so that no pixels are read
+    // if they do not fit in memory.
+    byte[] rgb = new byte[(int) (width * height * 3)];
+    int[] pixels = new int[(int) (width * height)];
+    in.readFully(rgb);
+    for (int i = 0; i < pixels.length; i++) {
+      pixels[i] = 0xFF000000 | (rgb[3 * i] & 0xFF) << 16 |
+                  (rgb[3 * i + 1] & 0xFF) << 8 | (rgb[3 * i + 2] & 0xFF);
+    }
+    return pixels;
+  }
+
+  private static Result[] decode(LuminanceSource source) {
+    BinaryBitmap bitmap = new BinaryBitmap(new HybridBinarizer(source));
+    GenericMultipleBarcodeReader reader =
+        new GenericMultipleBarcodeReader(new MultiFormatReader());
+    try {
+      return reader.decodeMultiple(bitmap, HINTS);
+    } catch (NotFoundException e) {
+      return new Result[0];
+    }
+  }
+
+  private static String points(Result result) {
+    StringBuilder points = new StringBuilder();
+    ResultPoint[] resultPoints = result.getResultPoints();
+    if (resultPoints != null) {
+      for (ResultPoint point : resultPoints) {
+        if (point != null) {
+          if (points.length() > 0) {
+            points.append(' ');
+          }
+          points.append(point.getX()).append(',').append(point.getY());
+        }
+      }
+    }
+    return points.toString();
+  }
+
+  private static String encode(String text) {
+    return Base64.getEncoder().encodeToString(
+        text.getBytes(StandardCharsets.UTF_8));
+  }
+}
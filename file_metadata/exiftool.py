@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to talk to long running ``exiftool`` processes. Starting perl and
+loading the exiftool modules usually takes longer than the extraction
+itself, hence a few processes are started with ``-stay_open True`` and
+reused for every file analyzed by the python process.
+"""
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import atexit
+import os
+import select
+import subprocess
+import threading
+import time
+
+from file_metadata.utilities import to_cstr
+
+
+class ExifToolTimeout(IOError):
+    """
+    Raised when exiftool does not write anything for longer than the
+    timeout while answering a request.
+    """
+
+
+class ExifToolProcess(object):
+    """
+    A single ``exiftool`` process started with ``-stay_open True -@ -``.
+    The arguments of a request are written to the stdin of the process (one
+    argument per line) and the output is read until the ``{ready}`` marker
+    that exiftool prints once it has finished the request.
+
+    :ivar executable: The path of the exiftool executable to use.
+    :ivar timeout:    The number of seconds to wait for more output of
+                      exiftool before giving up on a request, or None to
+                      wait forever.
+    """
+
+    def __init__(self, executable, timeout=None):
+        self.executable = executable
+        self.timeout = timeout
+        self.process = None
+        self.num_requests = 0
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        with open(os.devnull, 'wb') as devnull:
+            self.process = subprocess.Popen(
+                [self.executable, '-stay_open', 'True', '-@', '-'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=devnull)
+
+    def terminate(self):
+        """
+        Ask exiftool to exit gracefully and kill it if that is not possible.
+        """
+        if self.running:
+            try:
+                self.process.stdin.write(b'-stay_open\nFalse\n')
+                self.process.stdin.flush()
+                self.process.communicate()
+            except (IOError, OSError):
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def kill(self):
+        """
+        Kill the process without waiting for the current request.
+        """
+        if self.running:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def execute(self, *args):
+        """
+        Run exiftool with the given arguments and return the raw output.
+        ``ExifToolTimeout`` is raised if exiftool is silent for longer than
+        the timeout, the process is then busy and should be killed.
+
+        :param args: The arguments to give exiftool, one string per argument.
+        :return:     The bytes written to stdout by exiftool for this request.
+        """
+        if not self.running:
+            self.start()
+
+        self.num_requests += 1
+        sentinel = to_cstr('{{ready{0}}}'.format(self.num_requests))
+        request = b''.join(to_cstr(arg) + b'\n' for arg in args)
+        request += to_cstr('-execute{0}\n'.format(self.num_requests))
+        self.process.stdin.write(request)
+        self.process.stdin.flush()
+
+        fileno = self.process.stdout.fileno()
+        output = bytearray()
+        while not output[-64:].rstrip().endswith(sentinel):
+            if self.timeout is not None:
+                # For example a FIFO or an unresponsive network path can
+                # keep exiftool busy forever.
+                deadline = time.time() + self.timeout
+                readable = []
+                while not readable and time.time() < deadline:
+                    readable = select.select(
+                        [fileno], [], [], deadline - time.time())[0]
+                if not readable:
+                    raise ExifToolTimeout(
+                        'exiftool did not answer in {0} seconds.'
+                        .format(self.timeout))
+            chunk = os.read(fileno, 64 * 1024)
+            if not chunk:
+                raise IOError('The exiftool process exited unexpectedly.')
+            output += chunk
+        return bytes(output.rstrip()[:-len(sentinel)])
+
+
+class ExifToolPool(object):
+    """
+    A thread safe pool of ``ExifToolProcess`` objects. Processes are started
+    lazily, so a single threaded application only ever starts one exiftool
+    process. A process which crashes is restarted and the request is retried
+    once before giving up. A process which does not answer in time is
+    killed.
+
+    :ivar executable:  The path of the exiftool executable to use.
+    :ivar max_workers: The maximum number of exiftool processes to start.
+    :ivar timeout:     The number of seconds exiftool can be silent while
+                       answering a request, or None to wait forever.
+    """
+
+    def __init__(self, executable, max_workers=4, timeout=60):
+        self.executable = executable
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # Notified when a worker becomes idle or a slot becomes free.
+        self._available = threading.Condition(self._lock)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._workers = []
+
+    def _acquire(self):
+        with self._available:
+            while True:
+                if self._pid != os.getpid():
+                    # The process was forked, the pipes of the parent's
+                    # workers must not be used by the child.
+                    self._reset()
+                if self._idle:
+                    return self._idle.pop()
+                elif len(self._workers) < self.max_workers:
+                    worker = ExifToolProcess(self.executable, self.timeout)
+                    self._workers.append(worker)
+                    return worker
+                self._available.wait()
+
+    def _release(self, worker):
+        with self._available:
+            if worker in self._workers:
+                self._idle.append(worker)
+                self._available.notify()
+                return
+        # The pool was closed while the worker was in use.
+        worker.terminate()
+
+    def execute(self, *args):
+        """
+        Run exiftool with the given arguments on one of the idle processes.
+        Arguments containing newlines cannot be written to an argument file,
+        hence exiftool is run as a separate process for them.
+
+        :param args: The arguments to give exiftool, one string per argument.
+        :return:     The bytes written to stdout by exiftool.
+        """
+        if any('\n' in arg for arg in args):
+            with open(os.devnull, 'rb') as devnull:
+                proc = subprocess.Popen([self.executable] + list(args),
+                                        stdin=devnull, stdout=subprocess.PIPE)
+                return proc.communicate()[0]
+
+        worker = self._acquire()
+        try:
+            try:
+                output = worker.execute(*args)
+            except ExifToolTimeout:
+                raise
+            except (IOError, OSError):
+                # The process died or was killed, so restart it and retry.
+                worker.terminate()
+                output = worker.execute(*args)
+        except BaseException:
+            # The rest of the reply may still be in the pipe, which would be
+            # read as the reply of the next request. So the process cannot
+            # be used again.
+            self._discard(worker)
+            raise
+        self._release(worker)
+        return output
+
+    def _discard(self, worker):
+        worker.kill()
+        with self._available:
+            if worker in self._workers:
+                self._workers.remove(worker)
+                # A new process can be started in its place.
+                self._available.notify()
+
+    def close(self):
+        """
+        Terminate the idle exiftool processes started by this pool. The
+        processes still in use are terminated when their request is done.
+        """
+        with self._available:
+            idle = self._idle if self._pid == os.getpid() else []
+            self._reset()
+            self._available.notify_all()
+        for worker in idle:
+            worker.terminate()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def exiftool_pool(executable):
+    """
+    The process-wide ``ExifToolPool`` for the given executable.
+
+    :param executable: The path of the exiftool executable to use.
+    :return:           An ``ExifToolPool`` object.
+    """
+    with _pools_lock:
+        if executable not in _pools:
+            _pools[executable] = ExifToolPool(executable)
+        return _pools[executable]
+
+
+@atexit.register
+def close_pools():
+    """
+    Terminate all the exiftool processes started by this module.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
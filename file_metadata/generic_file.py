@@ -3,15 +3,22 @@
 from __future__ import (division, absolute_import, unicode_literals,
                         print_function)
 
+import hashlib
 import json
 import os
-import subprocess
+import sys
+import tempfile
+import threading
 
 import magic
+from six.moves import cPickle as pickle
 
-from file_metadata._compat import which
+from file_metadata import __version__
+from file_metadata._compat import makedirs, which
+from file_metadata.exiftool import exiftool_pool
 from file_metadata.mixins import is_svg
-from file_metadata.utilities import memoized
+from file_metadata.utilities import (app_dir, md5sum, memoized, requires,
+                                     uncached_analysis)
 
 
 class GenericFile(object):
@@ -28,8 +35,12 @@ class GenericFile(object):
 
     :ivar mimetypes: Set of mimetypes (strings) applicable to this class
         based on the official standard by IANA.
+    :ivar result_options: The options which change the results of the
+        analysis methods. Only these are part of the key of cached results,
+        and their values have to be JSON serializable.
     """
     mimetypes = ()
+    result_options = ('mime_buffer_size',)
     NO_CONFIG = object()
 
     def __init__(self, fname, **kwargs):
@@ -39,6 +50,8 @@ class GenericFile(object):
         self.closables = []  # List of items that need .close() at end
 
     def close(self):
+        memoized.clear_cache(self)
+
         while self.temp_filenames:
             path = self.temp_filenames.pop()
             os.remove(path)
@@ -47,6 +60,15 @@ class GenericFile(object):
             closable = self.closables.pop()
             closable.close()
 
+    @property
+    def max_cache_bytes(self):
+        """
+        The maximum number of bytes of arrays cached by ``fetch()`` and other
+        memoized methods for this file. Set with the ``max_cache_bytes``
+        option, ``None`` for no limit other than ``memoized.max_bytes``.
+        """
+        return self.config('max_cache_bytes')
+
     def __enter__(self):
         return self
 
@@ -54,7 +76,15 @@ class GenericFile(object):
         self.close()
 
     def config(self, key, new_defaults=()):
-        defaults = {}
+        defaults = {
+            # Cache the results of each analysis method on disk. Either a
+            # directory or True to use the user's cache directory.
+            "cache_results": False,
+            "max_cache_bytes": None,
+            # Detect the mimetype using only these many bytes from the start
+            # of the file, None to let libmagic read the file itself.
+            "mime_buffer_size": None
+        }
         defaults.update(dict(new_defaults))  # Update the defaults from child
         try:
             return self.options[key]
@@ -62,16 +92,19 @@ class GenericFile(object):
             return defaults[key]
 
     @memoized
-    def fetch(self, key=''):
+    def fetch(self, key='', **kwargs):
         """
         Fetch data about the file based on the key provided. Provides a
         uniform location where all the conversions of filetype, reading, etc.
         can happen efficiently and also it gets cached.
 
-        :param key: The key decides what data is fetched.
+        :param key:    The key decides what data is fetched.
+        :param kwargs: Options for the data of some keys.
         """
         if key == '' or key == 'filename':
             return os.path.abspath(self.filename)
+        elif key == 'md5sum':
+            return md5sum(self.fetch('filename'))
         return None
 
     @classmethod
@@ -85,7 +118,19 @@ class GenericFile(object):
         :parak kwargs: The kwargs to pass to the file class.
         :return:       A class inheriting from GenericFile.
         """
-        cls_file = cls(*args, **kwargs)
+        return cls.create_from(cls(*args, **kwargs))
+
+    @classmethod
+    def create_from(cls, cls_file):
+        """
+        Find the class which best suits the given file object and return an
+        object of that class. The results of the detection methods which
+        have already been run on the given object (``mime()``,
+        ``exiftool()`` and ``is_type()``) are reused by the returned object.
+
+        :param cls_file: A GenericFile object of the file.
+        :return:         A class inheriting from GenericFile.
+        """
         mime = cls_file.mime()
         _type, subtype = mime.split('/', 1)
 
@@ -93,43 +138,278 @@ class GenericFile(object):
                 cls_file.is_type('svg')) and
                 subtype not in ('vnd-djvu', 'vnd.djvu')):
             from file_metadata.image.image_file import ImageFile
-            return ImageFile.create(*args, **kwargs)
+            return ImageFile.create_from(cls_file)
         elif _type == 'audio' or cls_file.is_type('ogg'):
             from file_metadata.audio.audio_file import AudioFile
-            return AudioFile.create(*args, **kwargs)
+            return AudioFile.create_from(cls_file)
         elif _type == 'video' or cls_file.is_type('ogv'):
             from file_metadata.video.video_file import VideoFile
-            return VideoFile.create(*args, **kwargs)
+            return VideoFile.create_from(cls_file)
         elif _type == 'application':
             from file_metadata.application.application_file import (
                 ApplicationFile)
-            return ApplicationFile.create(*args, **kwargs)
+            return ApplicationFile.create_from(cls_file)
 
-        return cls_file
+        return cls_file.cast(cls)
 
-    def analyze(self, prefix='analyze_', suffix='', methods=None):
+    def cast(self, cls):
+        """
+        Create an object of the given class for this file. The temporary
+        files, closables and the cached detection results are moved to the
+        new object.
+
+        :param cls: The class inheriting from GenericFile to use.
+        :return:    An object of the given class.
+        """
+        if type(self) is cls:
+            return self
+        new_file = cls(self.filename, **self.options)
+        for method in ('mime', 'exiftool', 'is_type'):
+            memoized.lookup(GenericFile, method).copy_cache(self, new_file)
+        new_file.temp_filenames, self.temp_filenames = (
+            self.temp_filenames, new_file.temp_filenames)
+        new_file.closables, self.closables = self.closables, new_file.closables
+        return new_file
+
+    def analyze(self, prefix='analyze_', suffix='', methods=None,
+                executor=None, max_workers=None):
         """
         Analyze the given file and create metadata information appropriately.
         Search and use all methods that have a name starting with
         ``analyze_*`` and merge the doctionaries using ``.update()``
         to get the cumulative set of metadata.
 
-        :param prefix:  Use only methods that have this prefix.
-        :param suffix:  Use only methods that have this suffix.
-        :param methods: A list of method names to choose from. If not given,
-                        a sorted list of all methods from the class is used.
+        The methods can be run concurrently by giving an ``executor`` or
+        ``max_workers``. Many analysis methods wait on subprocesses or on
+        numpy routines which release the GIL, so threads help even for a
+        single file. The dictionaries are still merged in the same order as
+        when the methods are run one after another.
+
+        :param prefix:      Use only methods that have this prefix.
+        :param suffix:      Use only methods that have this suffix.
+        :param methods:     A list of method names to choose from. If not
+                            given, a sorted list of all methods from the
+                            class is used.
+        :param executor:    A ``concurrent.futures.Executor`` to run the
+                            methods with.
+        :param max_workers: Run the methods with a thread pool having these
+                            many threads. Not used if ``executor`` is given.
         :return: A dict containing the cumulative metadata.
         """
+        methods = [method for method in (methods or sorted(dir(self)))
+                   if method.startswith(prefix) and method.endswith(suffix)]
+
+        results = {}
+        for method in methods:
+            result = self._load_result(method)
+            if result is not None:
+                results[method] = result
+        pending = [method for method in methods if method not in results]
+
+        if executor is None and max_workers is not None and pending:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results.update(self._analyze_methods(pending, executor))
+        else:
+            results.update(self._analyze_methods(pending, executor))
+
         data = {}
-        methods = methods or sorted(dir(self))
         for method in methods:
-            if method.startswith(prefix) and method.endswith(suffix):
-		try:
-			data.update(getattr(self, method)())
-		except UnicodeDecodeError:
-			pass
+            data.update(results[method])
         return data
 
+    def _analyze_methods(self, methods, executor=None):
+        """
+        Run the given analysis methods.
+
+        :return: A dict mapping the method names to the data they found.
+        """
+        if executor is None:
+            return dict((method, self._analyze_method(method))
+                        for method in methods)
+
+        # The data required by the methods (declared with ``requires``)
+        # is computed first and every method starts as soon as its data
+        # is ready. Data from external tools (memoized methods like
+        # ``exiftool`` and converted files) is submitted before the rest
+        # as it takes the longest.
+        needs = dict((method, getattr(getattr(self, method), 'requires', ()))
+                     for method in methods)
+        keys = []
+        for method in methods:
+            keys.extend(key for key in needs[method] if key not in keys)
+        keys.sort(key=lambda key: not (
+            key.startswith('filename') or
+            callable(getattr(type(self), key, None))))
+        requirements = dict(
+            (key, executor.submit(self._analyze_requirement, key))
+            for key in keys)
+        futures = dict((method, self._submit_when_done(
+            executor, [requirements[key] for key in needs[method]],
+            self._analyze_method, method)) for method in methods)
+        return dict((method, futures[method].result()) for method in methods)
+
+    def _analyze_method(self, method):
+        try:
+            result = getattr(self, method)()
+        except UnicodeDecodeError:
+            result = {}
+        self._store_result(method, result)
+        return result
+
+    def _result_path(self, method):
+        """
+        The path to cache the result of an analysis method at. The path
+        depends on the md5sum of the file, the options of the file, the
+        class, the name and version of the method and the version of
+        file-metadata. ``None`` is given if the results should not be cached.
+        """
+        cache_dir = self.config('cache_results')
+        if (not cache_dir or
+                not getattr(getattr(self, method), 'cache_results', True)):
+            return None
+        if cache_dir is True:
+            cache_dir = app_dir('user_cache_dir', 'results')
+        try:
+            content_hash = self.fetch('md5sum')
+        except (IOError, OSError):
+            return None
+        # The options which do not change the data found are left out. The
+        # others are serialized as JSON, so that the key is the same in
+        # every run.
+        options = dict((key, value) for key, value in self.options.items()
+                       if key in self.result_options)
+        options_hash = hashlib.md5(json.dumps(
+            options, sort_keys=True).encode('utf-8'))
+        # The version of a method can be set with ``analysis_version``.
+        name = '{0}.{1}.{2}.{3}-{4}.{5}.pickle'.format(
+            type(self).__module__, type(self).__name__, method, __version__,
+            getattr(getattr(self, method), 'version', 0),
+            options_hash.hexdigest()[:16])
+        return os.path.join(cache_dir, content_hash[:2], content_hash, name)
+
+    def _load_result(self, method):
+        path = self._result_path(method)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except Exception:  # The cache file is corrupt, compute it again
+            return None
+
+    def _store_result(self, method, result):
+        path = self._result_path(method)
+        if path is None:
+            return
+        try:
+            makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a tempfile first so that a partially written cache
+            # file is never read.
+            fd, name = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix='tmp_file_metadata')
+            with os.fdopen(fd, 'wb') as cache_file:
+                pickle.dump(result, cache_file, protocol=2)
+            os.rename(name, path)
+        except (IOError, OSError, pickle.PicklingError):
+            pass
+
+    def _analyze_requirement(self, key):
+        """
+        Compute the data required by analysis methods. Errors are ignored
+        here as the analysis method raises them itself when it tries to
+        compute the same data.
+        """
+        method = getattr(type(self), key, None)
+        try:
+            if callable(method):
+                getattr(self, key)()
+            else:
+                self.fetch(key)
+        except Exception:
+            pass
+
+    @staticmethod
+    def _submit_when_done(executor, waitfor, func, *args):
+        """
+        Submit the function to the executor once all the futures in
+        ``waitfor`` are done.
+
+        :return: A future which gives the result of the function.
+        """
+        from concurrent.futures import Future
+        result = Future()
+        pending = [len(waitfor)]
+        lock = threading.Lock()
+
+        def chain(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        def submit(_=None):
+            with lock:
+                pending[0] -= 1
+                if pending[0] > 0:
+                    return
+            try:
+                executor.submit(func, *args).add_done_callback(chain)
+            except RuntimeError as err:  # The executor was shut down
+                result.set_exception(err)
+
+        if not waitfor:
+            pending[0] = 1
+            submit()
+        for future in waitfor:
+            future.add_done_callback(submit)
+        return result
+
+    @classmethod
+    def analyze_many(cls, filenames, workers=None, chunksize=1, ordered=False,
+                     preload=False, **kwargs):
+        """
+        Analyze many files using a pool of processes. Every file is opened
+        with ``create()`` and closed after the analysis, so temporary files
+        are removed even if the analysis fails. The processes import the
+        heavy analysis libraries once when they are started.
+
+        :param filenames: An iterable of the files to analyze.
+        :param workers:   The number of processes to use. Defaults to the
+                          number of CPUs.
+        :param chunksize: The number of files to send to a process at once.
+        :param ordered:   Whether the results should be given in the order
+                          of ``filenames``. If not, they are given as soon
+                          as they are ready.
+        :param preload:   Whether the processes should also load the data
+                          used by the analyzers (like classifiers) when they
+                          are started.
+        :param kwargs:    The kwargs to pass to ``create()``.
+        :return: A generator giving a tuple ``(filename, data, error)`` for
+                 every file. ``data`` is the dict from ``analyze()`` and
+                 ``error`` is ``None``, or if the analysis failed ``data``
+                 is ``None`` and ``error`` is the formatted traceback.
+        """
+        import multiprocessing
+        pool = multiprocessing.Pool(workers, initializer=_init_analyze_worker,
+                                    initargs=(preload,))
+        try:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for result in imap(_analyze_file,
+                               ((cls, filename, kwargs)
+                                for filename in filenames),
+                               chunksize):
+                yield result
+        except BaseException:
+            # Also when the generator is closed before the end.
+            pool.terminate()
+            pool.join()
+            raise
+        # Let the processes exit by themselves, so that they stop the
+        # exiftool processes they started.
+        pool.close()
+        pool.join()
+
     @memoized
     def exiftool(self):
         """
@@ -149,17 +429,17 @@ class GenericFile(object):
         and many more types of information. For more information see
         <http://www.sno.phy.queensu.ca/~phil/exiftool/>.
 
+        The data is read using a long running exiftool process which is
+        shared by all the files (see ``file_metadata.exiftool``).
+
         :return:      A dictionary containing the exif information.
         """
         executable = which('exiftool')
         if executable is None:
             raise OSError('Neither perl nor exiftool were found.')
 
-        try:
-            output = subprocess.check_output([
-                executable, '-G', '-j', self.fetch('filename')])
-        except subprocess.CalledProcessError as proc_error:
-            output = proc_error.output
+        output = exiftool_pool(executable).execute(
+            '-G', '-j', self.fetch('filename'))
 
         # Need to decode with replacement because older version of exiftool
         # (in ubuntu-precise) doesn't encode strings inside exiftool
@@ -170,16 +450,69 @@ class GenericFile(object):
         assert len(data) == 1
         return data[0]
 
+    @classmethod
+    def exiftool_many(cls, files):
+        """
+        The exif data of many files using a single ``exiftool`` request.
+        This is a lot faster than calling ``exiftool()`` for each file
+        separately as exiftool handles the list of files in one go. The
+        data found is also cached, so that calling ``exiftool()`` on the
+        given objects does not run ``exiftool`` again.
+
+        :param files: A list of ``GenericFile`` objects or filenames.
+        :return:      A list with a dictionary containing the exif
+                      information for each of the given files, in the same
+                      order. ``None`` is used for files which exiftool
+                      did not give any information about.
+        """
+        executable = which('exiftool')
+        if executable is None:
+            raise OSError('Neither perl nor exiftool were found.')
+
+        files = [_file if isinstance(_file, GenericFile) else cls(_file)
+                 for _file in files]
+        if not files:
+            return []
+        filenames = [_file.fetch('filename') for _file in files]
+        output = exiftool_pool(executable).execute('-G', '-j', *filenames)
+        output = output.decode('utf-8', 'replace')
+
+        # exiftool skips the files it cannot read (for example files which
+        # do not exist), hence the SourceFile is used to map the results.
+        items = json.loads(output) if output.strip() else []
+        sources = dict((item.get('SourceFile'), item) for item in items)
+        results = []
+        for _file, filename in zip(files, filenames):
+            data = sources.get(filename)
+            if data is not None:
+                memoized.lookup(cls, 'exiftool').set_cache(_file, data)
+            results.append(data)
+        return results
+
     @memoized
     def mime(self):
+        """
+        The mimetype of the file found using libmagic. If the option
+        ``mime_buffer_size`` is set, only that many bytes from the start of
+        the file are given to libmagic.
+        """
+        buffer_size = self.config('mime_buffer_size')
+        header = None
+        if buffer_size:
+            with open(self.fetch('filename'), 'rb') as _file:
+                header = _file.read(buffer_size)
+
         if hasattr(magic, "from_file"):
             # Use https://pypi.python.org/pypi/python-magic
+            if header is not None:
+                return magic.from_buffer(header, mime=True)
             return magic.from_file(self.fetch('filename'), mime=True)
         elif hasattr(magic, "open"):
             # Use the python-magic library in distro repos from the `file`
             # command - http://www.darwinsys.com/file/
-            magic_instance = magic.open(magic.MAGIC_MIME)
-            magic_instance.load()
+            magic_instance = _magic_instance()
+            if header is not None:
+                return magic_instance.buffer(header)
             return magic_instance.file(self.fetch('filename'))
 
         raise ImportError(
@@ -217,6 +550,7 @@ class GenericFile(object):
         stat_data = os.stat(self.fetch('filename'))
         return {"File:FileSize": str(stat_data.st_size) + " bytes"}
 
+    @requires('mime')
     def analyze_mimetype(self):
         """
         Use libmagic to identify the mimetype of the file. This analysis is
@@ -233,9 +567,13 @@ class GenericFile(object):
         """
         return {"File:MIMEType": self.mime()}
 
+    @uncached_analysis
+    @requires('exiftool')
     def analyze_exifdata(self, ignored_keys=()):
         """
-        Use ``exiftool`` and return metadata from it.
+        Use ``exiftool`` and return metadata from it. The data is not cached
+        by ``analyze()`` as exiftool also gives the name, dates and
+        permissions of the file.
 
         :return: dict containing all the data from ``exiftool``. It also
                  uses the groups given by exiftool.
@@ -248,3 +586,57 @@ class GenericFile(object):
             'File:MIMEType'))
         return dict((key, val) for key, val in self.exiftool().items()
                     if key not in ignored_keys)
+
+
+_magic_local = threading.local()
+
+
+def _magic_instance():
+    """
+    The magic instance of the python bindings from the ``file`` package for
+    the current thread. Loading the magic database takes longer than
+    detecting the mimetype, hence it is loaded only once per thread.
+    """
+    if getattr(_magic_local, 'module', None) is not magic:
+        _magic_local.instance = magic.open(magic.MAGIC_MIME)
+        _magic_local.instance.load()
+        _magic_local.module = magic
+    return _magic_local.instance
+
+
+def _init_analyze_worker(preload=False):
+    """
+    Prepare a process of the pool used by ``GenericFile.analyze_many()``.
+    The heavy modules are imported once here rather than for the first file
+    analyzed by every process.
+
+    :param preload: Whether to call the ``preload()`` function of the
+                    modules which have one.
+    """
+    import multiprocessing.util
+    from file_metadata.exiftool import close_pools
+
+    # The pool exits its processes without running the atexit handlers.
+    multiprocessing.util.Finalize(None, close_pools, exitpriority=10)
+    for module in ('file_metadata.image.image_file',
+                   'file_metadata.audio.audio_file',
+                   'file_metadata.video.video_file', 'cv2', 'wand.image'):
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        if preload and hasattr(sys.modules[module], 'preload'):
+            sys.modules[module].preload()
+
+
+def _analyze_file(args):
+    """
+    Analyze a single file in a process of ``GenericFile.analyze_many()``.
+    """
+    import traceback
+    cls, filename, kwargs = args
+    try:
+        with cls.create(filename, **kwargs) as _file:
+            return filename, _file.analyze(), None
+    except Exception:
+        return filename, None, traceback.format_exc()
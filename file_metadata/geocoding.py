@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Resolvers which find the country, state and city at a latitude and
+longitude (reverse geocoding) for ``ImageFile.analyze_geolocation()``.
+A resolver is any object with a ``reverse(lat, lon)`` method which returns
+a dict with the keys ``country``, ``state`` and ``city`` (None if unknown),
+or None if it could not find the location.
+"""
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import atexit
+import io
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy
+from six.moves import http_client
+from six.moves.urllib.parse import urlencode, urlsplit
+
+from file_metadata import __version__
+from file_metadata._compat import makedirs
+from file_metadata.utilities import app_dir
+
+EARTH_RADIUS = 6371.0  # In kilometers
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    The great circle distance between points on the earth.
+
+    :param lat1: The latitude of the first points in degrees.
+    :param lon1: The longitude of the first points in degrees.
+    :param lat2: The latitude of the second points in degrees.
+    :param lon2: The longitude of the second points in degrees.
+    :return:     The distances in kilometers. Arrays are broadcast.
+    """
+    lat1, lon1, lat2, lon2 = map(numpy.radians, (lat1, lon1, lat2, lon2))
+    hav = (numpy.sin((lat2 - lat1) / 2) ** 2 +
+           numpy.cos(lat1) * numpy.cos(lat2) *
+           numpy.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(hav, 1)))
+
+
+class Gazetteer(object):
+    """
+    An offline resolver which gives the nearest populated place in a
+    GeoNames dump (like ``cities1000.txt`` from
+    http://download.geonames.org/export/dump/). The names of the states and
+    countries are read from ``admin1CodesASCII.txt`` and ``countryInfo.txt``
+    in the same directory if they exist, else their codes are given.
+
+    The places are put in a grid of ``cell_size`` degrees, so a lookup only
+    finds the distance to the places in the cells near the location.
+
+    :ivar filename:     The path of the GeoNames dump.
+    :ivar max_distance: The maximum distance in kilometers to the nearest
+                        place, None is given for locations farther away.
+    :ivar cell_size:    The size of the cells of the grid in degrees.
+    """
+
+    def __init__(self, filename, max_distance=50, cell_size=1.0):
+        self.filename = filename
+        self.max_distance = max_distance
+        self.cell_size = cell_size
+        self._load()
+
+    @staticmethod
+    def _read_rows(filename):
+        with io.open(filename, encoding='utf-8') as _file:
+            for line in _file:
+                if line.strip() and not line.startswith('#'):
+                    yield line.rstrip('\r\n').split('\t')
+
+    def _load(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        states, countries = {}, {}
+        admin1_file = os.path.join(directory, 'admin1CodesASCII.txt')
+        if os.path.exists(admin1_file):
+            states = dict((row[0], row[1])
+                          for row in self._read_rows(admin1_file))
+        country_file = os.path.join(directory, 'countryInfo.txt')
+        if os.path.exists(country_file):
+            countries = dict((row[0], row[4])
+                             for row in self._read_rows(country_file))
+
+        self.places, coords = [], []
+        for row in self._read_rows(self.filename):
+            # Only use populated places (feature class P) as cities.
+            if len(row) < 11 or row[6] != 'P':
+                continue
+            country_code, admin1_code = row[8], row[10]
+            self.places.append((
+                countries.get(country_code, country_code or None),
+                states.get(country_code + '.' + admin1_code,
+                           admin1_code or None),
+                row[1]))
+            coords.append((float(row[4]), float(row[5])))
+        self.coords = numpy.array(coords, dtype=float).reshape(-1, 2)
+
+        cells = {}
+        for index, (row, col) in enumerate(self._cell(self.coords)):
+            cells.setdefault((row, col % self._ncols), []).append(index)
+        self.cells = dict((cell, numpy.array(indices))
+                          for cell, indices in cells.items())
+
+    @property
+    def _ncols(self):
+        return int(math.ceil(360 / self.cell_size))
+
+    def _cell(self, coords):
+        return numpy.floor((coords + (90, 180)) / self.cell_size).astype(int)
+
+    def _nearby(self, lat, lon, distance):
+        """
+        The indices of the places in the cells within ``distance``
+        kilometers of the location.
+        """
+        dlat = math.degrees(distance / EARTH_RADIUS)
+        coslat = math.cos(math.radians(min(90, abs(lat) + dlat)))
+        dlon = 180 if coslat < 1e-6 else min(180, dlat / coslat)
+        (row1, col1), (row2, col2) = self._cell(numpy.array(
+            [(lat - dlat, lon - dlon), (lat + dlat, lon + dlon)]))
+        cols = range(col1, col2 + 1) if dlon < 180 else range(self._ncols)
+        cols = set(col % self._ncols for col in cols)
+        indices = [self.cells[(row, col)]
+                   for row in range(row1, row2 + 1) for col in cols
+                   if (row, col) in self.cells]
+        if not indices:
+            return numpy.array([], dtype=int)
+        return numpy.concatenate(indices)
+
+    def reverse(self, lat, lon):
+        if self.max_distance is None:
+            indices = numpy.arange(len(self.places))
+        else:
+            indices = self._nearby(lat, lon, self.max_distance)
+        if len(indices) == 0:
+            return None
+        distances = haversine(lat, lon, self.coords[indices, 0],
+                              self.coords[indices, 1])
+        nearest = distances.argmin()
+        if (self.max_distance is not None and
+                distances[nearest] > self.max_distance):
+            return None
+        country, state, city = self.places[indices[nearest]]
+        return {'country': country, 'state': state, 'city': city}
+
+
+class Nominatim(object):
+    """
+    An online resolver using the reverse geocoding of OpenStreetMap's
+    nominatim. A single HTTP connection is kept alive for all the requests,
+    and at most one request is sent every ``delay`` seconds as asked by
+    nominatim's usage policy. The locations are cached in memory and on disk
+    by their coordinates rounded to ``precision`` decimals, as photos taken
+    at the same place ask for nearly the same coordinates.
+
+    :ivar url:         The URL of nominatim's reverse geocoding endpoint.
+    :ivar zoom:        The level of detail of the address. Country = 0,
+                       megacity = 10, district = 10, city = 13,
+                       village = 15, street = 16, house = 18.
+    :ivar delay:       The minimum number of seconds between two requests.
+    :ivar precision:   The number of decimals to round the coordinates to.
+    :ivar cache_dir:   The directory to cache the locations in. True to
+                       use the user's cache directory, None to not cache
+                       the locations on disk.
+    :ivar max_entries: The number of locations to cache in memory.
+    :ivar timeout:     The number of seconds to wait for nominatim.
+    """
+
+    URL = 'http://nominatim.openstreetmap.org/reverse'
+
+    def __init__(self, url=URL, zoom=13, delay=1.0, precision=3,
+                 cache_dir=True, max_entries=1024, timeout=10):
+        self.url = url
+        self.zoom = zoom
+        self.delay = delay
+        self.precision = precision
+        if cache_dir is True:
+            cache_dir = app_dir('user_cache_dir', 'nominatim')
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._last_request = 0
+        self._pid = os.getpid()
+
+    def _cache_path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, '{0}'.format(self.zoom),
+                            '{0}_{1}.json'.format(*key))
+
+    def _load(self, key):
+        if key in self._cache:
+            # Move the location to the end, as the most recently used.
+            self._cache[key] = self._cache.pop(key)
+            return True, self._cache[key]
+        path = self._cache_path(key)
+        if path is None or not os.path.exists(path):
+            return False, None
+        try:
+            with io.open(path, encoding='utf-8') as cache_file:
+                location = json.load(cache_file)
+        except (IOError, OSError, ValueError):  # Corrupt, query it again
+            return False, None
+        self._remember(key, location)
+        return True, location
+
+    def _remember(self, key, location):
+        self._cache[key] = location
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _store(self, key, location):
+        self._remember(key, location)
+        path = self._cache_path(key)
+        if path is None:
+            return
+        try:
+            makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a tempfile first so that a partially written cache
+            # file is never read.
+            fd, name = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix='tmp_file_metadata')
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(json.dumps(location).encode('utf-8'))
+            os.rename(name, path)
+        except (IOError, OSError):
+            pass
+
+    def _get(self, path):
+        """
+        Send a GET request on the kept alive connection and return the
+        status and body of the response.
+        """
+        if self._pid != os.getpid():
+            # The process was forked, the socket of the parent's connection
+            # must not be used by the child.
+            self._connection, self._pid = None, os.getpid()
+        if self._connection is None:
+            parts = urlsplit(self.url)
+            connection_class = (http_client.HTTPSConnection
+                                if parts.scheme == 'https' else
+                                http_client.HTTPConnection)
+            self._connection = connection_class(parts.netloc,
+                                                timeout=self.timeout)
+
+        wait = self._last_request + self.delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_request = time.time()
+        try:
+            self._connection.request('GET', path, headers={
+                'User-Agent': 'file-metadata/' + __version__})
+            response = self._connection.getresponse()
+            body = response.read()
+        except Exception:
+            self.close()
+            raise
+        if response.getheader('connection', '').lower() == 'close':
+            self.close()
+        return response.status, body
+
+    def reverse(self, lat, lon):
+        key = (round(float(lat), self.precision),
+               round(float(lon), self.precision))
+        query = urlencode([('format', 'json'), ('accept-language', 'en'),
+                           ('lat', key[0]), ('lon', key[1]),
+                           ('zoom', self.zoom)])
+        url = self.url + '?' + query
+
+        with self._lock:
+            found, location = self._load(key)
+            if not found:
+                path = urlsplit(self.url).path + '?' + query
+                try:
+                    try:
+                        status, body = self._get(path)
+                    except (IOError, http_client.HTTPException):
+                        # The server may have closed the kept alive
+                        # connection, retry once with a new connection.
+                        status, body = self._get(path)
+                    if status != 200:
+                        raise IOError('HTTP status {0}'.format(status))
+                    location = json.loads(body.decode('utf-8'))
+                except (IOError, ValueError,
+                        http_client.HTTPException) as err:
+                    logging.warn('An issue occured while querying nominatim '
+                                 'with: ' + url)
+                    logging.exception(err)
+                    return None
+                self._store(key, location)
+
+        if not isinstance(location, dict) or 'address' not in location:
+            return None  # No location found
+
+        addr = location['address']
+        return {'country': addr.get('country'),
+                'state': addr.get('state'),
+                'city': addr.get('city')}
+
+    def close(self):
+        """
+        Close the kept alive connection.
+        """
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+
+_gazetteers = {}
+_gazetteers_lock = threading.Lock()
+
+
+def gazetteer(filename):
+    """
+    The process-wide ``Gazetteer`` for the given GeoNames dump, which is
+    read only once.
+
+    :param filename: The path of the GeoNames dump.
+    :return:         A ``Gazetteer`` object.
+    """
+    filename = os.path.abspath(filename)
+    with _gazetteers_lock:
+        if filename not in _gazetteers:
+            _gazetteers[filename] = Gazetteer(filename)
+        return _gazetteers[filename]
+
+
+_nominatim = []
+_nominatim_lock = threading.Lock()
+
+
+def nominatim():
+    """
+    The process-wide ``Nominatim`` resolver, so that its connection and
+    cache are shared by all the files.
+
+    :return: A ``Nominatim`` object.
+    """
+    with _nominatim_lock:
+        if not _nominatim:
+            _nominatim.append(Nominatim())
+        return _nominatim[0]
+
+
+@atexit.register
+def close_nominatim():
+    """
+    Close the connection of the resolver given by ``nominatim()``.
+    """
+    with _nominatim_lock:
+        for resolver in _nominatim:
+            resolver.close()
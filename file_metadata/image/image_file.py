@@ -3,11 +3,13 @@
 from __future__ import (division, absolute_import, unicode_literals,
                         print_function)
 
-import json
+import contextlib
+import functools
 import logging
 import os
 import re
 import subprocess
+import threading
 import warnings
 
 import dlib
@@ -23,71 +25,413 @@ import skimage.transform
 import zbar
 from PIL import Image
 from pycolorname.pantone.pantonepaint import PantonePaint
-from six.moves.urllib.request import urlopen
-from six.moves.urllib.error import URLError
 
 from file_metadata.generic_file import GenericFile
+from file_metadata.geocoding import gazetteer, nominatim
+from file_metadata.mixins import wand_ndarray
 from file_metadata.utilities import (DictNoNone, app_dir, bz2_decompress,
-                                     download, to_cstr, memoized, DATA_PATH)
+                                     download, to_cstr, memoized, requires,
+                                     DATA_PATH, ObjectPool)
+from file_metadata.zxing import zxing_server
 
 # A Decompression Bomb is a small compressed image file which when decompressed
 # uses a uge amount of RAM. For example, a monochrome PNG file with 100kx100k
 # pixels. This tells PIL to make this warning into an error.
 warnings.simplefilter('error', Image.DecompressionBombWarning)
+# Newer versions of PIL raise an error instead for images with more than
+# twice the allowed number of pixels.
+DECOMPRESSION_BOMB = tuple(
+    getattr(Image, name)
+    for name in ('DecompressionBombWarning', 'DecompressionBombError')
+    if hasattr(Image, name))
+# The haarcascade files used by ``ImageFile.analyze_face_haarcascades()``.
+HAARCASCADES = {
+    'frontal_face': 'haarcascade_frontalface_alt.xml',
+    'profile_face': 'haarcascade_profileface.xml',
+    'nested': 'haarcascade_eye_tree_eyeglasses.xml',
+    'mouth': 'haarcascade_mcs_mouth.xml',
+    'nose': 'haarcascade_mcs_nose.xml',
+    'right_eye': 'haarcascade_righteye_2splits.xml',
+    'left_eye': 'haarcascade_lefteye_2splits.xml',
+    'left_ear': 'haarcascade_mcs_leftear.xml',
+    'right_ear': 'haarcascade_mcs_rightear.xml',
+    'upper_body': 'haarcascade_upperbody.xml',
+    'lower_body': 'haarcascade_lowerbody.xml'}
+
+_haarcascade_dir = {}
+_haarcascade_pools = {}
+_haarcascade_lock = threading.Lock()
+
+
+def haarcascade_directory():
+    """
+    Find the directory with the haarcascade files of OpenCV. This is done
+    once per process.
+
+    :return: The path of the directory, or None if OpenCV or its data files
+             are not installed.
+    """
+    with _haarcascade_lock:
+        if 'directory' not in _haarcascade_dir:
+            directory = None
+            try:
+                import cv2
+            except ImportError:
+                pass
+            else:
+                share = os.path.join(os.path.realpath(cv2.__file__),
+                                     *([os.pardir] * 4 + ['share']))
+                for name in ('OpenCV', 'opencv'):
+                    path = os.path.abspath(
+                        os.path.join(share, name, 'haarcascades'))
+                    if os.path.exists(path):
+                        directory = path
+                        break
+            _haarcascade_dir['directory'] = directory
+        return _haarcascade_dir['directory']
+
+
+def _haarcascade_pool(filename, directory=None):
+    if directory is None or not os.path.exists(directory):
+        directory = haarcascade_directory()
+    if directory is None:
+        return None
+    path = os.path.join(directory, filename)
+    with _haarcascade_lock:
+        if path not in _haarcascade_pools:
+            import cv2
+            _haarcascade_pools[path] = ObjectPool(
+                functools.partial(cv2.CascadeClassifier, path))
+        return _haarcascade_pools[path]
+
+
+@contextlib.contextmanager
+def haarcascade_classifier(filename, directory=None):
+    """
+    Get a ``cv2.CascadeClassifier`` of a haarcascade file, for use in a
+    ``with`` statement. Parsing the file takes long, hence the classifiers
+    are kept for the lifetime of the process. OpenCV's classifiers are not
+    thread safe, so a classifier is only used by one thread at a time and
+    more classifiers are created for threads using the file at once.
+
+    :param filename:  The name of the haarcascade file.
+    :param directory: The directory of the haarcascade file. The directory
+                      from ``haarcascade_directory()`` is used if it is not
+                      given or does not exist.
+    :return:          A context manager giving the classifier, or None if
+                      the directory was not found.
+    """
+    pool = _haarcascade_pool(filename, directory)
+    if pool is None:
+        yield None
+        return
+    with pool.get() as classifier:
+        yield classifier
+
+
+# The data file of dlib's shape predictor for the 68 facial landmarks.
+SHAPE_PREDICTOR_DAT = 'shape_predictor_68_face_landmarks.dat'
+SHAPE_PREDICTOR_URL = ('http://sourceforge.net/projects/dclib/files/dlib/'
+                       'v18.10/shape_predictor_68_face_landmarks.dat.bz2')
+
+_dlib_models = {}
+_dlib_lock = threading.Lock()
+_dlib_face_detectors = ObjectPool(dlib.get_frontal_face_detector)
+
+
+def dlib_face_detector():
+    """
+    Get dlib's frontal face detector, for use in a ``with`` statement. The
+    detectors keep buffers while detecting, so a detector is only used by
+    one thread at a time.
+
+    :return: A context manager giving a ``dlib.fhog_object_detector``.
+    """
+    return _dlib_face_detectors.get()
+
+
+def _zbar_new_scanner():
+    scanner = zbar.ImageScanner()
+    scanner.parse_config('enable')
+    return scanner
+
+
+_zbar_scanners = ObjectPool(_zbar_new_scanner)
+
+
+def zbar_scanner():
+    """
+    Get a ``zbar`` scanner with all the symbologies enabled, for use in a
+    ``with`` statement. The scanners keep state while scanning, so a
+    scanner is only used by one thread at a time.
+
+    :return: A context manager giving a ``zbar.ImageScanner``.
+    """
+    return _zbar_scanners.get()
+
+
+def dlib_shape_predictor():
+    """
+    Get dlib's shape predictor for the 68 facial landmarks. The data file is
+    downloaded if it does not exist yet and the predictor is loaded once per
+    process, as loading it takes about a second.
+
+    :return: A ``dlib.shape_predictor`` object.
+    """
+    with _dlib_lock:
+        if 'shape_predictor' not in _dlib_models:
+            dat_path = app_dir('user_data_dir', SHAPE_PREDICTOR_DAT)
+            if not os.path.exists(dat_path):
+                logging.warn('Downloading the landmark data file for facial '
+                             'landmark detection. Hence, the '
+                             'first run may take longer than normal.')
+                arch_path = app_dir('user_data_dir',
+                                    SHAPE_PREDICTOR_DAT + '.bz2')
+                download(SHAPE_PREDICTOR_URL, arch_path)
+                # Decompress into another file first, so that an interrupted
+                # run does not leave a truncated data file behind.
+                try:
+                    bz2_decompress(arch_path, dat_path + '.part')
+                except (IOError, EOFError):
+                    os.remove(arch_path)
+                    raise
+                os.rename(dat_path + '.part', dat_path)
+            try:
+                _dlib_models['shape_predictor'] = dlib.shape_predictor(
+                    to_cstr(dat_path))
+            except RuntimeError:
+                # The data file is corrupt, download it again next time.
+                os.remove(dat_path)
+                raise
+        return _dlib_models['shape_predictor']
+
+
+# The sRGB to XYZ matrix and the D65 white point used by ``colormath``.
+SRGB_TO_XYZ = numpy.array([[0.412424, 0.357579, 0.180464],
+                           [0.212656, 0.715158, 0.0721856],
+                           [0.0193324, 0.119193, 0.950444]])
+D65_WHITE = numpy.array([0.95047, 1.00000, 1.08883])
+
+
+def srgb_to_lab(colors):
+    """
+    Convert sRGB colors to CIE Lab with the D65 illuminant, exactly like
+    ``colormath.color_conversions.convert_color`` does for one
+    ``sRGBColor``, but for many colors at once.
+
+    :param colors: An array-like with the r, g, b values in the last axis.
+    :return:       An array with the L, a, b values in the last axis.
+    """
+    rgb = numpy.asarray(colors, dtype=float)
+    with numpy.errstate(invalid='ignore'):
+        linear = numpy.where(rgb <= 0.04045, rgb / 12.92,
+                             ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = numpy.maximum(linear.dot(SRGB_TO_XYZ.T), 0) / D65_WHITE
+    xyz = numpy.where(xyz > 216.0 / 24389.0, xyz ** (1.0 / 3.0),
+                      7.787 * xyz + 16.0 / 116.0)
+    return numpy.stack([116.0 * xyz[..., 1] - 16.0,
+                        500.0 * (xyz[..., 0] - xyz[..., 1]),
+                        200.0 * (xyz[..., 1] - xyz[..., 2])], axis=-1)
+
+
+class ColorPalette(object):
+    """
+    The colors of a ``pycolorname`` color system in a numpy array, to find
+    the closest colors of many colors at once. The colors are compared like
+    ``ColorSystem.find_closest()`` does, with the CIE 1976 delta E.
+
+    :ivar names:  The names of the colors.
+    :ivar colors: The r, g, b tuples of the colors.
+    :ivar lab:    The colors in CIE Lab, as an array of shape (colors, 3).
+    """
+
+    def __init__(self, color_system):
+        items = list(color_system.items())
+        self.names = [name for name, _ in items]
+        self.colors = [tuple(color) for _, color in items]
+        self.lab = srgb_to_lab(self.colors)
+
+    def closest(self, colors, chunk_size=256):
+        """
+        Find the closest color in the palette for every color.
+
+        :param colors:     An array-like with the r, g, b values in the last
+                           axis.
+        :param chunk_size: The number of colors to compare at a time.
+        :return:           An array with the index of the closest palette
+                           color for every color.
+        """
+        lab = srgb_to_lab(colors)
+        shape, lab = lab.shape[:-1], lab.reshape(-1, 3)
+        indices = numpy.empty(len(lab), dtype=numpy.intp)
+        for start in range(0, len(lab), chunk_size):
+            diff = lab[start:start + chunk_size, None, :] - self.lab
+            indices[start:start + chunk_size] = numpy.einsum(
+                'ijk,ijk->ij', diff, diff).argmin(axis=1)
+        return indices.reshape(shape)
+
+    def find_closest(self, color):
+        """
+        Find the closest color in the palette to a color.
+
+        :param color: Tuple of r, g, b values.
+        :return:      Tuple of name and rgb closest to the given color.
+        """
+        index = int(self.closest(color))
+        return self.names[index], self.colors[index]
+
+
+_palettes = {}
+_palettes_lock = threading.Lock()
+
+
+def pantone_palette():
+    """
+    Get the Pantone colors of ``pycolorname``, which are read once per
+    process.
+
+    :return: A ``ColorPalette`` object.
+    """
+    with _palettes_lock:
+        if 'pantone' not in _palettes:
+            _palettes['pantone'] = ColorPalette(PantonePaint())
+        return _palettes['pantone']
+
+
+def preload(threads=1):
+    """
+    Load the data used by the analyzers of ``ImageFile`` ahead of time, for
+    example when a worker process starts, instead of while analyzing the
+    first image. Data files which have not been downloaded yet are still
+    downloaded when they are first needed.
+
+    :param threads: The number of threads which analyze images at the same
+                    time, hence the number of classifiers to create.
+    """
+    for filename in set(HAARCASCADES.values()):
+        pool = _haarcascade_pool(filename)
+        if pool is not None:
+            pool.fill(threads)
+    _dlib_face_detectors.fill(threads)
+    _zbar_scanners.fill(threads)
+    pantone_palette()
+    if os.path.exists(app_dir('user_data_dir', SHAPE_PREDICTOR_DAT)):
+        dlib_shape_predictor()
 
 
 class ImageFile(GenericFile):
     mimetypes = ()
+    result_options = GenericFile.result_options + (
+        'max_decompressed_size', 'gazetteer')
 
     def config(self, key, new_defaults=()):
         defaults = {
-            "max_decompressed_size": int(1024 ** 3 / 4 / 3)  # In bytes
+            "max_decompressed_size": int(1024 ** 3 / 4 / 3),  # In bytes
+            # A GeoNames dump used for offline reverse geocoding.
+            "gazetteer": None
         }
         defaults.update(dict(new_defaults))  # Update the defaults from child
         return super(ImageFile, self).config(key, new_defaults=defaults)
 
     @classmethod
-    def create(cls, *args, **kwargs):
-        cls_file = cls(*args, **kwargs)
+    def create_from(cls, cls_file):
         mime = cls_file.mime()
         _type, subtype = mime.split('/', 1)
 
         if mime == 'image/jpeg':
             from file_metadata.image.jpeg_file import JPEGFile
-            return JPEGFile.create(*args, **kwargs)
+            return JPEGFile.create_from(cls_file)
         elif _type in ('image', 'application') and subtype == 'x-xcf':
             from file_metadata.image.xcf_file import XCFFile
-            return XCFFile.create(*args, **kwargs)
+            return XCFFile.create_from(cls_file)
         elif mime == 'image/tiff':
             from file_metadata.image.tiff_file import TIFFFile
-            return TIFFFile.create(*args, **kwargs)
+            return TIFFFile.create_from(cls_file)
         elif cls_file.is_type('svg'):
             from file_metadata.image.svg_file import SVGFile
-            return SVGFile.create(*args, **kwargs)
-        return cls(*args, **kwargs)
+            return SVGFile.create_from(cls_file)
+        return cls_file.cast(cls)
 
     def is_type(self, key):
         if key == 'alpha':
-            return self.fetch('pillow').mode in ('LA', 'RGBA')
+            try:
+                return self.fetch('pillow').mode in ('LA', 'RGBA')
+            except DECOMPRESSION_BOMB:
+                return self.fetch('ping')['alpha']
+        elif key == 'animated':
+            # Animated images and multi page images. Only the first frame of
+            # the images which Pillow refuses to open is read.
+            try:
+                return getattr(self.fetch('pillow'), 'n_frames', 1) > 1
+            except DECOMPRESSION_BOMB:
+                return False
+        elif key == 'too_large':
+            # Images with more pixels than allowed are never decoded at full
+            # resolution, they are read in tiles or at a lower resolution.
+            # Pillow's own limit is also used, as it refuses to open them.
+            width, height = self.fetch('size')
+            limits = [self.config('max_decompressed_size'),
+                      Image.MAX_IMAGE_PIXELS]
+            return width * height > min(limit for limit in limits
+                                        if limit is not None)
         return super(ImageFile, self).is_type(key)
 
+    def _analyze_requirement(self, key):
+        # The analysis methods read animated images a frame at a time and
+        # images which are too large a tile at a time, all of their pixels
+        # should not be decoded beforehand.
+        try:
+            skip = key.startswith('ndarray') and (
+                self.is_type('animated') or self.is_type('too_large'))
+        except Exception:
+            skip = False
+        if not skip:
+            super(ImageFile, self)._analyze_requirement(key)
+
     @memoized
-    def fetch(self, key=''):
+    def fetch(self, key='', **kwargs):
         if key == 'filename_raster':
             # A raster filename holds the file in a raster graphic format
             return self.fetch('filename')
         elif key == 'filename_zxing':
             return pathlib2.Path(self.fetch('filename_raster')).as_uri()
+        elif key in ('ndarray', 'ndarray_grey') and 'max_side' in kwargs:
+            # Decode at the largest power of two reduction which still has
+            # ``max_side`` pixels on the longer side. Analyzers asking for
+            # similar sizes hence share the same array.
+            if self.is_type('too_large'):
+                return self.fetch(key, overview=kwargs['max_side'])
+            longer_side, factor = max(self.fetch('size')), 1
+            while longer_side // (factor * 2) >= kwargs['max_side']:
+                factor *= 2
+            if factor == 1 or self.is_type('animated'):
+                return self.fetch(key)
+            if (key == 'ndarray_grey' and
+                    self.fetch('pillow').format != 'JPEG'):
+                # Only JPEG files can be decoded at a lower resolution, the
+                # others are decoded fully anyway, so share the pyramid.
+                pyramid = self.fetch('pyramid')
+                return pyramid[min(factor.bit_length() - 1, len(pyramid) - 1)]
+            return self.fetch(key, reduce=factor)
+        elif key == 'ndarray' and 'reduce' in kwargs:
+            if self.is_type('too_large'):
+                return self.fetch(key)
+            elif self.fetch('pillow').format != 'JPEG':
+                # Only JPEG files can be decoded at a lower resolution, the
+                # others are decoded fully anyway, so reduce the shared array.
+                return self._reduce(self.fetch('ndarray'), kwargs['reduce'])
+            return self._read_reduced(kwargs['reduce'])
+        elif key == 'ndarray' and 'overview' in kwargs:
+            return self._read_overview(kwargs['overview'])
         elif key == 'ndarray':
-            Image.MAX_IMAGE_PIXELS = self.config('max_decompressed_size')
-            try:
-                image_array = skimage.io.imread(self.fetch('filename_raster'))
-                if image_array.shape == (2,):
-                    # Assume this is related to
-                    # https://github.com/scikit-image/scikit-image/issues/2154
-                    return image_array[0]
-                return image_array
-            except Image.DecompressionBombWarning:
+            image_array = None
+            if not self.is_type('too_large'):
+                try:
+                    image_array = skimage.io.imread(
+                        self.fetch('filename_raster'))
+                except DECOMPRESSION_BOMB:
+                    pass
+            if image_array is None:
                 logging.warn('The file "{0}" contains a lot of pixels and '
                              'can take a lot of memory when decompressed. '
                              'To allow larger images, modify the '
@@ -95,11 +439,16 @@ class ImageFile(GenericFile):
                              .format(self.fetch('filename')))
                 # Use empty array as the file cannot be read.
                 return numpy.ndarray(0)
+            if image_array.shape == (2,):
+                # Assume this is related to
+                # https://github.com/scikit-image/scikit-image/issues/2154
+                return image_array[0]
+            return image_array
         elif key == 'ndarray_grey':
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
                 return skimage.img_as_ubyte(
-                    skimage.color.rgb2grey(self.fetch('ndarray')))
+                    skimage.color.rgb2grey(self.fetch('ndarray', **kwargs)))
         elif key == 'ndarray_hsv':
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
@@ -109,39 +458,478 @@ class ImageFile(GenericFile):
             if self.is_type('alpha'):
                 return self.alpha_blend(self.fetch('ndarray'))
             return self.fetch('ndarray')
+        elif key == 'pyramid':
+            # The grey image followed by versions with half the width and
+            # height of the previous one, down to about 32 pixels.
+            levels = [self.fetch('ndarray_grey')]
+            while (levels[-1].ndim >= 2 and
+                    min(levels[-1].shape[-2:]) >= 2 and
+                    max(levels[-1].shape[-2:]) // 2 >= 32):
+                levels.append(self._downsample(levels[-1]))
+            return tuple(levels)
+        elif key == 'histogram':
+            # The number of pixels with each value from 0 to 255 in a channel
+            # ("grey", "red", "green", "blue", or "rgb" for all three). The
+            # region is (top, bottom, left, right) in pixels.
+            channel = kwargs.get('channel', 'grey')
+            region = kwargs.get('region')
+            if kwargs != {'channel': channel, 'region': region}:
+                # Share the cached histogram for equivalent arguments.
+                return self.fetch('histogram', channel=channel, region=region)
+            elif channel in ('red', 'green', 'blue'):
+                return self.fetch('histogram', channel='rgb', region=region)[
+                    ('red', 'green', 'blue').index(channel)]
+            elif self.is_type('too_large') or self.is_type('animated'):
+                hist = self._streamed_histograms(channel == 'rgb', region)
+                return hist if channel == 'rgb' else hist[0]
+            elif channel == 'rgb':
+                image_array = self.fetch('ndarray_noalpha')
+            else:
+                image_array = self.fetch('ndarray_grey')[..., None]
+            if region is not None:
+                top, bottom, left, right = region
+                image_array = image_array[..., top:bottom, left:right, :]
+            hist = self._channel_histograms(image_array)
+            return hist if channel == 'rgb' else hist[0]
         elif key == 'pillow':
-            pillow_img = Image.open(self.fetch('filename_raster'))
+            pillow_img = self._open_raster()
             self.closables.append(pillow_img)
             return pillow_img
-        return super(ImageFile, self).fetch(key)
+        elif key == 'size':
+            # The (width, height) of the image in pixels.
+            try:
+                return self.fetch('pillow').size
+            except DECOMPRESSION_BOMB:
+                return self.fetch('ping')['size']
+        elif key == 'ping':
+            # The header of the image read by ImageMagick without decoding
+            # the pixels, for the images which Pillow refuses to open.
+            import wand.image
+
+            with wand.image.Image.ping(filename=self._wand_raster()) \
+                    as image:
+                return {'size': image.size,
+                        'alpha': bool(image.alpha_channel)}
+        return super(ImageFile, self).fetch(key, **kwargs)
+
+    def _open_raster(self):
+        """
+        Open the raster image with Pillow. The caller has to close it.
+
+        :return: A ``PIL.Image.Image`` object.
+        """
+        return Image.open(self.fetch('filename_raster'))
+
+    def _read_reduced(self, factor):
+        """
+        Read the raster image with both sides reduced by the given factor.
+        JPEG files are scaled by libjpeg while decoding, hence the image is
+        never decoded at full resolution.
+
+        :param factor: The integer to divide the width and height by.
+        :return:       The numpy array of the reduced image, which can be
+                       modified.
+        """
+        image = self._open_raster()
+        try:
+            size = (max(1, image.size[0] // factor),
+                    max(1, image.size[1] // factor))
+            if image.format == 'JPEG':
+                image.draft(image.mode, size)
+
+            reduced = self._array_mode(image)
+            remaining = reduced.size[0] // size[0]
+            if remaining > 1 and hasattr(reduced, 'reduce'):
+                reduced = reduced.reduce(remaining)
+            if reduced.size != size:
+                reduced = reduced.resize(size, Image.LANCZOS)
+            return numpy.array(reduced)
+        finally:
+            image.close()
+
+    @staticmethod
+    def _array_mode(image, grey_palette=None):
+        """
+        Convert a Pillow image to the mode skimage.io.imread() would use for
+        the array of the image.
+
+        :param image:        The ``PIL.Image.Image`` to convert.
+        :param grey_palette: Whether the palette of a "P" image only has
+                             grey colors. Found from the palette if None.
+        :return:             The converted image, or the image itself.
+        """
+        if image.mode == 'P':
+            if grey_palette is None:
+                grey_palette = ImageFile._is_grey_palette(image)
+            if grey_palette:
+                return image.convert('L')
+            return image.convert(
+                'RGBA' if image.format == 'PNG' and
+                'transparency' in image.info else 'RGB')
+        elif image.mode == '1':
+            return image.convert('L')
+        elif 'A' in image.mode and image.mode != 'RGBA':
+            return image.convert('RGBA')
+        elif image.mode not in ('L', 'RGB', 'RGBA', 'I', 'F'):
+            return image.convert('RGB')
+        return image
 
     @staticmethod
-    def alpha_blend(img, background=255):
+    def _is_grey_palette(image):
+        """
+        Check whether the colors used by a "P" image are all grey.
+        """
+        palette = numpy.asarray(image.getpalette()).reshape((-1, 3))
+        start, stop = image.getextrema()
+        used = palette[start:stop + 1]
+        return bool((numpy.diff(used) == 0).all())
+
+    @contextlib.contextmanager
+    def _wand_image(self, filename):
+        """
+        Open a raster image with ``wand`` without using more memory than
+        ``max_decompressed_size`` allows. ImageMagick keeps the pixels which
+        do not fit in the memory limit in a file on disk instead.
+
+        :param filename: The filename to give ImageMagick.
+        :return:         A context manager giving a ``wand.image.Image``.
+        """
+        # Imported here as ImageMagick is only needed for large images.
+        import wand.image
+        import wand.resource
+
+        # The limits are in bytes, allow as many as an 8 bit RGB array.
+        limit = self.config('max_decompressed_size') * 3
+        old_limits = dict((resource, wand.resource.limits[resource])
+                          for resource in ('memory', 'map'))
+        try:
+            for resource in old_limits:
+                wand.resource.limits[resource] = limit
+            with wand.image.Image(filename=filename) as image:
+                yield image
+        finally:
+            for resource, old_limit in old_limits.items():
+                wand.resource.limits[resource] = old_limit
+
+    def _wand_raster(self):
+        """
+        The filename to give ImageMagick to read the first frame of the image.
+        """
+        return self.fetch('filename_raster') + '[0]'
+
+    def _read_overview(self, max_side):
+        """
+        Read an image which is too large to decode at full resolution with
+        ``max_side`` pixels on the longer side. JPEG files are scaled by
+        libjpeg while decoding, other files are resized by ImageMagick.
+
+        :param max_side: The number of pixels on the longer side.
+        :return:         The numpy array of the reduced image.
+        """
+        try:
+            image = self._open_raster()
+        except DECOMPRESSION_BOMB:
+            # Pillow refuses to open the image, even to read its header.
+            return self._resize_raster(max_side)
+        try:
+            if image.format == 'JPEG':
+                image.draft(image.mode, (max_side, max_side))
+                width, height = image.size
+                if width * height <= self.config('max_decompressed_size'):
+                    return numpy.asarray(self._array_mode(image))
+        finally:
+            image.close()
+        return self._resize_raster(max_side)
+
+    def _resize_raster(self, max_side):
+        """
+        Read the first frame of the image with ImageMagick, resized to fit
+        in ``max_side`` x ``max_side`` pixels.
+
+        :param max_side: The number of pixels on the longer side.
+        :return:         The numpy array of the resized image.
+        """
+        with self._wand_image(self._wand_raster()) as image:
+            scale = max_side / max(image.size)
+            image.resize(max(1, int(round(image.width * scale))),
+                         max(1, int(round(image.height * scale))))
+            return wand_ndarray(
+                image, 'RGBA' if self.is_type('alpha') else 'RGB')
+
+    def iter_tiles(self, tile_size=1024):
+        """
+        Give the first frame of the image as tiles of at most ``tile_size``
+        x ``tile_size`` pixels, from left to right and top to bottom. Images
+        which are too large to decode at full resolution are read by
+        ImageMagick with bounded memory, and always give RGB or RGBA tiles.
+
+        :param tile_size: The width and height of the tiles in pixels.
+        :return:          A generator of (top, left, ndarray) tuples.
+        """
+        if not self.is_type('too_large'):
+            _, image_array = next(self.iter_frames('first'))
+            for top in range(0, image_array.shape[0], tile_size):
+                for left in range(0, image_array.shape[1], tile_size):
+                    yield top, left, image_array[top:top + tile_size,
+                                                 left:left + tile_size]
+            return
+
+        channels = 'RGBA' if self.is_type('alpha') else 'RGB'
+        with self._wand_image(self._wand_raster()) as image:
+            for top in range(0, image.height, tile_size):
+                for left in range(0, image.width, tile_size):
+                    with image[left:left + tile_size,
+                               top:top + tile_size] as tile:
+                        yield top, left, wand_ndarray(tile, channels)
+
+    def iter_frames(self, sample='all', keyframe_threshold=8):
+        """
+        Give the frames of an animated or multi page image one at a time,
+        so that a single frame is in memory at once. Images with one frame
+        give the array of the whole image.
+
+        :param sample:             The frames to give: "all", "first",
+                                   "keyframes" for the frames which differ
+                                   from the previous keyframe, or an integer
+                                   n for every nth frame.
+        :param keyframe_threshold: The mean absolute difference (from 0 to
+                                   255) from the previous keyframe at which
+                                   a frame is a keyframe.
+        :return:                   A generator of (index, ndarray) tuples.
+        """
+        if not self.is_type('animated'):
+            yield 0, self.fetch('ndarray')
+            return
+
+        image = self._open_raster()
+        try:
+            mode, grey_palette, keyframe = None, None, None
+            for index in range(image.n_frames):
+                if sample == 'first' and index > 0:
+                    break
+                elif (isinstance(sample, six.integer_types) and
+                        index % sample != 0):
+                    continue
+                # Pillow decodes the frames in between when seeking.
+                image.seek(index)
+                if grey_palette is None and image.mode == 'P':
+                    grey_palette = self._is_grey_palette(image)
+                frame = self._array_mode(image, grey_palette)
+                if mode is None:
+                    mode = frame.mode
+                elif frame.mode != mode:
+                    frame = frame.convert(mode)
+                frame = numpy.asarray(frame)
+
+                if sample == 'keyframes':
+                    if (keyframe is not None and
+                            keyframe.shape == frame.shape and
+                            numpy.abs(frame.astype(numpy.int16) - keyframe)
+                            .mean() <= keyframe_threshold):
+                        continue
+                    keyframe = frame
+                yield index, frame
+        finally:
+            image.close()
+
+    def _noalpha(self, img):
+        """
+        Remove the alpha channel of a frame or a tile, and the channel axis
+        of greyscale ones.
+
+        :param img: The image with the channels in the last axis.
+        :return:    The RGB or greyscale image.
+        """
+        if img.ndim == 3 and img.shape[2] in (2, 4):
+            img = self.alpha_blend(img)
+        if img.ndim == 3 and img.shape[2] == 1:
+            img = img[..., 0]
+        return img
+
+    @staticmethod
+    def _grey(img):
+        """
+        Convert an RGB frame or tile to 8 bit greyscale.
+
+        :param img: The RGB or greyscale image.
+        :return:    The greyscale image.
+        """
+        if img.ndim == 2:
+            return img
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return skimage.img_as_ubyte(skimage.color.rgb2grey(img))
+
+    def _streamed_histograms(self, rgb=True, region=None):
+        """
+        Count the pixels with each value from 0 to 255 like the "histogram"
+        key does, one tile at a time for images which are too large or one
+        frame at a time for animated images.
+
+        :param rgb:    Count the red, green and blue channels if True, else
+                       count the grey channel.
+        :param region: The (top, bottom, left, right) region to count.
+        :return:       An array with the shape (channels, 256).
+        """
+        if self.is_type('too_large'):
+            tiles = self.iter_tiles()
+        else:
+            tiles = ((0, 0, frame) for _, frame in self.iter_frames())
+
+        top, bottom, left, right = region or (None, None, None, None)
+        hist = numpy.zeros((3 if rgb else 1, 256), dtype=numpy.intp)
+        for tile_top, tile_left, tile in tiles:
+            tile = tile[max(0, (top or 0) - tile_top):
+                        None if bottom is None else max(0, bottom - tile_top),
+                        max(0, (left or 0) - tile_left):
+                        None if right is None else max(0, right - tile_left)]
+            if tile.size == 0:
+                continue
+            tile = self._noalpha(tile)
+            if not rgb:
+                tile = self._grey(tile)
+            counts = self._channel_histograms(
+                tile if tile.ndim == 3 else tile[..., None])
+            hist += counts if len(counts) == len(hist) else counts[[0] * 3]
+        return hist
+
+    @staticmethod
+    def _downsample(img):
+        """
+        Halve the width and height of an 8 bit image by averaging blocks of
+        2x2 pixels. An odd last row or column is dropped.
+
+        :param img: The image with the rows and columns in the last axes.
+        :return:    The downsampled image.
+        """
+        height, width = img.shape[-2] // 2 * 2, img.shape[-1] // 2 * 2
+        img = img[..., :height, :width]
+        total = img[..., 0::2, 0::2].astype(numpy.uint16)
+        total += img[..., 1::2, 0::2]
+        total += img[..., 0::2, 1::2]
+        total += img[..., 1::2, 1::2]
+        total += 2
+        total >>= 2
+        return total.astype(numpy.uint8)
+
+    @staticmethod
+    def _reduce(img, factor):
+        """
+        Divide the width and height of an image by an integer by averaging
+        blocks of pixels. The last rows and columns which do not fill a
+        block are dropped.
+
+        :param img:    The image with the rows and columns in the first
+                       axes.
+        :param factor: The integer to divide the width and height by.
+        :return:       The reduced image, with the dtype of the image.
+        """
+        if img.ndim < 2:  # The image could not be read
+            return img
+        height = max(1, img.shape[0] // factor)
+        width = max(1, img.shape[1] // factor)
+        blocks = img[:height * factor, :width * factor].reshape(
+            (height, min(factor, img.shape[0]), width,
+             min(factor, img.shape[1])) + img.shape[2:])
+        reduced = blocks.mean(axis=(1, 3))
+        if img.dtype.kind in 'iub':
+            reduced = numpy.rint(reduced)
+        return reduced.astype(img.dtype)
+
+    @staticmethod
+    def _channel_histograms(img, chunk_rows=256):
+        """
+        Count the pixels with each value from 0 to 255 in all the channels
+        of an image in one pass. 8 bit images are counted with bincount a
+        chunk of rows at a time, other images use numpy.histogram.
+
+        :param img:        The image with the channels in the last axis.
+        :param chunk_rows: The number of rows to count at a time.
+        :return:           An array with the shape (channels, 256).
+        """
+        nchannels = img.shape[-1]
+        if img.dtype != numpy.uint8:
+            return numpy.array([
+                numpy.histogram(img[..., ichan], bins=range(257))[0]
+                for ichan in range(nchannels)])
+
+        if img.ndim > 3:  # Animated images
+            img = img.reshape((-1,) + img.shape[-2:])
+        offsets = numpy.arange(nchannels, dtype=numpy.intp) * 256
+        counts = numpy.zeros(nchannels * 256, dtype=numpy.intp)
+        for start in range(0, img.shape[0], chunk_rows):
+            # A view if the chunk is contiguous, else a copy of the chunk.
+            pixels = img[start:start + chunk_rows].reshape(-1, nchannels)
+            if nchannels == 1:
+                counts += numpy.bincount(pixels.ravel(), minlength=256)
+            else:
+                counts += numpy.bincount((pixels + offsets).ravel(),
+                                         minlength=nchannels * 256)
+        return counts.reshape(nchannels, 256)
+
+    @staticmethod
+    def alpha_blend(img, background=255, out=None, chunk_rows=256):
         """
         Take an image, assume the last channel is a alpha channel and remove it
         by using the appropriate background.
 
+        Images with 8 bit channels are blended with integer arithmetic. The
+        image is blended ``chunk_rows`` rows (or frames in animated images)
+        at a time, so the temporary arrays are small compared to the image.
+
         :param img:        The image to alpha blend into given background.
         :param background: The background color to use when alpha blending.
                            A scalar is expected, which is used for all
                            the channels.
+        :param out:        The array to write the blended image into. It
+                           should have the shape of the image without the
+                           alpha channel. A new array is used if not given.
+        :param chunk_rows: The number of rows to blend at a time.
+        :return:           The blended image.
         """
-        alpha = img[..., -1] / 255.0
-        channels = img[..., :-1]
-        new_img = numpy.zeros_like(channels)
-        for ichan in range(channels.shape[-1]):
-            new_img[..., ichan] = numpy.clip(
-                (1 - alpha) * background + alpha * channels[..., ichan],
-                a_min=0, a_max=255)
-        return new_img
-
-    def analyze_geolocation(self, use_nominatim=True):
+        if out is None:
+            out = numpy.empty(img.shape[:-1] + (img.shape[-1] - 1,),
+                              dtype=img.dtype)
+        # Integer arithmetic is only exact for integer backgrounds.
+        integer = (img.dtype == numpy.uint8 and
+                   numpy.ndim(background) == 0 and
+                   float(background).is_integer() and
+                   0 <= background <= 255)
+        for start in range(0, img.shape[0], chunk_rows):
+            chunk = img[start:start + chunk_rows]
+            if integer:
+                # floor((c * a + bg * (255 - a)) / 255) fits in 16 bits, and
+                # (x + 1 + (x >> 8)) >> 8 is x // 255 for such values.
+                alpha = chunk[..., -1:].astype(numpy.uint16)
+                blend = numpy.multiply(chunk[..., :-1], alpha,
+                                       dtype=numpy.uint16)
+                numpy.subtract(255, alpha, out=alpha)
+                alpha *= int(background)
+                blend += alpha
+                blend += (blend >> 8) + 1
+                blend >>= 8
+            else:
+                alpha = chunk[..., -1:] / 255.0
+                blend = alpha * chunk[..., :-1]
+                numpy.subtract(1, alpha, out=alpha)
+                blend += alpha * background
+                numpy.clip(blend, 0, 255, out=blend)
+            out[start:start + chunk_rows] = blend
+        return out
+
+    @requires('exiftool')
+    def analyze_geolocation(self, use_nominatim=True, resolvers=None):
         """
         Find the location where the photo was taken initially. This is
         information which is got using the latitude/longitude in EXIF data.
+        The country, state and city are found offline from the GeoNames dump
+        in the "gazetteer" config if it is set, and else from nominatim.
 
         :param use_nominatim: Whether to use reverse geocoding from nominatim
                               or not.
+        :param resolvers:     The reverse geocoding resolvers to try in
+                              order, instead of the ones above. See
+                              ``file_metadata.geocoding``.
         :return: dict with the keys:
 
              - Composite:Country - The country the photo was taken.
@@ -189,34 +977,33 @@ class ImageFile(GenericFile):
         data = DictNoNone({'Composite:GPSLatitude': lat,
                            'Composite:GPSLongitude': lon})
 
-        if use_nominatim:
-            # Zoom levels: country = 0, megacity = 10, district = 10,
-            # city = 13, village = 15, street = 16, house = 18
-            url = ('http://nominatim.openstreetmap.org/reverse?format=json'
-                   '&accept-language=en&lat={lat}&lon={lon}&zoom={zoom}'
-                   .format(lat=lat, lon=lon, zoom=13))
-            try:
-                response = urlopen(url)
-                location = json.loads(response.read().decode('utf-8'))
-            except URLError as err:
-                logging.warn('An issue occured while querying nominatim '
-                             'with: ' + url)
-                logging.exception(err)
-                return data
-
-            if isinstance(location, list) and len(location) == 0:
-                return data  # No location found
-
-            addr = location.get('address', {})
-            data['Composite:GPSCountry'] = addr.get('country')
-            data['Composite:GPSState'] = addr.get('state')
-            data['Composite:GPSCity'] = addr.get('city')
+        if resolvers is None:
+            resolvers = []
+            if self.config('gazetteer') is not None:
+                resolvers.append(gazetteer(self.config('gazetteer')))
+            if use_nominatim:
+                resolvers.append(nominatim())
+
+        # The first resolver which finds the location is used.
+        for resolver in resolvers:
+            location = resolver.reverse(lat, lon)
+            if location is not None:
+                data['Composite:GPSCountry'] = location.get('country')
+                data['Composite:GPSState'] = location.get('state')
+                data['Composite:GPSCity'] = location.get('city')
+                break
 
         return data
 
-    def analyze_color_calibration_target(self):
+    @requires('ndarray_grey', 'ndarray')
+    def analyze_color_calibration_target(self, max_rows=None):
         """
         Find whether there is a color calibration strip on top of the image.
+
+        :param max_rows: The number of rows sampled from the bars and from
+                         the rest of the image, so that the analysis takes
+                         the same time for tall scans. All the rows are
+                         used if None, sampling can change the results.
         """
         grey_array = self.fetch('ndarray_grey')
         image_array = self.fetch('ndarray')
@@ -227,41 +1014,49 @@ class ImageFile(GenericFile):
         # image and also in the 20% we need the mid area
         bary = int(0.2 * grey_array.shape[0])
 
+        def sample_rows(x):
+            if max_rows is None:
+                return x
+            return x[::max(1, -(-x.shape[0] // max_rows))]
+
         def bar_intensity(x):
             sampley = max(int(0.1 * x.shape[0]), 2)
-            return numpy.mean(
+            return numpy.mean(sample_rows(
                 x[(x.shape[0] - sampley) // 2:(x.shape[0] + sampley) // 2,
-                  :, ...],
+                  :, ...]),
                 axis=0)
 
         topbar = bar_intensity(grey_array[:bary, :, ...])
         botbar = bar_intensity(grey_array[-bary:, :, ...])
 
-        def _merge_near(arr):
-            out = []
-            last_elem = arr[0]
-            out.append(last_elem)
-            for elem in arr[1:]:
-                if elem != last_elem:
-                    out.append(elem)
-                last_elem = elem
-            return numpy.asarray(out)
+        def count_runs(mask):
+            # The number of runs of consecutive True values.
+            if len(mask) == 0:
+                return 0
+            starts = numpy.flatnonzero(
+                numpy.diff(mask.astype(numpy.int8)) == 1)
+            return len(starts) + int(mask[0])
+
+        def grey_mse(rgb, grey, chunk_rows=64):
+            # Accumulate the squared differences a few rows at a time to
+            # keep the temporary arrays small.
+            rgb, grey = sample_rows(rgb[..., :3]), sample_rows(grey)
+            total = 0.0
+            for start in range(0, rgb.shape[0], chunk_rows):
+                diff = (rgb[start:start + chunk_rows].astype(numpy.float32) -
+                        grey[start:start + chunk_rows, ..., None])
+                total += numpy.square(diff).sum(dtype=numpy.float64)
+            return total / max(rgb.size, 1)
 
         # Bottom bars seem to have smaller intensity because of the background
         # Hence, we set a smaller threshold for peaks in bottom bars.
-        bot_spikes = _merge_near((numpy.diff(botbar)) > -2.5).sum()
-        top_spikes = _merge_near((numpy.diff(topbar)) < 3).sum()
+        bot_spikes = count_runs((numpy.diff(botbar)) > -2.5)
+        top_spikes = count_runs((numpy.diff(topbar)) < 3)
         top_grey_mse, bot_grey_mse = 0, 0
         if image_array.ndim == 3:
-            for chan in range(image_array.shape[2]):
-                top_grey_mse += (
-                    (image_array[bary:, :, chan] -
-                     grey_array[bary:]) ** 2).mean()
-                bot_grey_mse += (
-                    (image_array[-bary, :, chan] -
-                     grey_array[-bary]) ** 2).mean()
-            top_grey_mse /= 3.0
-            bot_grey_mse /= 3.0
+            top_grey_mse = grey_mse(image_array[bary:], grey_array[bary:])
+            bot_grey_mse = grey_mse(image_array[-bary][None],
+                                    grey_array[-bary][None])
 
         data = {}
         if 15 < top_spikes < 25:
@@ -273,6 +1068,7 @@ class ImageFile(GenericFile):
 
         return data
 
+    @requires('ndarray_grey')
     def analyze_stereo_card(self):
         """
         Find whether the given image is a stereo card or not.
@@ -281,24 +1077,32 @@ class ImageFile(GenericFile):
         if image_array is None:
             return {}
 
-        def _full_histogram(img):
-            return numpy.histogram(img, bins=range(256))[0]
+        def _full_histogram(**kwargs):
+            # Use the bins of numpy.histogram(img, bins=range(256)) which
+            # counts 254 and 255 in the last bin.
+            hist = self.fetch('histogram', **kwargs)
+            return numpy.append(hist[:254], hist[254:].sum())
 
-        h, w = image_array.shape[:2]
+        h, w = image_array.shape[-2:]
         # Remove corners as that's probably the edges and gradient etc.
-        roi = image_array[int(0.1 * h):int(0.9 * h),
-                          int(0.1 * w):int(0.9 * w), ...]
-        _, width = roi.shape[:2]
-        left = roi[:, :width // 2]
-        right = roi[:, width // 2 + (width % 2):]
+        top, bottom = int(0.1 * h), int(0.9 * h)
+        roi_left, roi_right = int(0.1 * w), int(0.9 * w)
+        roi = image_array[..., top:bottom, roi_left:roi_right]
+        width = roi.shape[-1]
+        left = roi[..., :width // 2]
+        right = roi[..., width // 2 + (width % 2):]
         mean_square_err = ((left - right) ** 2).mean()
-        histogram_mse = (
-            ((_full_histogram(left) - _full_histogram(right)) ** 2).mean() /
-            left.size)
+        left_hist = _full_histogram(
+            region=(top, bottom, roi_left, roi_left + width // 2))
+        right_hist = _full_histogram(
+            region=(top, bottom, roi_left + width // 2 + (width % 2),
+                    roi_right))
+        histogram_mse = ((left_hist - right_hist) ** 2).mean() / left.size
 
         return {'Misc:StereoCardMSE': mean_square_err,
                 'Misc:StereoCardHistogramMSE': histogram_mse}
 
+    @requires('ndarray_noalpha', 'ndarray_grey', 'ndarray')
     def analyze_color_info(self,
                            grey_shade_threshold=0.05,
                            freq_colors_threshold=0.1,
@@ -336,10 +1140,13 @@ class ImageFile(GenericFile):
              - Color:UsesAlpha - True if the alpha channel is present and being
                 used.
         """
+        if self.is_type('too_large') or self.is_type('animated'):
+            return self._color_info_from_histograms(
+                grey_shade_threshold, freq_colors_threshold,
+                edge_ratio_gaussian_sigma)
+
         image_array = self.fetch('ndarray_noalpha')
-        if image_array.ndim == 4:  # Animated images
-            mean_color = image_array.mean(axis=(0, 1, 2))
-        elif image_array.ndim == 3 and image_array.shape[2] == 3:  # Static
+        if image_array.ndim == 3 and image_array.shape[2] == 3:  # Static
             mean_color = image_array.mean(axis=(0, 1))
         elif image_array.ndim == 2:  # Greyscale images
             avg = image_array.mean()
@@ -353,29 +1160,35 @@ class ImageFile(GenericFile):
             return {}
 
         # Find the mean color and the closest color in the known palette
-        closest_label, closest_color = PantonePaint().find_closest(mean_color)
+        closest_label, closest_color = pantone_palette().find_closest(
+            mean_color)
 
         grey_array = self.fetch('ndarray_grey')
 
-        def _full_histogram(img):
-            return numpy.histogram(img, bins=range(256))[0]
+        def _full_histogram(**kwargs):
+            # Use the bins of numpy.histogram(img, bins=range(256)) which
+            # counts 254 and 255 in the last bin.
+            hist = self.fetch('histogram', **kwargs)
+            return numpy.append(hist[:254], hist[254:].sum())
 
         if image_array.ndim == 3 or image_array.ndim == 2:
             # Find the edge ratio by applying the canny filter and finding
-            # bright spots. Not applicable to animated images.
+            # bright spots.
             scale = max(1.0, numpy.average(image_array.shape[:2]) / 500.0)
+            img_shape = [int(x / scale) for x in grey_array.shape[:2]]
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                img_shape = map(lambda x: int(x / scale), grey_array.shape[:2])
-                grey_img = skimage.transform.resize(grey_array,
-                                                    output_shape=img_shape,
-                                                    preserve_range=True)
+                # Resize the smallest pyramid level larger than the shape.
+                level = [lvl for lvl in self.fetch('pyramid')
+                         if max(lvl.shape) >= max(img_shape)][-1]
+                grey_img = skimage.transform.resize(
+                    level, output_shape=img_shape, preserve_range=True)
             edge_img = skimage.feature.canny(grey_img,
                                              sigma=edge_ratio_gaussian_sigma)
             edge_ratio = (edge_img > 0).mean()
 
             # Find the number of grey shades in the imag eusing the histogram.
-            grey_hist = _full_histogram(grey_array)
+            grey_hist = _full_histogram(channel='grey')
             grey_hist_max = grey_shade_threshold * grey_hist.max()
             num_grey_shades = (grey_hist > grey_hist_max).sum()
         else:
@@ -383,20 +1196,11 @@ class ImageFile(GenericFile):
             num_grey_shades = None
 
         # Find the peaks_percent using a histogram
-        if image_array.ndim == 4:  # Animated images
-            hist = {
-                "red": _full_histogram(image_array[:, :, :, 0]),
-                "green": _full_histogram(image_array[:, :, :, 1]),
-                "blue": _full_histogram(image_array[:, :, :, 2])
-            }
-        elif image_array.ndim == 3 and image_array.shape[2] == 3:  # Static
-            hist = {
-                "red": _full_histogram(image_array[:, :, 0]),
-                "green": _full_histogram(image_array[:, :, 1]),
-                "blue": _full_histogram(image_array[:, :, 2])
-            }
-        elif image_array.ndim == 2:  # Greyscale images
-            hist = {"grey": _full_histogram(image_array)}
+        if image_array.ndim == 2:  # Greyscale images
+            hist = {"grey": _full_histogram(channel='grey')}
+        else:  # RGB images
+            hist = dict((color, _full_histogram(channel=color))
+                        for color in ("red", "green", "blue"))
 
         # Calculate peaks by finding the number of colors which occur
         # more than a given threshold. The threshold is chosen to be 1% of
@@ -431,6 +1235,60 @@ class ImageFile(GenericFile):
             'Color:MeanSquareErrorFromGrey': blackwhite_mean_square_err,
             'Color:UsesAlpha': uses_alpha})
 
+    def _color_info_from_histograms(self, grey_shade_threshold,
+                                    freq_colors_threshold,
+                                    edge_ratio_gaussian_sigma):
+        """
+        Find the color info of animated images and images which are too
+        large to decode at full resolution. The histograms are counted a
+        frame or a tile at a time, and the edges of large images are found
+        in a smaller version of the image. The mean square error from grey
+        and the use of alpha are not found, and neither are the edges and
+        grey shades of animated images.
+
+        :return: dict like ``analyze_color_info()``.
+        """
+        def _full_histogram(hist):
+            return numpy.append(hist[:254], hist[254:].sum())
+
+        rgb_hist = self.fetch('histogram', channel='rgb')
+        mean_color = (rgb_hist.dot(numpy.arange(256)) /
+                      numpy.maximum(rgb_hist.sum(axis=1), 1))
+        closest_label, closest_color = pantone_palette().find_closest(
+            mean_color)
+
+        edge_ratio, num_grey_shades = None, None
+        if not self.is_type('animated'):
+            width, height = self.fetch('size')
+            scale = max(1.0, numpy.average((height, width)) / 500.0)
+            img_shape = [int(x / scale) for x in (height, width)]
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                grey_img = skimage.transform.resize(
+                    self.fetch('ndarray_grey', max_side=max(img_shape)),
+                    output_shape=img_shape, preserve_range=True)
+            edge_img = skimage.feature.canny(grey_img,
+                                             sigma=edge_ratio_gaussian_sigma)
+            edge_ratio = (edge_img > 0).mean()
+
+            grey_hist = _full_histogram(
+                self.fetch('histogram', channel='grey'))
+            grey_hist_max = grey_shade_threshold * grey_hist.max()
+            num_grey_shades = (grey_hist > grey_hist_max).sum()
+
+        hist_concat = numpy.concatenate([_full_histogram(hist)
+                                         for hist in rgb_hist])
+        peaks_hist_max = freq_colors_threshold * hist_concat.max()
+        peaks_percent = (hist_concat > peaks_hist_max).mean()
+
+        return DictNoNone({
+            'Color:ClosestLabeledColorRGB': closest_color,
+            'Color:ClosestLabeledColor': closest_label,
+            'Color:AverageRGB': tuple(round(i, 3) for i in mean_color),
+            'Color:NumberOfGreyShades': num_grey_shades,
+            'Color:PercentFrequentColors': peaks_percent,
+            'Color:EdgeRatio': edge_ratio})
+
     @staticmethod
     def _haarcascade(image, filename, directory=None, **kwargs):
         """
@@ -446,30 +1304,13 @@ class ImageFile(GenericFile):
         """
         warn_msg = ('HAAR Cascade analysis requires the optional dependencies '
                     'OpenCV and opencv-data to be installed.')
-        try:
-            import cv2
-        except ImportError:
-            logging.warn(warn_msg)
-            return []
-
-        haar_paths = [
-            os.path.abspath(os.path.join(
-                os.path.realpath(cv2.__file__),
-                *([os.pardir] * 4 + ['share', 'OpenCV', 'haarcascades']))),
-            os.path.abspath(os.path.join(
-                os.path.realpath(cv2.__file__),
-                *([os.pardir] * 4 + ['share', 'opencv', 'haarcascades'])))]
-        for _dir in [directory] + haar_paths:
-            if _dir is not None and os.path.exists(_dir):
-                directory = _dir
-                break
-        if directory is None:
-            logging.warn(warn_msg)
-            return []
-        cascade = cv2.CascadeClassifier(os.path.join(directory, filename),)
-        features = cascade.detectMultiScale(image, **kwargs)
-        return features
+        with haarcascade_classifier(filename, directory) as cascade:
+            if cascade is None:
+                logging.warn(warn_msg)
+                return []
+            return cascade.detectMultiScale(image, **kwargs)
 
+    @requires('size')
     def analyze_face_haarcascades(self):
         """
         Use opencv's haar cascade filters to identify faces, right eye, left
@@ -477,25 +1318,48 @@ class ImageFile(GenericFile):
         """
         try:
             import cv2  # noqa (unused import)
-            from cv2 import cv
+            from cv2 import cv  # noqa (unused import)
         except ImportError:
             logging.warn('HAAR Cascade analysis requires the optional '
                          'dependency OpenCV 2.x to be installed.')
             return {}
 
-        image_array = self.fetch('ndarray_grey')
-        if image_array.ndim == 3:
-            logging.warn('Faces cannot be detected in animated images '
-                         'using haarcascades yet.')
+        # The "scale" given here is relevant for the detection rate.
+        width, height = self.fetch('size')
+        scale = max(1.0, numpy.average((height, width)) / 500.0)
+        img_shape = [int(x / scale) for x in (height, width)]
+
+        if self.is_type('animated'):
+            # Look for faces in the frames which change the image a lot.
+            data = []
+            for index, frame in self.iter_frames('keyframes'):
+                grey = self._grey(self._noalpha(frame))
+                for face in self._haarcascade_faces(grey, img_shape, scale):
+                    face['frame'] = index
+                    data.append(face)
+        else:
+            data = self._haarcascade_faces(
+                self.fetch('ndarray_grey', max_side=max(img_shape)),
+                img_shape, scale)
+
+        if len(data) == 0:
             return {}
+        return {'OpenCV:Faces': data}
 
-        # The "scale" given here is relevant for the detection rate.
-        scale = max(1.0, numpy.average(image_array.shape) / 500.0)
+    def _haarcascade_faces(self, image_array, img_shape, scale):
+        """
+        Find the faces and their features with haarcascades.
+
+        :param image_array: The greyscale image to look for faces in.
+        :param img_shape:   The shape to resize the image to.
+        :param scale:       The ratio of the image size to ``img_shape``.
+        :return:            A list with a dict for every face.
+        """
+        from cv2 import cv
 
         # Equalize the histogram and make the size smaller
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            img_shape = map(lambda x: int(x / scale), image_array.shape)
             img = skimage.img_as_ubyte(
                 skimage.exposure.equalize_hist(
                     skimage.transform.resize(image_array,
@@ -503,18 +1367,6 @@ class ImageFile(GenericFile):
                                              preserve_range=True)))
 
         def haar(im, key, single=False, **kwargs):
-            cascades = {
-                'frontal_face': 'haarcascade_frontalface_alt.xml',
-                'profile_face': 'haarcascade_profileface.xml',
-                'nested': 'haarcascade_eye_tree_eyeglasses.xml',
-                'mouth': 'haarcascade_mcs_mouth.xml',
-                'nose': 'haarcascade_mcs_nose.xml',
-                'right_eye': 'haarcascade_righteye_2splits.xml',
-                'left_eye': 'haarcascade_lefteye_2splits.xml',
-                'left_ear': 'haarcascade_mcs_leftear.xml',
-                'right_ear': 'haarcascade_mcs_rightear.xml',
-                'upper_body': 'haarcascade_upperbody.xml',
-                'lower_body': 'haarcascade_lowerbody.xml'}
             # Set some default kwargs
             kwargs['scaleFactor'] = kwargs.get('scaleFactor', 1.1)
             kwargs['minNeighbors'] = kwargs.get('minNeighbors', 2)
@@ -524,7 +1376,7 @@ class ImageFile(GenericFile):
                 flags = (flags | cv.CV_HAAR_FIND_BIGGEST_OBJECT |
                          cv.CV_HAAR_DO_ROUGH_SEARCH)
             kwargs['flags'] = kwargs.get('flags', flags)
-            return list(self._haarcascade(im, cascades[key], **kwargs))
+            return list(self._haarcascade(im, HAARCASCADES[key], **kwargs))
 
         def drop_overlapping_regions(regions):
             drop = set()
@@ -547,9 +1399,6 @@ class ImageFile(GenericFile):
         profile = haar(img, 'profile_face')
         faces = list(drop_overlapping_regions(frontal + profile))
 
-        if len(faces) == 0:
-            return {}
-
         data = []
         for face in faces:
             scaled_face = list(map(lambda x: int(x * scale), face))
@@ -608,8 +1457,9 @@ class ImageFile(GenericFile):
                 fdata['mouth'] = feat_mid(mouth_feats[0], 0, mouth_offy)
 
             data.append(fdata)
-        return {'OpenCV:Faces': data}
+        return data
 
+    @requires('ndarray_noalpha')
     def analyze_facial_landmarks(self,
                                  with_landmarks=True,
                                  detector_upsample_num_times=0):
@@ -638,38 +1488,49 @@ class ImageFile(GenericFile):
                 - right eye - Location of the center of the right eye.
                 - mouth - Location of the center of the mouth.
         """
-        image_array = self.fetch('ndarray_noalpha')
-        if (image_array.ndim == 4 or
-                (image_array.ndim == 3 and image_array.shape[2] != 3)):
-            logging.warn('Facial landmarks of animated images cannot be '
-                         'detected yet.')
+        if self.is_type('animated'):
+            # Look for faces in the frames which change the image a lot.
+            data = []
+            for index, frame in self.iter_frames('keyframes'):
+                for face in self._dlib_faces(self._noalpha(frame),
+                                             with_landmarks,
+                                             detector_upsample_num_times):
+                    face['frame'] = index
+                    data.append(face)
+        else:
+            image_array = self.fetch('ndarray_noalpha')
+            if image_array.ndim == 3 and image_array.shape[2] != 3:
+                logging.warn('Facial landmarks of images with {0} channels '
+                             'cannot be detected.'
+                             .format(image_array.shape[2]))
+                return {}
+            data = self._dlib_faces(image_array, with_landmarks,
+                                    detector_upsample_num_times)
+
+        if len(data) == 0:
             return {}
+        return {'dlib:Faces': data}
 
-        predictor_dat = 'shape_predictor_68_face_landmarks.dat'
-        predictor_arch = predictor_dat + '.bz2'
-        dat_path = app_dir('user_data_dir', predictor_dat)
-        arch_path = app_dir('user_data_dir', predictor_arch)
-
-        if with_landmarks and not os.path.exists(dat_path):
-            logging.warn('Downloading the landmark data file for facial '
-                         'landmark detection. Hence, the '
-                         'first run may take longer than normal.')
-            url = 'http://sourceforge.net/projects/dclib/files/dlib/v18.10/{0}'
-            download(url.format(predictor_arch), arch_path)
-            bz2_decompress(arch_path, dat_path)
-
-        detector = dlib.get_frontal_face_detector()
-
-        # TODO: Get orientation data from ``orient_id`` and use it.
-        faces, scores, orient_id = detector.run(
-            image_array,
-            upsample_num_times=detector_upsample_num_times)
-
-        if len(faces) == 0:
-            return {}
+    @staticmethod
+    def _dlib_faces(image_array, with_landmarks=True,
+                    detector_upsample_num_times=0):
+        """
+        Find the faces and their landmarks with ``dlib``.
 
+        :param image_array: The greyscale or RGB image to look for faces in.
+        :param with_landmarks:
+            Whether to detect the facial landmarks or not.
+        :param detector_upsample_num_times:
+            The number of times to upscale the image by when detecting faces.
+        :return: A list with a dict for every face.
+        """
         if with_landmarks:
-            predictor = dlib.shape_predictor(to_cstr(dat_path))
+            predictor = dlib_shape_predictor()
+        # TODO: Get orientation data from ``orient_id`` and use it.
+        with dlib_face_detector() as detector:
+            faces, scores, orient_id = detector.run(
+                image_array,
+                upsample_num_times=detector_upsample_num_times)
 
         data = []
         for face, score in zip(faces, scores):
@@ -700,41 +1561,19 @@ class ImageFile(GenericFile):
                 # Point 49 and 55 are the two outer corners of the mouth
                 fdata['mouth'] = tup2(shape.part(49), shape.part(55))
             data.append(fdata)
+        return data
 
-        return {'dlib:Faces': data}
-
-    def analyze_barcode_zxing(self):
+    @staticmethod
+    def _zxing_command_line(filename):
         """
-        Use ``zxing`` to find barcodes, qr codes, data matrices, etc.
-        from the image.
+        Find the barcodes in an image with zxing's ``CommandLineRunner``,
+        which starts a new JVM for every image.
 
-        :return: dict with the keys:
-
-             - zxing:Barcodes - An array containing information about barcodes.
-                Each barcode is encoded to a dictionary with the keys:
-                - format - The format of the barcode. Example: QR_CODE,
-                    CODABAR, DATA_MATRIX, etc.
-                - data - The text data that is encdoded in the barcode.
-                - bounding box - A dictionary with left, width, top, height.
-                - points - The detection points of the barcode (4 points for
-                    QR codes and Data matrices and 2 points for barcodes).
+        :param filename: The ``file://`` URI of the image.
+        :return:         The list of barcodes like
+                         ``ZXingServer.decode_file()``, or None if the
+                         image could not be read.
         """
-        image_array = self.fetch('ndarray')
-        if all(map(lambda x: x < 4, image_array.shape)):
-            # If the file is less than 4 pixels, it won't contain a barcode.
-            # Small files cause zxing to crash so, we just return empty.
-            return {}
-        if (image_array.ndim == 4 or
-                (image_array.ndim == 3 and
-                 image_array.shape[2] not in (3, 4))):
-            logging.warn('Barcode analysis with zxing of animated images '
-                         'or multi page images is not supported yet.')
-            return {}
-
-        filename = self.fetch('filename_zxing')
-        if filename is None:
-            return {}
-
         try:
             output = subprocess.check_output([
                 'java', '-cp', os.path.join(DATA_PATH, '*'),
@@ -749,12 +1588,12 @@ class ImageFile(GenericFile):
                     "zxing's barcode analysis.")
             else:
                 logging.error(err.output)
-            return {}
+            return None
 
         if 'No barcode found' in output:
-            return {}
+            return []
 
-        barcodes = []
+        results = []
         for section in output.split("\nfile:"):
             lines = section.strip().splitlines()
 
@@ -771,28 +1610,129 @@ class ImageFile(GenericFile):
                 point = float(pt.group(1)), float(pt.group(2))
                 points.append(point)
 
+            results.append({'format': _format, 'points': points,
+                            'raw_data': raw_result, 'data': parsed_result})
+        return results
+
+    def _zxing_decode(self, image_array, fallback=False):
+        """
+        Find the barcodes in an image with the ZXing server.
+
+        :param image_array: The greyscale or RGB image to look for barcodes.
+        :param fallback:    Use zxing's command line on the file if the
+                            server cannot be started.
+        :return:            The list of barcodes like
+                            ``ZXingServer.decode_pixels()``, or None if the
+                            image could not be read.
+        """
+        if all(map(lambda x: x < 4, image_array.shape[:2])):
+            # If the file is less than 4 pixels, it won't contain a barcode.
+            # Small files cause zxing to crash so, we just return empty.
+            return []
+
+        server = zxing_server()
+        try:
+            # Give the pixels which are already decoded to zxing, so that
+            # no file has to be written for formats java cannot read.
+            return server.decode_pixels(skimage.img_as_ubyte(image_array))
+        except ValueError as err:
+            logging.error(err)
+            return None
+        except (IOError, OSError) as err:
+            if not server.failed or not fallback:  # Timed out or crashed
+                logging.error(err)
+                return None
+            # The server needs Java 11 or newer, use zxing's command line.
+            filename = self.fetch('filename_zxing')
+            if filename is None:
+                return None
+            return self._zxing_command_line(filename)
+
+    @requires('ndarray_noalpha')
+    def analyze_barcode_zxing(self):
+        """
+        Use ``zxing`` to find barcodes, qr codes, data matrices, etc.
+        from the image.
+
+        :return: dict with the keys:
+
+             - zxing:Barcodes - An array containing information about barcodes.
+                Each barcode is encoded to a dictionary with the keys:
+                - format - The format of the barcode. Example: QR_CODE,
+                    CODABAR, DATA_MATRIX, etc.
+                - data - The text data that is encdoded in the barcode.
+                - bounding box - A dictionary with left, width, top, height.
+                - points - The detection points of the barcode (4 points for
+                    QR codes and Data matrices and 2 points for barcodes).
+        """
+        if self.is_type('animated'):
+            # Look for barcodes in the frames which change the image a lot,
+            # a barcode found in an earlier frame is not given again.
+            results, found = [], set()
+            for index, frame in self.iter_frames('keyframes'):
+                for result in self._zxing_decode(self._noalpha(frame)) or []:
+                    if (result['format'], result['raw_data']) not in found:
+                        found.add((result['format'], result['raw_data']))
+                        result['frame'] = index
+                        results.append(result)
+        else:
+            image_array = self.fetch('ndarray')
+            if (image_array.ndim == 3 and
+                    image_array.shape[2] not in (3, 4)):
+                logging.warn('Barcode analysis with zxing of images with {0} '
+                             'channels is not supported.'
+                             .format(image_array.shape[2]))
+                return {}
+            results = self._zxing_decode(self.fetch('ndarray_noalpha'),
+                                         fallback=True)
+
+        if not results:
+            return {}
+
+        barcodes = []
+        for result in results:
+            points = result['points']
             bbox = {}
-            if num_pts == 2:  # left, right
+            if len(points) == 2:  # left, right
                 l, r = [(int(i), int(j)) for (i, j) in points]
                 bbox = {"left": l[0], "top": l[1],
                         "width": r[0] - l[0] + 1, "height": r[1] - l[1] + 1}
-            elif num_pts == 4:  # bottomLeft, topLeft, topRight, bottomRight
+            elif len(points) == 4:
+                # bottomLeft, topLeft, topRight, bottomRight
                 lb, lt, rt, rb = [(int(i), int(j)) for (i, j) in points]
                 bbox = {"left": min(lb[0], lt[0]),
                         "top": min(lt[1], rt[1]),
                         "width": max(rb[0] - lb[0], rt[0] - lt[0]),
                         "height": max(rb[1] - rt[1], lb[1] - lt[1])}
-
-            barcodes.append({'format': _format, 'points': points,
-                             'raw_data': raw_result, 'data': parsed_result,
-                             'bounding box': bbox})
+            result['bounding box'] = bbox
+            barcodes.append(result)
 
         return {'zxing:Barcodes': barcodes}
 
-    def analyze_barcode_zbar(self):
+    @requires('ndarray_grey')
+    def analyze_barcode_zbar(self, regions=None, first_pass_max_side=None,
+                             full_scan_fallback=True):
         """
         Use ``zbar`` to find barcodes and qr codes from the image.
 
+        The image is scanned at full resolution by default. With
+        ``first_pass_max_side`` (for example 2048), images with more pixels
+        on the longer side are first scanned at a lower resolution, and only
+        the regions around the barcodes found are scanned again at full
+        resolution. This is faster for large scans, but small barcodes are
+        missed when a larger one is found in the first pass.
+
+        :param regions:
+            A list of (top, bottom, left, right) regions in pixels to scan
+            instead of the whole image.
+        :param first_pass_max_side:
+            The longer side in pixels of the image scanned first for large
+            images. None (the default) to always scan the image at full
+            resolution.
+        :param full_scan_fallback:
+            Whether to scan the image at full resolution when no barcode
+            is found in the first pass. Small barcodes may not be readable
+            at a lower resolution.
         :return: dict with the keys:
 
              - zbar:Barcodes - An array containing information about barcodes.
@@ -804,26 +1744,119 @@ class ImageFile(GenericFile):
                 - confidence - The quality of the barcode. The higher it is
                     the more accurate the detection is.
         """
-        image_array = self.fetch('ndarray_grey')
-        if image_array.ndim == 3:
-            logging.warn('Barcodes cannot be detected in animated images '
-                         'using zbar.')
+        if self.is_type('animated'):
+            # Look for barcodes in the frames which change the image a lot,
+            # a barcode found in an earlier frame is not given again.
+            barcodes, found = [], set()
+            for index, frame in self.iter_frames('keyframes'):
+                grey = self._grey(self._noalpha(frame))
+                for barcode in self._zbar_scan(grey):
+                    if (barcode['format'], barcode['data']) not in found:
+                        found.add((barcode['format'], barcode['data']))
+                        barcode['frame'] = index
+                        barcodes.append(barcode)
+        else:
+            barcodes = self._zbar_scan_image(regions, first_pass_max_side,
+                                             full_scan_fallback)
+
+        if len(barcodes) == 0:
             return {}
+        return {'zbar:Barcodes': barcodes}
+
+    def _zbar_scan_image(self, regions, first_pass_max_side,
+                         full_scan_fallback):
+        """
+        Find the barcodes in the given regions of the image, or in the whole
+        image with a first pass at a lower resolution for large images.
+        """
+        width, height = self.fetch('size')
+        first_pass = []
+        if (regions is None and first_pass_max_side and
+                max(width, height) > first_pass_max_side):
+            small = self.fetch('ndarray_grey', max_side=first_pass_max_side)
+            first_pass = self._zbar_scan(small, scale=width / small.shape[1])
+            if self.is_type('too_large'):
+                # The image cannot be decoded at full resolution.
+                return first_pass
+            if not first_pass and not full_scan_fallback:
+                return []
+            # Scan the barcodes again with a margin of half their size.
+            regions = []
+            for barcode in first_pass:
+                bbox = barcode['bounding box']
+                margin_x = bbox['width'] // 2 + 16
+                margin_y = bbox['height'] // 2 + 16
+                regions.append((
+                    max(bbox['top'] - margin_y, 0),
+                    bbox['top'] + bbox['height'] + margin_y,
+                    max(bbox['left'] - margin_x, 0),
+                    bbox['left'] + bbox['width'] + margin_x))
+            regions = regions or None
+
+        grey = self.fetch('ndarray_grey')
+        if regions is None:
+            return self._zbar_scan(grey)
+
+        barcodes, found = [], set()
+        for top, bottom, left, right in regions:
+            top, left = top or 0, left or 0
+            for barcode in self._zbar_scan(grey[top:bottom, left:right],
+                                           top=top, left=left):
+                bbox = barcode['bounding box']
+                key = (barcode['format'], barcode['data'],
+                       bbox['left'], bbox['top'])
+                if key not in found:  # Regions may overlap
+                    found.add(key)
+                    barcodes.append(barcode)
+        # Keep the barcodes of the first pass which were not read again.
+        rescanned = set((barcode['format'], barcode['data'])
+                        for barcode in barcodes)
+        barcodes.extend(barcode for barcode in first_pass
+                        if (barcode['format'], barcode['data'])
+                        not in rescanned)
+        return barcodes
+
+    @staticmethod
+    def _zbar_scan(image_array, top=0, left=0, scale=1):
+        """
+        Find the barcodes in a greyscale image with ``zbar``.
+
+        :param image_array: The 8 bit greyscale image.
+        :param top:         The row of the image in the full image.
+        :param left:        The column of the image in the full image.
+        :param scale:       The size of a pixel of the image in pixels of
+                            the full image.
+        :return:            A list with a dict for every barcode, with the
+                            positions in pixels of the full image.
+        """
+        # A view of the array when it already is contiguous 8 bit pixels.
+        image_array = numpy.ascontiguousarray(image_array, dtype=numpy.uint8)
         height, width = image_array.shape
-        zbar_img = zbar.Image(width, height, 'Y800', image_array.tobytes())
-        scanner = zbar.ImageScanner()
-        scanner.parse_config('enable')
-        if scanner.scan(zbar_img) == 0:
-            return {}
+        if height == 0 or width == 0:
+            return []
+        try:
+            # zbar keeps a reference to the buffer of the array itself.
+            zbar_img = zbar.Image(width, height, 'Y800', image_array)
+        except TypeError:
+            # The bindings which only accept strings need a copy.
+            zbar_img = zbar.Image(width, height, 'Y800',
+                                  image_array.tobytes())
+        # The symbols found are read before another thread uses the scanner.
+        with zbar_scanner() as scanner:
+            if scanner.scan(zbar_img) == 0:
+                return []
+            symbols = [(barcode.location, barcode.data, barcode.quality,
+                        str(barcode.type)) for barcode in zbar_img]
 
         barcodes = []
-        for barcode in zbar_img:
-            p = numpy.array(barcode.location)
+        for location, data, quality, _type in symbols:
+            p = numpy.rint(numpy.array(location) * scale +
+                           (left, top)).astype(int)
             bbox = {"left": min(p[:, 0]), "top": min(p[:, 1]),
                     "width": max(p[:, 0]) - min(p[:, 0]),
                     "height": max(p[:, 1]) - min(p[:, 1])}
-            barcodes.append({'data': barcode.data,
+            barcodes.append({'data': data,
                              'bounding box': bbox,
-                             'confidence': barcode.quality,
-                             'format': str(barcode.type)})
-        return {'zbar:Barcodes': barcodes}
+                             'confidence': quality,
+                             'format': _type})
+        return barcodes
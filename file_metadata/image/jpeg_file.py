@@ -16,11 +16,11 @@ from file_metadata.utilities import memoized
 class JPEGFile(ImageFile):
 
     @classmethod
-    def create(cls, *args, **kwargs):
-        return cls(*args, **kwargs)
+    def create_from(cls, cls_file):
+        return cls_file.cast(cls)
 
     @memoized
-    def fetch(self, key=''):
+    def fetch(self, key='', **kwargs):
         if key == 'filename_zxing':
             exif = self.exiftool()
             if (exif.get('APP14:ColorTransform') == 'Unknown (RGB or CMYK)' or
@@ -36,4 +36,4 @@ class JPEGFile(ImageFile):
                 self.temp_filenames.add(name)
                 return pathlib2.Path(name).as_uri()
 
-        return super(JPEGFile, self).fetch(key)
+        return super(JPEGFile, self).fetch(key, **kwargs)
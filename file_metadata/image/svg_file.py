@@ -3,38 +3,15 @@
 from __future__ import (division, absolute_import, unicode_literals,
                         print_function)
 
-import os
-import tempfile
-
-import wand.image
-
 from file_metadata.image.image_file import ImageFile
-from file_metadata.utilities import memoized
+from file_metadata.mixins import WandRasterMixin
 
 
-class SVGFile(ImageFile):
+class SVGFile(WandRasterMixin, ImageFile):
 
     @classmethod
-    def create(cls, *args, **kwargs):
-        return cls(*args, **kwargs)
-
-    @memoized
-    def fetch(self, key=''):
-        if key == 'filename_raster':
-            # SVG files are not raster graphics, hence we convert it to one
-            # and use that instead.
-            with wand.image.Image(filename=self.fetch('filename')) \
-                    as svg_image:
-                svg_image.format = 'png'
-                fd, name = tempfile.mkstemp(
-                    suffix=os.path.split(self.fetch('filename'))[-1] + '.png',
-                    prefix='tmp_file_metadata')
-                os.close(fd)
-                svg_image.save(filename=name)
-                self.temp_filenames.add(name)
-                return name
-
-        return super(SVGFile, self).fetch(key)
+    def create_from(cls, cls_file):
+        return cls_file.cast(cls)
 
     def analyze_file_format(self):
         """
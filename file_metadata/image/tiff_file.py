@@ -16,14 +16,13 @@ from file_metadata.utilities import memoized
 class TIFFFile(ImageFile):
 
     @classmethod
-    def create(cls, *args, **kwargs):
-        return cls(*args, **kwargs)
+    def create_from(cls, cls_file):
+        return cls_file.cast(cls)
 
     @memoized
-    def fetch(self, key=''):
+    def fetch(self, key='', **kwargs):
         if key == 'filename_zxing':
-            pill = self.fetch('pillow')
-            if hasattr(pill, 'n_frames') and pill.n_frames != 1:
+            if self.is_type('animated'):
                 return None
             # ZXing cannot handle most TIFF images, convert to PNG.
             with wand.image.Image(filename=self.fetch('filename')) \
@@ -37,4 +36,4 @@ class TIFFFile(ImageFile):
                 self.temp_filenames.add(name)
                 return pathlib2.Path(name).as_uri()
 
-        return super(TIFFFile, self).fetch(key)
+        return super(TIFFFile, self).fetch(key, **kwargs)
@@ -9,14 +9,91 @@ from __future__ import (division, absolute_import, unicode_literals,
                         print_function)
 
 import json
+import logging
 import os
+import re
 import subprocess
+import tempfile
+import threading
 from xml.etree import cElementTree
 
-from file_metadata.utilities import DictNoNone, memoized
+from file_metadata.utilities import DictNoNone, app_dir, memoized, requires
 from file_metadata._compat import ffprobe_parser, which
 
 
+# The entries of ``ffprobe`` used by ``FFProbeMixin.analyze_ffprobe()``.
+FFPROBE_ENTRIES = ('format=format_name,duration,nb_streams:'
+                   'stream=codec_type,codec_name,avg_frame_rate,width,height,'
+                   'channels,sample_fmt,sample_rate,duration')
+
+_ffprobe_tool = {}
+_ffprobe_lock = threading.Lock()
+
+
+def ffprobe_executable():
+    """
+    Find the ``ffprobe`` (or ``avprobe``) executable and the features it
+    supports. This is done once per process, and the features are also
+    saved in the user's cache directory until the executable changes.
+
+    :return: A tuple with the path of the executable and a dict with the
+             keys ``json`` and ``show_entries`` saying whether the
+             ``-of json`` and ``-show_entries`` arguments are supported.
+    """
+    key = os.environ.get('PATH')
+    with _ffprobe_lock:
+        if _ffprobe_tool.get('key') != key:
+            executable = which('ffprobe') or which('avprobe')
+            _ffprobe_tool['tool'] = (executable, executable and
+                                     _ffprobe_capabilities(executable))
+            _ffprobe_tool['key'] = key
+        executable, capabilities = _ffprobe_tool['tool']
+
+    if executable is None:
+        raise OSError('Neither avprobe nor ffprobe were found.')
+    return executable, capabilities
+
+
+def _ffprobe_capabilities(executable):
+    stat = os.stat(os.path.realpath(executable))
+    signature = [stat.st_size, stat.st_mtime]
+    cache_path = app_dir('user_cache_dir', 'ffprobe_capabilities.json')
+    try:
+        with open(cache_path) as cache_file:
+            cached = json.load(cache_file)
+        entry = cached.get(executable, {})
+        if entry.get('signature') == signature:
+            return dict(entry['capabilities'])
+    except (IOError, OSError, ValueError, AttributeError, KeyError,
+            TypeError):
+        # A missing or unreadable cache file is a cache miss.
+        cached = {}
+    if not isinstance(cached, dict):
+        cached = {}
+
+    with open(os.devnull, 'wb') as devnull:
+        proc = subprocess.Popen([executable, '-h'], stdout=subprocess.PIPE,
+                                stderr=devnull)
+        output = proc.communicate()[0].decode('utf-8', 'replace')
+    capabilities = {
+        'json': bool(re.search(r'^-(of|print_format)\b', output, re.M)),
+        'show_entries': bool(re.search(r'^-show_entries\b', output, re.M))}
+
+    cached[executable] = {'signature': signature,
+                          'capabilities': capabilities}
+    try:
+        # Write to a tempfile first so that other processes never read a
+        # partially written cache file.
+        fd, name = tempfile.mkstemp(dir=os.path.dirname(cache_path),
+                                    prefix='tmp_file_metadata')
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(cached, cache_file)
+        os.rename(name, cache_path)
+    except (IOError, OSError):
+        pass
+    return capabilities
+
+
 class FFProbeMixin(object):
 
     @memoized
@@ -26,27 +103,28 @@ class FFProbeMixin(object):
         ffmpeg utility ffprobe (or avprobe from libav-tools, a fork of
         ffmpeg).
         """
-        executable = which('ffprobe') or which('avprobe')
-        if executable is None:
-            raise OSError('Neither avprobe nor ffprobe were found.')
+        executable, capabilities = ffprobe_executable()
 
-        # Check whether json is supported
-        json_support = False if subprocess.call([
-            executable, '-v', '0', os.devnull, '-of', 'json']) == 1 else True
+        args = [executable, '-v', '0']
+        if capabilities['show_entries']:
+            args += ['-show_entries', FFPROBE_ENTRIES]
+        else:
+            args += ['-show_format', '-show_streams']
+        if capabilities['json']:
+            args += ['-of', 'json']
 
         try:
-            proc = subprocess.check_output(
-                [executable, '-v', '0', '-show_format', '-show_streams',
-                 self.fetch('filename')] +
-                (['-of', 'json'] if json_support else []))
+            proc = subprocess.check_output(args + [self.fetch('filename')])
         except subprocess.CalledProcessError:
             return {}
         else:
             output = proc.decode('utf-8')
 
-        data = json.loads(output) if json_support else ffprobe_parser(output)
-        return data
+        if capabilities['json']:
+            return json.loads(output)
+        return ffprobe_parser(output)
 
+    @requires('ffprobe')
     def analyze_ffprobe(self):
         """
         Use ``ffprobe`` and return streams and format from it.
@@ -95,6 +173,107 @@ class FFProbeMixin(object):
         return data
 
 
+def wand_ndarray(wand_image, channels='RGBA'):
+    """
+    Copy the pixels of a ``wand`` image into a numpy array with 8 bits per
+    channel. The array is read-only as it uses the exported buffer.
+
+    :param wand_image: The ``wand.image.Image`` to read the pixels of.
+    :param channels:   The channels to export, in ImageMagick's notation.
+    :return:           An array with the shape (height, width, channels).
+    """
+    import numpy
+
+    wand_image.depth = 8
+    pixels = numpy.frombuffer(wand_image.make_blob(channels),
+                              dtype=numpy.uint8)
+    return pixels.reshape(wand_image.height, wand_image.width, len(channels))
+
+
+class WandRasterMixin(object):
+    """
+    Read images which are not raster graphics (like SVG or XCF) with
+    ``wand``. The pixels are copied from ImageMagick into a numpy array
+    directly, and a PNG file is only written when a path is needed.
+    """
+
+    def is_type(self, key):
+        if key == 'animated':
+            # Only the first frame (or the flattened layers) is read.
+            return False
+        elif key == 'alpha' and self.is_type('too_large'):
+            return self.fetch('ping')['alpha']
+        elif key == 'alpha':
+            # The alpha channel is kept in the array only if it is used.
+            image_array = self.fetch('ndarray')
+            return image_array.ndim == 3 and image_array.shape[2] in (2, 4)
+        return super(WandRasterMixin, self).is_type(key)
+
+    @memoized
+    def fetch(self, key='', **kwargs):
+        if key == 'size':
+            # Pinging the file reads the dimensions without rendering it.
+            return self.fetch('ping')['size']
+        elif key == 'ndarray' and not kwargs:
+            # Imported here as ImageMagick is only needed for images.
+            import numpy
+            import wand.image
+
+            if self.is_type('too_large'):
+                logging.warn('The file "{0}" contains a lot of pixels and '
+                             'can take a lot of memory when rendered. '
+                             'To allow larger images, modify the '
+                             '"max_decompressed_size" config.'
+                             .format(self.fetch('filename')))
+                # Use empty array as the file is not rendered.
+                return numpy.ndarray(0)
+
+            with wand.image.Image(filename=self.fetch('filename')) as image:
+                with wand.image.Image(image=image.sequence[0]) as frame:
+                    pixels = wand_ndarray(frame)
+
+            # Use the channels ImageMagick would write in a PNG file: the
+            # alpha channel only if it is used, and one channel for grey.
+            channels = [0, 1, 2, 3]
+            if (pixels[..., 3] == 255).all():
+                channels.remove(3)
+            if ((pixels[..., 0] == pixels[..., 1]).all() and
+                    (pixels[..., 1] == pixels[..., 2]).all()):
+                channels.remove(1)
+                channels.remove(2)
+            if channels == [0]:
+                return numpy.ascontiguousarray(pixels[..., 0])
+            elif len(channels) < 4:
+                return numpy.ascontiguousarray(pixels[..., channels])
+            return pixels
+        elif key == 'filename_raster':
+            # Other tools need a file in a raster graphic format. Large
+            # images are rendered with the memory limits of ImageMagick.
+            with self._wand_image(self.fetch('filename')) as wand_image:
+                wand_image.format = 'png'
+                fd, name = tempfile.mkstemp(
+                    suffix=os.path.split(self.fetch('filename'))[-1] + '.png',
+                    prefix='tmp_file_metadata')
+                os.close(fd)
+                wand_image.save(filename=name)
+                self.temp_filenames.add(name)
+                return name
+
+        return super(WandRasterMixin, self).fetch(key, **kwargs)
+
+    def _open_raster(self):
+        from PIL import Image
+
+        return Image.fromarray(self.fetch('ndarray'))
+
+    def _wand_raster(self):
+        return self.fetch('filename') + '[0]'
+
+    def _read_overview(self, max_side):
+        # The file is not a JPEG file, so it is resized by ImageMagick.
+        return self._resize_raster(max_side)
+
+
 def is_svg(_file):
     """
     Check is a given file is SVG or not. A file is considered to be SVG if:
@@ -10,9 +10,13 @@ from __future__ import (division, absolute_import, unicode_literals,
 import bz2
 import functools
 import hashlib
+import inspect
 import os
 import tarfile
 import tempfile
+import threading
+import weakref
+from collections import OrderedDict
 from shutil import copyfileobj
 
 import appdirs
@@ -103,7 +107,7 @@ def bz2_decompress(filepath, newfilepath, block_size=64 * 1024):
     """
     with open(newfilepath, 'wb') as new_file:
         _file = bz2.BZ2File(filepath, 'rb')
-        for data in iter(lambda: _file.read(block_size), ''):
+        for data in iter(lambda: _file.read(block_size), b''):
             new_file.write(data)
         _file.close()
 
@@ -208,6 +212,37 @@ def app_dir(dirtype, *args):
     return os.path.join(makedirs(path, exist_ok=True), *args)
 
 
+class _MemoizedCache(dict):
+    """
+    The values cached by ``memoized`` on a single instance.
+
+    :ivar locks:  A lock for every key which is being computed, with the
+                  number of threads using it. A lock is removed when no
+                  thread uses it anymore.
+    :ivar sizes:  The number of bytes used by the values which have a size,
+                  ordered from the least recently used to the most recently
+                  used.
+    :ivar nbytes: The total number of bytes in ``sizes``.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.locks = {}
+        self.sizes = OrderedDict()
+        self.nbytes = 0
+
+
+def _nbytes(value):
+    """
+    The number of bytes used by a value, which is known only for numpy
+    arrays (or anything else with an ``nbytes``) and lists or tuples of them.
+    """
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(item) for item in value)
+    nbytes = getattr(value, 'nbytes', 0)
+    return nbytes if isinstance(nbytes, six.integer_types) else 0
+
+
 class memoized(object):  # noqa (class names should use CapWords)
     """
     Cache the return value of a method.
@@ -220,9 +255,26 @@ class memoized(object):  # noqa (class names should use CapWords)
     If a cached method is invoked directly on its class the result will not
     be cached. Instead the method will be invoked like a static method.
 
+    The cache is thread safe: if multiple threads invoke the method with the
+    same arguments, it is run only once and the other threads wait for its
+    return value.
+
+    The memory used by cached numpy arrays is limited by ``max_bytes`` for
+    all the instances together, and by the ``max_cache_bytes`` attribute of
+    an instance (if present) for that instance. When a limit is exceeded, the
+    least recently used arrays are removed from the cache and are computed
+    again when needed. Other values are never removed.
+
     Taken from: http://code.activestate.com/recipes/
     577452-a-memoize-decorator-for-instance-methods/
+
+    :cvar max_bytes: The maximum number of bytes of arrays to cache for all
+                     instances together, ``None`` for no limit.
     """
+    max_bytes = 2 * 1024 ** 3
+    _lock = threading.Lock()
+    _sizes = OrderedDict()  # Sized values of all instances in LRU order
+    _nbytes = 0
 
     def __init__(self, func):
         self.func = func
@@ -232,19 +284,266 @@ class memoized(object):  # noqa (class names should use CapWords)
             return self.func
         return functools.partial(self, obj)
 
-    def __call__(self, *args, **kw):
-        obj = args[0]
+    @classmethod
+    def _cache(cls, obj):
         try:
-            cache = obj.__cache
+            return obj.__cache
         except AttributeError:
-            cache = obj.__cache = {}
+            with cls._lock:
+                try:
+                    return obj.__cache
+                except AttributeError:
+                    obj.__cache = _MemoizedCache()
+                    return obj.__cache
+
+    @classmethod
+    @contextmanager
+    def _key_lock(cls, cache, key):
+        with cls._lock:
+            entry = cache.locks.setdefault(key, [threading.RLock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with cls._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del cache.locks[key]
+
+    @classmethod
+    def _store(cls, obj, cache, key, value):
+        nbytes = _nbytes(value)
+        if nbytes == 0:
+            if key in cache.sizes:
+                with cls._lock:
+                    cls._forget(cache, key)
+            cache[key] = value
+            return
+        with cls._lock:
+            cls._forget(cache, key)
+            cache[key] = value
+            cache.sizes[key] = nbytes
+            cache.nbytes += nbytes
+            global_key = (id(cache), key)
+            if global_key in cls._sizes:  # A cache which was freed had the id
+                cls._nbytes -= cls._sizes.pop(global_key)[2]
+            cls._sizes[global_key] = (weakref.ref(cache), key, nbytes)
+            cls._nbytes += nbytes
+
+            # The value which was just computed is never removed.
+            max_bytes = getattr(obj, 'max_cache_bytes', None)
+            for old_key in list(cache.sizes):
+                if max_bytes is None or cache.nbytes <= max_bytes:
+                    break
+                if old_key != key:
+                    cls._forget(cache, old_key)
+            for old_key in list(cls._sizes):
+                if cls.max_bytes is None or cls._nbytes <= cls.max_bytes:
+                    break
+                ref, old_cache_key, old_nbytes = cls._sizes[old_key]
+                old_cache = ref()
+                if old_cache is None:  # The instance does not exist anymore
+                    del cls._sizes[old_key]
+                    cls._nbytes -= old_nbytes
+                elif old_key != global_key:
+                    cls._forget(old_cache, old_cache_key)
+
+    @classmethod
+    def _forget(cls, cache, key):
+        """
+        Remove a value from the cache. Should be called with ``_lock``.
+        """
+        value = cache.pop(key, None)
+        nbytes = cache.sizes.pop(key, None)
+        if nbytes is not None:
+            cache.nbytes -= nbytes
+            cls._nbytes -= cls._sizes.pop((id(cache), key))[2]
+        return value
+
+    @classmethod
+    def _touch(cls, cache, key):
+        """
+        Mark a cached array as the most recently used.
+        """
+        with cls._lock:
+            if key in cache.sizes:
+                cache.sizes[key] = cache.sizes.pop(key)
+                global_key = (id(cache), key)
+                cls._sizes[global_key] = cls._sizes.pop(global_key)
+
+    def __call__(self, *args, **kw):
+        obj = args[0]
+        cache = self._cache(obj)
         key = (self.func, args[1:], frozenset(kw.items()))
         try:
             res = cache[key]
         except KeyError:
-            res = cache[key] = self.func(*args, **kw)
+            pass
+        else:
+            if key in cache.sizes:
+                self._touch(cache, key)
+            return res
+        with self._key_lock(cache, key):
+            try:
+                res = cache[key]
+            except KeyError:
+                res = self.func(*args, **kw)
+                self._store(obj, cache, key, res)
         return res
 
+    @classmethod
+    def lookup(cls, objtype, name):
+        """
+        Find the ``memoized`` object of a method, to use ``set_cache()`` or
+        ``copy_cache()`` with it.
+
+        :param objtype: The class defining the method or a subclass of it.
+        :param name:    The name of the method.
+        :return:        The ``memoized`` object wrapping the method.
+        """
+        for klass in inspect.getmro(objtype):
+            value = klass.__dict__.get(name)
+            if isinstance(value, cls):
+                return value
+        raise AttributeError('{0} has no memoized method {1}'
+                             .format(objtype.__name__, name))
+
+    def set_cache(self, obj, value, *args, **kw):
+        """
+        Store a value which was computed elsewhere as the cached return value
+        of the method for the given instance and arguments.
+
+        :param obj:   The instance to cache the value on.
+        :param value: The value to return when the method is invoked.
+        :param args:  The args the method would be invoked with.
+        :param kw:    The kwargs the method would be invoked with.
+        """
+        self._store(obj, self._cache(obj),
+                    (self.func, args, frozenset(kw.items())), value)
+
+    def copy_cache(self, src, dst):
+        """
+        Copy all the cached return values of the method from one instance
+        to another.
+
+        :param src: The instance to copy the cached values from.
+        :param dst: The instance to copy the cached values to.
+        """
+        dst_cache = self._cache(dst)
+        for key, value in list(self._cache(src).items()):
+            if key[0] is self.func and key not in dst_cache:
+                self._store(dst, dst_cache, key, value)
+
+    @classmethod
+    def clear_cache(cls, obj):
+        """
+        Remove all the values cached on the given instance.
+
+        :param obj: The instance to clear the cache of.
+        """
+        cache = cls._cache(obj)
+        with cls._lock:
+            for key in list(cache.sizes):
+                cls._forget(cache, key)
+            cache.clear()
+
+
+def requires(*keys):
+    """
+    Declare the data that an analysis method uses. This lets
+    ``GenericFile.analyze()`` compute the shared data once and run the
+    analysis methods as soon as the data they need is available.
+
+    >>> @requires('ndarray', 'exiftool')
+    ... def analyze_something(self):
+    ...     pass
+    >>> analyze_something.requires == ('ndarray', 'exiftool')
+    True
+
+    :param keys: The keys to give to ``fetch()`` or the names of memoized
+                 methods (like ``exiftool``) that the method uses.
+    :return:     A decorator setting the ``requires`` attribute.
+    """
+    def requires_decorator(func):
+        func.requires = keys
+        return func
+    return requires_decorator
+
+
+def analysis_version(version):
+    """
+    Set the version of an analysis method. The version should be increased
+    whenever the data given by the method changes, so that results cached by
+    ``GenericFile.analyze()`` are not used anymore.
+
+    :param version: The version of the method, an integer.
+    :return:        A decorator setting the ``version`` attribute.
+    """
+    def analysis_version_decorator(func):
+        func.version = version
+        return func
+    return analysis_version_decorator
+
+
+def uncached_analysis(func):
+    """
+    Never cache the data of an analysis method on disk. For methods which
+    give data depending on more than the content of the file, like its name
+    or modification date.
+
+    :param func: The analysis method.
+    :return:     The method with the ``cache_results`` attribute set.
+    """
+    func.cache_results = False
+    return func
+
+
+class ObjectPool(object):
+    """
+    A thread safe pool of objects which take long to create and can only
+    be used by one thread at a time, like the classifiers of OpenCV. A new
+    object is only created when all the others are in use, hence the objects
+    are shared by all the threads of the process, even short lived ones.
+
+    :ivar factory: The function called to create a new object.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def get(self):
+        """
+        Take an idle object (or a new one) out of the pool, for use in a
+        ``with`` statement. It is put back into the pool at the end of the
+        ``with`` block.
+        """
+        with self._lock:
+            idle = bool(self._idle)
+            obj = self._idle.pop() if idle else None
+        if not idle:
+            obj = self.factory()
+        try:
+            yield obj
+        finally:
+            with self._lock:
+                self._idle.append(obj)
+
+    def fill(self, size):
+        """
+        Create objects until the pool has the given number of idle objects.
+
+        :param size: The number of idle objects the pool should have.
+        """
+        with self._lock:
+            missing = size - len(self._idle)
+        objs = [self.factory() for _ in range(missing)]
+        with self._lock:
+            self._idle.extend(objs)
+
 
 def retry(exceptions=Exception, tries=-1):
     """
@@ -11,9 +11,8 @@ class VideoFile(FFProbeMixin, GenericFile):
     mimetypes = ()
 
     @classmethod
-    def create(cls, *args, **kwargs):
-        cls_file = cls(*args, **kwargs)
+    def create_from(cls, cls_file):
         if cls_file.is_type('ogv'):
             from file_metadata.video.ogv_file import OGVFile
-            return OGVFile.create(*args, **kwargs)
-        return cls(*args, **kwargs)
+            return OGVFile.create_from(cls_file)
+        return cls_file.cast(cls)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to talk to a long running ZXing decoder. Starting the JVM and
+loading the ZXing classes takes much longer than decoding an image, hence
+a single ``ZXingServer.java`` process is started and reused for every image
+analyzed by the python process. The server is compiled once into the
+user's cache directory. If ``javac`` cannot be used, the source file is run
+directly, which needs Java 11 or newer and compiles it on every start.
+"""
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import atexit
+import base64
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import numpy
+from six.moves import queue
+
+from file_metadata.utilities import DATA_PATH, app_dir, to_cstr
+
+
+def server_command():
+    """
+    The command starting ``ZXingServer.java`` with the ZXing jars. The
+    class is compiled into the user's cache directory the first time, and
+    recompiled only when the source changes.
+
+    :return: A list with the command and its arguments.
+    """
+    source = os.path.join(DATA_PATH, 'ZXingServer.java')
+    classpath = os.path.join(DATA_PATH, '*')
+    with open(source, 'rb') as source_file:
+        digest = hashlib.md5(source_file.read()).hexdigest()[:16]
+    class_dir = app_dir('user_cache_dir', 'zxing_server_' + digest)
+
+    if not os.path.exists(os.path.join(class_dir, 'ZXingServer.class')):
+        # Compile into a temporary directory which is renamed into place,
+        # so that other processes never run a partially written class.
+        tempdir = tempfile.mkdtemp(dir=os.path.dirname(class_dir),
+                                   prefix='tmp_file_metadata')
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                subprocess.check_call(
+                    ['javac', '-cp', classpath, '-d', tempdir, source],
+                    stdout=devnull, stderr=devnull)
+            os.rename(tempdir, class_dir)
+        except (OSError, subprocess.CalledProcessError):
+            # Another process may have compiled it first.
+            shutil.rmtree(tempdir, ignore_errors=True)
+        if not os.path.exists(os.path.join(class_dir, 'ZXingServer.class')):
+            return ['java', '-cp', classpath, source]
+
+    return ['java', '-cp', os.pathsep.join([class_dir, classpath]),
+            'ZXingServer']
+
+
+class ZXingServer(object):
+    """
+    A ``ZXingServer.java`` process. Every request is a line written to the
+    stdin of the process, and the process answers with one line per barcode
+    found followed by a ``done`` line. A process which crashes is restarted
+    and the request is retried once. A process which takes longer than
+    ``timeout`` seconds for a request is killed.
+
+    :ivar command: The command to start the process with. Defaults to
+                   ``server_command()`` when the process is started.
+    :ivar timeout: The number of seconds to wait for a request.
+    """
+
+    def __init__(self, command=None, timeout=60):
+        self.command = command
+        self.timeout = timeout
+        self.failed = False
+        self.process = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """
+        Start the process and wait until it is ready. If it cannot be
+        started (for example because Java is too old), it is not tried
+        again by this object.
+        """
+        if self.failed:
+            raise OSError('The ZXing server could not be started.')
+        with open(os.devnull, 'wb') as devnull:
+            try:
+                self.process = subprocess.Popen(
+                    self.command or server_command(), stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=devnull)
+            except OSError:
+                self.failed = True
+                raise
+        self._lines = queue.Queue()
+        reader = threading.Thread(target=self._read_lines,
+                                  args=(self.process.stdout, self._lines))
+        reader.daemon = True
+        reader.start()
+        try:
+            ready = self._readline()
+        except IOError:
+            ready = None
+        if ready != 'ready':
+            self.failed = True
+            self.terminate()
+            raise OSError('The ZXing server could not be started.')
+
+    @staticmethod
+    def _read_lines(stdout, lines):
+        for line in iter(stdout.readline, b''):
+            lines.put(line.decode('utf-8').rstrip('\r\n'))
+        lines.put(None)
+
+    def _readline(self):
+        try:
+            line = self._lines.get(timeout=self.timeout)
+        except queue.Empty:
+            self.process.kill()
+            self.terminate()
+            raise IOError('The ZXing server did not answer in {0} seconds.'
+                          .format(self.timeout))
+        if line is None:
+            raise IOError('The ZXing server exited unexpectedly.')
+        return line
+
+    def terminate(self):
+        """
+        Stop the process.
+        """
+        if self.running:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def _request(self, header, payload=b''):
+        if not self.running:
+            self.start()
+        self.process.stdin.write(to_cstr(header) + b'\n' + payload)
+        self.process.stdin.flush()
+
+        results, error = [], None
+        for line in iter(self._readline, 'done'):
+            fields = line.split('\t')
+            if fields[0] == 'error':
+                error = base64.b64decode(fields[1]).decode('utf-8')
+                continue
+            points = [tuple(float(i) for i in point.split(','))
+                      for point in fields[4].split()]
+            results.append({
+                'format': fields[1],
+                'raw_data': base64.b64decode(fields[2]).decode('utf-8'),
+                'data': base64.b64decode(fields[3]).decode('utf-8'),
+                'points': points})
+        if error is not None:
+            raise ValueError(error)
+        return results
+
+    def decode(self, header, payload=b''):
+        with self._lock:
+            if self._pid != os.getpid():
+                # The process was forked, the pipes of the parent's process
+                # must not be used by the child.
+                self.process, self._pid = None, os.getpid()
+            try:
+                return self._request(header, payload)
+            except IOError:
+                if self.failed or self.process is None:  # Timed out
+                    raise
+                # The process died or was killed, so restart it and retry.
+                self.terminate()
+                return self._request(header, payload)
+
+    def decode_file(self, uri):
+        """
+        Find the barcodes in an image file.
+
+        :param uri: The ``file://`` URI of the image.
+        :return:    A list of dicts with the keys ``format``, ``raw_data``,
+                    ``data`` and ``points`` for every barcode found.
+        """
+        return self.decode('file ' + uri)
+
+    def decode_pixels(self, image_array):
+        """
+        Find the barcodes in the pixels of an image.
+
+        :param image_array: A greyscale, RGB or RGBA image with 8 bit
+                            channels. The alpha channel is ignored.
+        :return:            The list of barcodes, like ``decode_file()``.
+        """
+        if image_array.ndim == 2:
+            image_array = image_array[..., None].repeat(3, axis=2)
+        rgb = numpy.ascontiguousarray(image_array[..., :3], dtype=numpy.uint8)
+        height, width = rgb.shape[:2]
+        return self.decode('pixels {0} {1}'.format(width, height),
+                           rgb.tobytes())
+
+    def close(self):
+        """
+        Stop the process if it was started by this python process.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                self.terminate()
+            self.process = None
+
+
+_server = []
+_server_lock = threading.Lock()
+
+
+def zxing_server():
+    """
+    The process-wide ``ZXingServer``.
+
+    :return: A ``ZXingServer`` object.
+    """
+    with _server_lock:
+        if not _server:
+            _server.append(ZXingServer())
+        return _server[0]
+
+
+@atexit.register
+def close_server():
+    """
+    Stop the ZXing process started by this module.
+    """
+    with _server_lock:
+        for server in _server:
+            server.close()
@@ -23,6 +23,7 @@ install_deps = [
     setupdeps.LibMagic(),
     setupdeps.PythonMagic(),
     setupdeps.Six(),
+    setupdeps.Futures(),
     setupdeps.ExifTool(),
     setupdeps.AppDirs(),
     # Image deps
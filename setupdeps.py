@@ -315,6 +315,22 @@ class PathLib(SetupPackage):
             return []
 
 
+class Futures(SetupPackage):
+    name = 'futures'
+
+    def check(self):
+        if sys.version_info < (3, 2):
+            return 'Backported concurrent.futures will be installed with pip.'
+        else:
+            return 'Already installed in python 3.2+'
+
+    def get_install_requires(self):
+        if sys.version_info < (3, 2):
+            return ['futures']
+        else:
+            return []
+
+
 class AppDirs(SetupPackage):
     name = 'appdirs'
 
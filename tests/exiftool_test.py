@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from file_metadata._compat import which
+from file_metadata.exiftool import (ExifToolPool, ExifToolProcess,
+                                    ExifToolTimeout, exiftool_pool)
+from tests import fetch_file, mock, unittest
+
+# A small stand-in for ``exiftool -stay_open True -@ -`` which echoes the
+# arguments of every request as JSON. The argument "crash" kills it and
+# "hang" makes it stop answering.
+FAKE_EXIFTOOL = """#!{python}
+import json
+import sys
+import time
+
+args = []
+for line in iter(sys.stdin.readline, ''):
+    line = line.rstrip('\\n')
+    if line == 'crash':
+        sys.exit(1)
+    elif line == 'hang':
+        time.sleep(60)
+    elif line == 'False' and args[-1:] == ['-stay_open']:
+        sys.exit(0)
+    elif line.startswith('-execute'):
+        sys.stdout.write(json.dumps(args) + '\\n')
+        sys.stdout.write('{{ready' + line[len('-execute'):] + '}}\\n')
+        sys.stdout.flush()
+        args = []
+    else:
+        args.append(line)
+"""
+
+
+class FakeExifToolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.executable = os.path.join(self.testdir, 'exiftool')
+        with open(self.executable, 'w') as _file:
+            _file.write(FAKE_EXIFTOOL.format(python=sys.executable))
+        os.chmod(self.executable, stat.S_IRWXU)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+
+class ExifToolProcessTest(FakeExifToolTest):
+
+    def test_multiple_requests(self):
+        uut = ExifToolProcess(self.executable)
+        try:
+            self.assertEqual(json.loads(uut.execute('-j', 'a').decode()),
+                             ['-j', 'a'])
+            pid = uut.process.pid
+            self.assertEqual(json.loads(uut.execute('b').decode()), ['b'])
+            self.assertEqual(uut.process.pid, pid)
+        finally:
+            uut.terminate()
+        self.assertFalse(uut.running)
+
+    def test_crash(self):
+        uut = ExifToolProcess(self.executable)
+        self.assertRaises(IOError, uut.execute, 'crash')
+        uut.terminate()
+
+
+class ExifToolPoolTest(FakeExifToolTest):
+
+    def test_restart_after_crash(self):
+        uut = ExifToolPool(self.executable, max_workers=1)
+        try:
+            uut.execute('a')
+            uut._workers[0].process.kill()
+            uut._workers[0].process.wait()
+            self.assertEqual(json.loads(uut.execute('b').decode()), ['b'])
+        finally:
+            uut.close()
+
+    def test_newline_argument(self):
+        uut = ExifToolPool(self.executable)
+        # The fake exiftool only prints output for "-execute", hence nothing
+        # is printed when it is not run with "-stay_open".
+        self.assertEqual(uut.execute('a\nb'), b'')
+        self.assertEqual(uut._workers, [])
+
+    def test_threads(self):
+        uut = ExifToolPool(self.executable, max_workers=2)
+        results = {}
+
+        def run(i):
+            results[i] = json.loads(uut.execute(str(i)).decode())
+
+        try:
+            threads = [threading.Thread(target=run, args=(i,))
+                       for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertLessEqual(len(uut._workers), 2)
+        finally:
+            uut.close()
+        self.assertEqual(results, dict((i, [str(i)]) for i in range(10)))
+
+    def test_discard_worker_after_error(self):
+        uut = ExifToolPool(self.executable, max_workers=1)
+        try:
+            uut.execute('a')
+            worker = uut._workers[0]
+            with mock.patch.object(worker, 'execute',
+                                   side_effect=KeyboardInterrupt):
+                self.assertRaises(KeyboardInterrupt, uut.execute, 'b')
+            self.assertFalse(worker.running)
+            self.assertEqual(uut._workers, [])
+            self.assertEqual(json.loads(uut.execute('c').decode()), ['c'])
+        finally:
+            uut.close()
+
+    def test_timeout(self):
+        uut = ExifToolPool(self.executable, max_workers=1, timeout=0.5)
+        try:
+            uut.execute('a')
+            worker = uut._workers[0]
+            self.assertRaises(ExifToolTimeout, uut.execute, 'hang')
+            self.assertFalse(worker.running)
+            self.assertEqual(uut._workers, [])
+            self.assertEqual(json.loads(uut.execute('c').decode()), ['c'])
+        finally:
+            uut.close()
+
+    def _run_blocked(self, uut, side_effect):
+        # Run a request in a thread which keeps the only worker busy until
+        # ``proceed`` is set.
+        uut.execute('a')
+        worker = uut._workers[0]
+        proceed = threading.Event()
+
+        def execute(*args):
+            proceed.wait(10)
+            return side_effect()
+
+        def run():
+            try:
+                uut.execute('b')
+            except RuntimeError:
+                pass
+
+        patcher = mock.patch.object(worker, 'execute', side_effect=execute)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        thread = threading.Thread(target=run)
+        thread.start()
+        while uut._idle:
+            time.sleep(0.01)
+        return worker, thread, proceed
+
+    def test_waiting_after_discard(self):
+        # A thread waiting for the only worker continues with a new process
+        # when that worker is discarded.
+        uut = ExifToolPool(self.executable, max_workers=1)
+        results = []
+        try:
+            worker, blocked, proceed = self._run_blocked(
+                uut, mock.Mock(side_effect=RuntimeError))
+            waiting = threading.Thread(
+                target=lambda: results.append(uut.execute('c')))
+            waiting.start()
+            proceed.set()
+            blocked.join(10)
+            waiting.join(10)
+            self.assertFalse(waiting.is_alive())
+            self.assertNotIn(worker, uut._workers)
+        finally:
+            uut.close()
+        self.assertEqual([json.loads(r.decode()) for r in results], [['c']])
+
+    def test_close_while_busy(self):
+        uut = ExifToolPool(self.executable, max_workers=1)
+        worker, blocked, proceed = self._run_blocked(
+            uut, mock.Mock(return_value=b'[]'))
+        with mock.patch.object(worker, 'terminate') as mock_terminate:
+            uut.close()
+            self.assertFalse(mock_terminate.called)
+            proceed.set()
+            blocked.join(10)
+            # The worker is terminated instead of joining the new pool.
+            self.assertTrue(mock_terminate.called)
+        self.assertEqual(uut._idle, [])
+        worker.kill()
+
+
+@unittest.skipIf(which('exiftool') is None, '`exiftool` not found.')
+class ExifToolPoolIntegrationTest(unittest.TestCase):
+
+    def test_exiftool_text_plain(self):
+        uut = exiftool_pool(which('exiftool'))
+        data = json.loads(uut.execute(
+            '-G', '-j', fetch_file('ascii.txt')).decode('utf-8'))
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['File:FileSize'], '98 bytes')
+        self.assertIs(uut, exiftool_pool(which('exiftool')))
@@ -3,28 +3,300 @@
 from __future__ import (division, absolute_import, unicode_literals,
                         print_function)
 
+import json
 import os
+import shutil
+import signal
+import stat
+import sys
 import tempfile
+import time
 
-from file_metadata.generic_file import GenericFile, magic
-from tests import fetch_file, mock, unittest, which_sideeffect
+from file_metadata.generic_file import (GenericFile, _init_analyze_worker,
+                                        magic)
+from file_metadata.utilities import analysis_version, memoized, requires
+from tests import CACHE_DIR, fetch_file, mock, unittest, which_sideeffect
 
 
 class DerivedFile(GenericFile):
 
-    def analyze(self):  # Only use the `_analyze_test` functions for tests
-        return GenericFile.analyze(self, prefix='analyze_test')
+    @classmethod
+    def create_from(cls, cls_file):
+        return cls_file.cast(cls)
+
+    def analyze(self, **kwargs):  # Only use the `_analyze_test` functions
+        return GenericFile.analyze(self, prefix='analyze_test', **kwargs)
 
     def analyze_test1(self):
         return {"test1": "test1"}
 
 
+class StatDerivedFile(DerivedFile):
+
+    def analyze_test2(self):
+        return self.analyze_os_stat()
+
+
+class CountingDerivedFile(DerivedFile):
+
+    def __init__(self, *args, **kwargs):
+        super(CountingDerivedFile, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def analyze_test1(self):
+        self.calls.append('test1')
+        return {'test1': 1}
+
+    def analyze_test2(self):
+        self.calls.append('test2')
+        return {'test2': 1}
+
+
+class SlowDerivedFile(GenericFile):
+
+    def analyze(self, **kwargs):  # Only use the `_analyze_test` functions
+        return GenericFile.analyze(self, prefix='analyze_test', **kwargs)
+
+    def analyze_test1(self):
+        time.sleep(0.2)
+        return {"test1": "test1", "common": "test1"}
+
+    def analyze_test2(self):
+        time.sleep(0.2)
+        return {"test2": "test2", "common": "test2"}
+
+    def analyze_test3(self):
+        raise UnicodeDecodeError(str('utf-8'), b'', 0, 1, str('invalid'))
+
+
+class RequiresDerivedFile(GenericFile):
+
+    def analyze(self, **kwargs):  # Only use the `_analyze_test` functions
+        return GenericFile.analyze(self, prefix='analyze_test', **kwargs)
+
+    @memoized
+    def fetch(self, key=''):
+        if key == 'slow':
+            self.fetched.append(key)
+            time.sleep(0.2)
+            return 'slow'
+        return super(RequiresDerivedFile, self).fetch(key)
+
+    @requires('slow')
+    def analyze_test1(self):
+        return {'test1': self.fetch('slow')}
+
+    @requires('slow', 'filename')
+    def analyze_test2(self):
+        return {'test2': self.fetch('slow') + self.fetch('filename')}
+
+    @requires('slow')
+    def analyze_test3(self):
+        raise ValueError('Analysis failed')
+
+
+class ExifDerivedFile(DerivedFile):
+
+    def analyze_test2(self):
+        return self.exiftool()
+
+
+# A stand-in for ``exiftool -stay_open True -@ -`` which writes its pid in
+# the directory it is in, and like exiftool keeps running when its stdin is
+# closed without being asked to exit.
+FAKE_EXIFTOOL = """#!{python}
+import json
+import os
+import sys
+import time
+
+open(os.path.join({directory!r}, str(os.getpid())), 'w').close()
+args = []
+for line in iter(sys.stdin.readline, ''):
+    line = line.rstrip('\\n')
+    if line == 'False' and args[-1:] == ['-stay_open']:
+        sys.exit(0)
+    elif line.startswith('-execute'):
+        sys.stdout.write(json.dumps([{{'File:FileName': args[-1]}}]) + '\\n')
+        sys.stdout.write('{{ready' + line[len('-execute'):] + '}}\\n')
+        sys.stdout.flush()
+        args = []
+    else:
+        args.append(line)
+time.sleep(60)
+"""
+
+
 class GenericFileTest(unittest.TestCase):
 
     def test_derived_file_analyze(self):
         uut = DerivedFile(fetch_file('ascii.txt'))
         self.assertEqual(uut.analyze(), {'test1': 'test1'})
 
+    def test_concurrent_analyze(self):
+        from concurrent.futures import ThreadPoolExecutor
+        uut = SlowDerivedFile(fetch_file('ascii.txt'))
+        expected = {'test1': 'test1', 'test2': 'test2', 'common': 'test2'}
+        self.assertEqual(uut.analyze(), expected)
+
+        start = time.time()
+        self.assertEqual(uut.analyze(max_workers=2), expected)
+        self.assertLess(time.time() - start, 0.35)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(uut.analyze(executor=executor), expected)
+
+    def test_requires_analyze(self):
+        uut = RequiresDerivedFile(fetch_file('ascii.txt'))
+        uut.fetched = []
+        self.assertRaises(ValueError, uut.analyze, max_workers=3)
+        self.assertEqual(uut.fetched, ['slow'])
+        uut.analyze_test3 = lambda: {}
+        self.assertEqual(uut.analyze(max_workers=3),
+                         {'test1': 'slow',
+                          'test2': 'slow' + uut.fetch('filename')})
+        self.assertEqual(uut.fetched, ['slow'])
+
+    def test_analyze_many(self):
+        filenames = [fetch_file('ascii.txt'), fetch_file('file.bin'),
+                     os.path.join(CACHE_DIR, 'missing.txt')]
+        for ordered in (True, False):
+            results = list(StatDerivedFile.analyze_many(
+                filenames, workers=2, ordered=ordered))
+            self.assertEqual(len(results), 3)
+            if ordered:
+                self.assertEqual([i[0] for i in results], filenames)
+            results = dict((i[0], i[1:]) for i in results)
+            self.assertEqual(results[filenames[0]], (
+                {'test1': 'test1', 'File:FileSize': '98 bytes'}, None))
+            self.assertEqual(results[filenames[1]], (
+                {'test1': 'test1', 'File:FileSize': '128 bytes'}, None))
+            self.assertIsNone(results[filenames[2]][0])
+            self.assertIn('Error', results[filenames[2]][1])
+
+    def test_analyze_many_stops_exiftool(self):
+        testdir = tempfile.mkdtemp()
+        try:
+            pid_dir = os.path.join(testdir, 'pids')
+            os.mkdir(pid_dir)
+            executable = os.path.join(testdir, 'exiftool')
+            with open(executable, 'w') as _file:
+                _file.write(FAKE_EXIFTOOL.format(python=sys.executable,
+                                                 directory=pid_dir))
+            os.chmod(executable, stat.S_IRWXU)
+
+            filenames = [fetch_file('ascii.txt'), fetch_file('file.bin')]
+            with mock.patch('file_metadata.generic_file.which',
+                            return_value=executable):
+                results = list(ExifDerivedFile.analyze_many(filenames,
+                                                            workers=2))
+            self.assertEqual(sorted(i[1]['File:FileName'] for i in results),
+                             sorted(filenames))
+            pids = [int(pid) for pid in os.listdir(pid_dir)]
+            self.assertTrue(pids)
+            for pid in pids:
+                self.assertRaises(OSError, os.kill, pid, 0)
+        finally:
+            for pid in os.listdir(os.path.join(testdir, 'pids')):
+                try:
+                    os.kill(int(pid), signal.SIGKILL)
+                except OSError:
+                    pass
+            shutil.rmtree(testdir)
+
+    def test_analyze_worker_preload(self):
+        module = mock.Mock()
+        with mock.patch.dict('sys.modules',
+                             {'file_metadata.video.video_file': module}):
+            _init_analyze_worker()
+            self.assertFalse(module.preload.called)
+            _init_analyze_worker(preload=True)
+        module.preload.assert_called_once_with()
+
+    def test_cache_results(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            uut = CountingDerivedFile(fetch_file('ascii.txt'),
+                                      cache_results=cache_dir)
+            self.assertEqual(uut.analyze(), {'test1': 1, 'test2': 1})
+            uut = CountingDerivedFile(fetch_file('ascii.txt'),
+                                      cache_results=cache_dir)
+            self.assertEqual(uut.analyze(max_workers=2),
+                             {'test1': 1, 'test2': 1})
+            self.assertEqual(uut.calls, [])
+
+            # A new version of the method is analyzed again
+            uut = CountingDerivedFile(fetch_file('ascii.txt'),
+                                      cache_results=cache_dir)
+            uut.analyze_test2 = analysis_version(2)(
+                lambda: {'test2': uut.calls.append('test2') or 2})
+            self.assertEqual(uut.analyze(), {'test1': 1, 'test2': 2})
+            self.assertEqual(uut.calls, ['test2'])
+
+            # Other files are not affected by the cache
+            uut = CountingDerivedFile(fetch_file('file.bin'),
+                                      cache_results=cache_dir)
+            self.assertEqual(uut.analyze(), {'test1': 1, 'test2': 1})
+            self.assertEqual(uut.calls, ['test1', 'test2'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_cache_results_options(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            # Options like max_cache_bytes which do not change the data do
+            # not change the cache key.
+            analyzed = ['test1', 'test2']
+            for option, calls in ((1, analyzed), (2, analyzed), (1, [])):
+                uut = CountingDerivedFile(
+                    fetch_file('ascii.txt'), cache_results=cache_dir,
+                    max_cache_bytes=option * 1024,
+                    mime_buffer_size=option * 1024)
+                self.assertEqual(uut.analyze(), {'test1': 1, 'test2': 1})
+                self.assertEqual(uut.calls, calls)
+
+            # Other options, like objects used for the analysis, are not
+            # part of the key either.
+            uut = CountingDerivedFile(
+                fetch_file('ascii.txt'), cache_results=cache_dir,
+                mime_buffer_size=1024, resolver=object())
+            self.assertEqual(uut.analyze(), {'test1': 1, 'test2': 1})
+            self.assertEqual(uut.calls, [])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_cache_results_exifdata(self):
+        def execute(*args):
+            filename = args[-1]
+            return json.dumps([{
+                'SourceFile': filename,
+                'File:FileName': os.path.basename(filename),
+                'File:FileModifyDate': os.stat(filename).st_mtime,
+                'EXIF:Make': 'Camera'}]).encode('utf-8')
+
+        testdir = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(testdir, 'cache')
+            first = os.path.join(testdir, 'first.txt')
+            second = os.path.join(testdir, 'second.txt')
+            shutil.copy(fetch_file('ascii.txt'), first)
+            shutil.copy(fetch_file('ascii.txt'), second)
+            os.utime(second, (1000000000, 1000000000))
+            with mock.patch('file_metadata.generic_file.which',
+                            return_value='exiftool'), \
+                    mock.patch('file_metadata.generic_file.exiftool_pool') \
+                    as mock_pool:
+                mock_pool.return_value.execute.side_effect = execute
+                data = [GenericFile(name, cache_results=cache_dir).analyze(
+                    methods=['analyze_exifdata']) for name in (first, second)]
+            self.assertEqual(data[0]['File:FileName'], 'first.txt')
+            self.assertEqual(data[1]['File:FileName'], 'second.txt')
+            self.assertEqual(data[1]['File:FileModifyDate'], 1000000000)
+            self.assertNotEqual(data[0]['File:FileModifyDate'], 1000000000)
+            self.assertEqual(mock_pool.return_value.execute.call_count, 2)
+        finally:
+            shutil.rmtree(testdir)
+
     def test_file_close(self):
         uut = GenericFile(fetch_file('ascii.txt'))
         fd, name = tempfile.mkstemp(
@@ -35,6 +307,15 @@ class GenericFileTest(unittest.TestCase):
         uut.close()
         self.assertFalse(os.path.exists(name))
 
+    def test_file_close_cache(self):
+        uut = GenericFile(fetch_file('ascii.txt'))
+        memoized.lookup(GenericFile, 'exiftool').set_cache(
+            uut, {'a': 1})
+        uut.close()
+        with mock.patch('file_metadata.generic_file.which',
+                        return_value=None):
+            self.assertRaises(OSError, uut.exiftool)
+
     def test_enter_exit(self):
         name = None
         with GenericFile(fetch_file('ascii.txt')) as uut:
@@ -66,6 +347,25 @@ class GenericFileTest(unittest.TestCase):
         _file = GenericFile(fetch_file('ascii.txt'))
         self.assertRaises(ImportError, _file.analyze_mimetype)
 
+    @mock.patch('file_metadata.generic_file.magic')
+    def test_magic_instance_reused(self, mock_magic):
+        del mock_magic.from_file
+        mock_magic.open.return_value.file.return_value = 'text/plain'
+        for _ in range(2):
+            _file = GenericFile(fetch_file('ascii.txt'))
+            self.assertEqual(_file.mime(), 'text/plain')
+        self.assertEqual(mock_magic.open.call_count, 1)
+        self.assertEqual(mock_magic.open.return_value.load.call_count, 1)
+
+    @mock.patch('file_metadata.generic_file.magic')
+    def test_magic_buffer(self, mock_magic):
+        mock_magic.from_buffer.return_value = 'text/plain'
+        _file = GenericFile(fetch_file('ascii.txt'), mime_buffer_size=10)
+        self.assertEqual(_file.mime(), 'text/plain')
+        mock_magic.from_buffer.assert_called_once_with(b'abcdefghij',
+                                                       mime=True)
+        self.assertFalse(mock_magic.from_file.called)
+
     @mock.patch('file_metadata.generic_file.which',
                 side_effect=which_sideeffect(['exiftool']))
     def test_exiftool_not_found(self, mock_which):
@@ -86,6 +386,10 @@ class GenericFileMagicTest(unittest.TestCase):
         self.assertIn('File:MIMEType', data)
         self.assertEqual(data['File:MIMEType'], 'audio/x-wav')
 
+    def test_magic_buffer_audio_wav(self):
+        _file = GenericFile(fetch_file('noise.wav'), mime_buffer_size=4096)
+        self.assertEqual(_file.mime(), 'audio/x-wav')
+
 
 @unittest.skipIf(not hasattr(magic, 'from_file'),
                  'python-magic from pypi not found.')
@@ -126,6 +430,30 @@ class GenericFileExiftoolTest(unittest.TestCase):
         self.assertEqual(data['XMP:State'], 'Franche-Comté')
         self.assertIn('Éclipse', data['XMP:Description'])
 
+    def test_exiftool_many(self):
+        files = [GenericFile(fetch_file('ascii.txt')),
+                 fetch_file('noise.wav')]
+        data = GenericFile.exiftool_many(files)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0]['File:FileSize'], '98 bytes')
+        self.assertEqual(data[1]['File:FileSize'], '86 kB')
+        self.assertIs(files[0].exiftool(), data[0])
+
+    @mock.patch('file_metadata.generic_file.which', return_value='exiftool')
+    @mock.patch('file_metadata.generic_file.exiftool_pool')
+    def test_exiftool_many_missing_file(self, mock_pool, mock_which):
+        _file = GenericFile(fetch_file('ascii.txt'))
+        missing = GenericFile(os.path.join(CACHE_DIR, 'missing.txt'))
+        mock_pool.return_value.execute.return_value = (
+            '[{{"SourceFile": {0}, "File:FileSize": "98 bytes"}}]'
+            .format(json.dumps(_file.fetch('filename'))).encode('utf-8'))
+        self.assertEqual(GenericFile.exiftool_many([missing, _file]),
+                         [None, {'SourceFile': _file.fetch('filename'),
+                                 'File:FileSize': '98 bytes'}])
+        self.assertEqual(_file.exiftool()['File:FileSize'], '98 bytes')
+        mock_pool.return_value.execute.assert_called_once_with(
+            '-G', '-j', missing.fetch('filename'), _file.fetch('filename'))
+
 
 class GenericFileCreateTest(unittest.TestCase):
 
@@ -139,6 +467,35 @@ class GenericFileCreateTest(unittest.TestCase):
             self.assertTrue(os.path.exists(name))
         self.assertFalse(os.path.exists(name))
 
+    @mock.patch('file_metadata.generic_file.which', return_value='exiftool')
+    @mock.patch('file_metadata.generic_file.exiftool_pool')
+    @mock.patch('file_metadata.generic_file.magic')
+    def test_create_detects_once(self, mock_magic, mock_pool, mock_which):
+        from file_metadata.audio.ogg_file import OGGFile
+        mock_magic.from_file.return_value = 'audio/ogg'
+        mock_pool.return_value.execute.return_value = (
+            b'[{"File:MIMEType": "audio/x-ogg", "File:FileType": "OGG"}]')
+        uut = GenericFile.create(fetch_file('file.bin'))
+        self.assertTrue(isinstance(uut, OGGFile))
+        self.assertEqual(uut.mime(), 'audio/ogg')
+        self.assertEqual(uut.exiftool()['File:FileType'], 'OGG')
+        self.assertEqual(mock_magic.from_file.call_count, 1)
+        self.assertEqual(mock_pool.return_value.execute.call_count, 1)
+
+    def test_cast(self):
+        from file_metadata.application.application_file import ApplicationFile
+        _file = GenericFile(fetch_file('file.bin'), option1='one')
+        memoized.lookup(GenericFile, 'exiftool').set_cache(
+            _file, {'a': 1})
+        _file.temp_filenames.add('tempfile')
+        uut = _file.cast(ApplicationFile)
+        self.assertTrue(isinstance(uut, ApplicationFile))
+        self.assertEqual(uut.config('option1'), 'one')
+        self.assertEqual(uut.exiftool(), {'a': 1})
+        self.assertEqual(uut.temp_filenames, set(['tempfile']))
+        self.assertEqual(_file.temp_filenames, set())
+        self.assertIs(uut.cast(ApplicationFile), uut)
+
     def test_create_image_file(self):
         from file_metadata.image.image_file import ImageFile
         for fname in ['red.png']:
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import parse_qs, urlsplit
+
+from file_metadata.geocoding import (Gazetteer, Nominatim, gazetteer,
+                                     haversine, nominatim)
+from tests import unittest
+
+# A few rows in the format of the GeoNames dumps.
+CITIES = [
+    ['1853295', 'Moriguchi', 'Moriguchi', '', '34.7375', '135.56417', 'P',
+     'PPL', 'JP', '', '32', '', '', '', '146697', '', '5', 'Asia/Tokyo',
+     '2017-04-09'],
+    ['1853909', 'Osaka', 'Osaka', '', '34.69374', '135.50218', 'P', 'PPLA',
+     'JP', '', '32', '', '', '', '2592413', '', '14', 'Asia/Tokyo',
+     '2019-09-05'],
+    ['1850147', 'Tokyo', 'Tokyo', '', '35.6895', '139.69171', 'P', 'PPLC',
+     'JP', '', '40', '', '', '', '8336599', '', '44', 'Asia/Tokyo',
+     '2019-09-05'],
+    ['1861060', 'Japan', 'Japan', '', '35.68536', '139.75309', 'A', 'PCLI',
+     'JP', '', '00', '', '', '', '126529100', '', '', 'Asia/Tokyo',
+     '2019-09-05'],
+    ['2208330', 'Suva', 'Suva', '', '-18.14161', '178.44149', 'P', 'PPLC',
+     'FJ', '', '01', '', '', '', '77366', '', '', 'Pacific/Fiji',
+     '2019-09-05'],
+    ['4031637', 'Apia', 'Apia', '', '-13.83333', '-171.76666', 'P', 'PPLC',
+     'WS', '', '11', '', '', '', '40407', '', '', 'Pacific/Apia',
+     '2019-09-05'],
+]
+ADMIN1 = [['JP.32', 'Osaka', 'Osaka', '1853904'],
+          ['JP.40', 'Tokyo', 'Tokyo', '1850144']]
+COUNTRIES = [['JP', 'JPN', '392', 'JA', 'Japan', 'Tokyo']]
+
+
+def write_rows(filename, rows):
+    with io.open(filename, 'w', encoding='utf-8') as _file:
+        _file.write('# A comment\n')
+        for row in rows:
+            _file.write('\t'.join(row) + '\n')
+
+
+class HaversineTest(unittest.TestCase):
+
+    def test_haversine(self):
+        self.assertAlmostEqual(haversine(0, 0, 0, 1), 111.19, places=2)
+        self.assertAlmostEqual(haversine(0, 179.5, 0, -179.5), 111.19,
+                               places=2)
+        self.assertAlmostEqual(haversine(90, 0, 90, 100), 0)
+
+
+class GazetteerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.testdir, 'cities1000.txt')
+        write_rows(self.filename, CITIES)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_reverse_names(self):
+        write_rows(os.path.join(self.testdir, 'admin1CodesASCII.txt'),
+                   ADMIN1)
+        write_rows(os.path.join(self.testdir, 'countryInfo.txt'), COUNTRIES)
+        uut = Gazetteer(self.filename)
+        self.assertEqual(uut.reverse(34.748261, 135.576661),
+                         {'country': 'Japan', 'state': 'Osaka',
+                          'city': 'Moriguchi'})
+        self.assertEqual(uut.reverse(35.69, 139.7)['city'], 'Tokyo')
+
+    def test_reverse_codes(self):
+        uut = Gazetteer(self.filename)
+        self.assertEqual(uut.reverse(34.748261, 135.576661),
+                         {'country': 'JP', 'state': '32',
+                          'city': 'Moriguchi'})
+
+    def test_reverse_only_populated_places(self):
+        uut = Gazetteer(self.filename)
+        self.assertEqual(len(uut.places), 5)
+        self.assertEqual(uut.reverse(35.68536, 139.75309)['city'], 'Tokyo')
+
+    def test_reverse_max_distance(self):
+        uut = Gazetteer(self.filename)
+        self.assertIsNone(uut.reverse(0, 0))
+        uut.max_distance = None
+        self.assertEqual(uut.reverse(0, 0)['city'], 'Osaka')
+
+    def test_reverse_across_antimeridian(self):
+        uut = Gazetteer(self.filename, max_distance=1000)
+        self.assertEqual(uut.reverse(-17, -179.9)['city'], 'Suva')
+        self.assertEqual(uut.reverse(-14, -172.5)['city'], 'Apia')
+
+    def test_reverse_cell_sizes(self):
+        for cell_size in (0.1, 1, 7, 360):
+            uut = Gazetteer(self.filename, max_distance=600,
+                            cell_size=cell_size)
+            self.assertEqual(uut.reverse(34.69, 135.5)['city'], 'Osaka')
+            self.assertEqual(uut.reverse(35, 139)['city'], 'Tokyo')
+
+    def test_gazetteer_loaded_once(self):
+        self.assertIs(gazetteer(self.filename), gazetteer(self.filename))
+
+
+class NominatimHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connections alive.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.client_address, self.path))
+        status, body = server.responses.get(
+            parse_qs(urlsplit(self.path).query)['lat'][0],
+            (200, {'address': {'country': 'Japan', 'city': 'Moriguchi'}}))
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # Every kept alive connection is handled in its own thread.
+    daemon_threads = True
+
+
+class NominatimTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), NominatimHandler)
+        self.server.requests, self.server.responses = [], {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/reverse'.format(
+            self.server.server_address[1])
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def resolver(self, **kwargs):
+        kwargs.setdefault('delay', 0)
+        kwargs.setdefault('cache_dir', self.cache_dir)
+        resolver = Nominatim(self.url, **kwargs)
+        self.addCleanup(resolver.close)
+        return resolver
+
+    def test_reverse(self):
+        self.assertEqual(self.resolver().reverse(34.748261, 135.576661),
+                         {'country': 'Japan', 'state': None,
+                          'city': 'Moriguchi'})
+        (_, path), = self.server.requests
+        query = parse_qs(urlsplit(path).query)
+        self.assertEqual(urlsplit(path).path, '/reverse')
+        self.assertEqual(query['lat'], ['34.748'])
+        self.assertEqual(query['lon'], ['135.577'])
+        self.assertEqual(query['zoom'], ['13'])
+
+    def test_reverse_not_found(self):
+        self.server.responses['0.0'] = (200, [])
+        self.assertIsNone(self.resolver().reverse(0, 0))
+        self.server.responses['1.0'] = (200, {'error': 'Unable to geocode'})
+        self.assertIsNone(self.resolver().reverse(1, 0))
+
+    def test_memory_cache(self):
+        uut = self.resolver(cache_dir=None)
+        uut.reverse(34.748261, 135.576661)
+        uut.reverse(34.7481, 135.5765)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_memory_cache_max_entries(self):
+        uut = self.resolver(cache_dir=None, max_entries=2)
+        for lat in (1, 2, 3, 1):
+            uut.reverse(lat, 0)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(list(uut._cache), [(3, 0), (1, 0)])
+
+    def test_disk_cache(self):
+        self.resolver().reverse(34.748261, 135.576661)
+        data = self.resolver().reverse(34.748261, 135.576661)
+        self.assertEqual(data['city'], 'Moriguchi')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_errors_not_cached(self):
+        self.server.responses['0.0'] = (500, {})
+        uut = self.resolver()
+        self.assertIsNone(uut.reverse(0, 0))
+        self.assertIsNone(uut.reverse(0, 0))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_keep_alive(self):
+        uut = self.resolver()
+        for lat in (1, 2, 3):
+            uut.reverse(lat, 0)
+        clients = set(client for client, _ in self.server.requests)
+        self.assertEqual(len(clients), 1)
+
+    def test_reconnect(self):
+        uut = self.resolver()
+        uut.reverse(1, 0)
+        # Close the socket as a server does for idle connections.
+        uut._connection.sock.close()
+        self.assertEqual(uut.reverse(2, 0)['city'], 'Moriguchi')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_rate_limit(self):
+        uut = self.resolver(delay=0.2)
+        start = time.time()
+        for lat in (1, 2, 3):
+            uut.reverse(lat, 0)
+        self.assertGreaterEqual(time.time() - start, 0.4)
+
+    def test_unreachable(self):
+        uut = self.resolver()
+        uut.url = 'http://127.0.0.1:1/reverse'
+        self.assertIsNone(uut.reverse(0, 0))
+
+    def test_nominatim_shared(self):
+        self.assertIs(nominatim(), nominatim())
@@ -3,10 +3,21 @@
 from __future__ import (division, absolute_import, unicode_literals,
                         print_function)
 
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
 import pytest
+from PIL import Image
+from pycolorname.pantone.pantonepaint import PantonePaint
 
-from file_metadata.image.image_file import ImageFile
-from tests import fetch_file, unittest
+from file_metadata.image.image_file import (
+    HAARCASCADES, SHAPE_PREDICTOR_DAT, ImageFile, dlib_face_detector,
+    dlib_shape_predictor, haarcascade_classifier, haarcascade_directory,
+    pantone_palette, zbar_scanner)
+from tests import fetch_file, mock, unittest
 
 
 class ImageFileTest(unittest.TestCase):
@@ -19,6 +30,204 @@ class ImageFileTest(unittest.TestCase):
         _file = ImageFile(fetch_file('huge.png'))
         self.assertEqual(_file.fetch('ndarray').shape, (0,))
 
+    def test_ndarray_max_side(self):
+        _file = ImageFile(fetch_file('ball.png'))
+        self.assertEqual(_file.fetch('ndarray', max_side=100).shape,
+                         (113, 113, 4))
+        self.assertIs(_file.fetch('ndarray', max_side=100),
+                      _file.fetch('ndarray', max_side=110))
+        self.assertEqual(_file.fetch('ndarray_grey', max_side=100).shape,
+                         (113, 113))
+
+    def test_ndarray_max_side_decoded_once(self):
+        _file = ImageFile(fetch_file('ball.png'))
+        with mock.patch.object(_file, '_read_reduced') as mock_read:
+            reduced = _file.fetch('ndarray', max_side=100)
+        self.assertFalse(mock_read.called)
+        full = _file.fetch('ndarray')
+        numpy.testing.assert_allclose(
+            reduced[10, 20], full[20:22, 40:42].mean(axis=(0, 1)), atol=0.5)
+
+    def test_reduce(self):
+        img = numpy.arange(30, dtype=numpy.uint16).reshape(5, 6) * 1000
+        reduced = ImageFile._reduce(img, 2)
+        self.assertEqual(reduced.dtype, numpy.uint16)
+        self.assertEqual(reduced.tolist(), [[3500, 5500, 7500],
+                                            [15500, 17500, 19500]])
+        self.assertEqual(ImageFile._reduce(img[..., None], 5).shape,
+                         (1, 1, 1))
+
+    def test_ndarray_max_side_larger_than_image(self):
+        _file = ImageFile(fetch_file('ball.png'))
+        self.assertIs(_file.fetch('ndarray', max_side=500),
+                      _file.fetch('ndarray'))
+
+    def test_ndarray_max_side_jpeg(self):
+        _file = ImageFile(fetch_file('geotag_osaka.jpg'))
+        full = _file.fetch('ndarray')
+        reduced = _file.fetch('ndarray', max_side=max(full.shape) // 4)
+        self.assertEqual(reduced.shape,
+                         (full.shape[0] // 4, full.shape[1] // 4, 3))
+        reduced[0, 0] = 0  # Can be modified
+
+    def test_ndarray_max_side_too_large(self):
+        _file = ImageFile(fetch_file('ball.png'), max_decompressed_size=1000)
+        self.assertTrue(_file.is_type('too_large'))
+        self.assertEqual(_file.fetch('ndarray', max_side=100).shape,
+                         (100, 100, 4))
+        self.assertEqual(_file.fetch('ndarray_grey', max_side=100).shape,
+                         (100, 100))
+
+    def test_above_pillow_limit(self):
+        # Pillow refuses to open the image, its limit is left as it is and
+        # ImageMagick reads the image instead.
+        _file = ImageFile(fetch_file('ball.png'))
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            self.assertEqual(_file.fetch('size'), (226, 226))
+            self.assertTrue(_file.is_type('too_large'))
+            self.assertTrue(_file.is_type('alpha'))
+            self.assertFalse(_file.is_type('animated'))
+            self.assertEqual(_file.fetch('ndarray').size, 0)
+            self.assertEqual(_file.fetch('ndarray', max_side=100).shape,
+                             (100, 100, 4))
+            self.assertEqual(Image.MAX_IMAGE_PIXELS, 1000)
+
+    def test_iter_tiles(self):
+        _file = ImageFile(fetch_file('ball.png'))
+        tiles = list(_file.iter_tiles(tile_size=100))
+        self.assertEqual([(top, left, tile.shape[:2])
+                          for top, left, tile in tiles[:4]],
+                         [(0, 0, (100, 100)), (0, 100, (100, 100)),
+                          (0, 200, (100, 26)), (100, 0, (100, 100))])
+        self.assertEqual(len(tiles), 9)
+
+    def test_iter_tiles_too_large(self):
+        full = ImageFile(fetch_file('ball.png')).fetch('ndarray')
+        _file = ImageFile(fetch_file('ball.png'), max_decompressed_size=1000)
+        for top, left, tile in _file.iter_tiles(tile_size=100):
+            numpy.testing.assert_array_equal(
+                tile, full[top:top + 100, left:left + 100])
+
+    def test_histogram_too_large(self):
+        expected = ImageFile(fetch_file('ball.png'))
+        _file = ImageFile(fetch_file('ball.png'), max_decompressed_size=1000)
+        for region in (None, (10, 150, 120, 226)):
+            numpy.testing.assert_array_equal(
+                _file.fetch('histogram', channel='rgb', region=region),
+                expected.fetch('histogram', channel='rgb', region=region))
+
+    def test_iter_frames(self):
+        _file = ImageFile(fetch_file('animated.gif'))
+        n_frames = _file.fetch('pillow').n_frames
+        self.assertTrue(_file.is_type('animated'))
+        self.assertEqual([index for index, _ in _file.iter_frames()],
+                         list(range(n_frames)))
+        self.assertEqual([index for index, _ in _file.iter_frames(3)],
+                         list(range(0, n_frames, 3)))
+        self.assertEqual([index for index, _ in _file.iter_frames('first')],
+                         [0])
+
+    def test_iter_frames_keyframes(self):
+        from PIL import Image
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'frames.gif')
+            frames = [Image.new('L', (10, 10), color)
+                      for color in (0, 2, 255, 250, 0)]
+            frames[0].save(filename, save_all=True,
+                           append_images=frames[1:])
+            _file = ImageFile(filename)
+            self.assertEqual(
+                [index for index, _ in _file.iter_frames('keyframes')],
+                [0, 2, 4])
+            _file.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_iter_frames_static_image(self):
+        _file = ImageFile(fetch_file('ball.png'))
+        self.assertFalse(_file.is_type('animated'))
+        (index, frame), = _file.iter_frames()
+        self.assertEqual(index, 0)
+        self.assertIs(frame, _file.fetch('ndarray'))
+
+    def test_histogram_animated(self):
+        _file = ImageFile(fetch_file('animated.gif'))
+        pillow_img = _file.fetch('pillow')
+        width, height = pillow_img.size
+        hist = _file.fetch('histogram', channel='rgb')
+        self.assertEqual(hist.shape, (3, 256))
+        self.assertEqual(hist.sum(axis=1).tolist(),
+                         [pillow_img.n_frames * width * height] * 3)
+
+    def test_pyramid(self):
+        _file = ImageFile(fetch_file('ball.png'))
+        pyramid = _file.fetch('pyramid')
+        self.assertEqual([level.shape for level in pyramid],
+                         [(226, 226), (113, 113), (56, 56)])
+        self.assertIs(pyramid[0], _file.fetch('ndarray_grey'))
+        self.assertIs(_file.fetch('ndarray_grey', max_side=100), pyramid[1])
+
+    def test_downsample(self):
+        img = numpy.array([[0, 255, 10, 20, 7],
+                           [255, 0, 30, 41, 7],
+                           [1, 1, 1, 1, 1]], dtype=numpy.uint8)
+        numpy.testing.assert_array_equal(ImageFile._downsample(img),
+                                         [[128, 25]])
+
+    def test_histogram(self):
+        _file = ImageFile(fetch_file('ball.png'))
+        grey = _file.fetch('ndarray_grey')
+        hist = _file.fetch('histogram')
+        numpy.testing.assert_array_equal(
+            hist, numpy.bincount(grey.ravel(), minlength=256))
+        self.assertIs(hist, _file.fetch('histogram', channel='grey'))
+
+    def test_histogram_channel_region(self):
+        _file = ImageFile(fetch_file('ball.png'))
+        rgb = _file.fetch('histogram', channel='rgb', region=(10, 20, 30, 50))
+        self.assertEqual(rgb.shape, (3, 256))
+        green = _file.fetch('ndarray_noalpha')[10:20, 30:50, 1]
+        numpy.testing.assert_array_equal(
+            _file.fetch('histogram', channel='green', region=(10, 20, 30, 50)),
+            numpy.bincount(green.ravel(), minlength=256))
+
+
+class ImageFileAlphaBlendTest(unittest.TestCase):
+
+    def test_alpha_blend(self):
+        img = numpy.array([[[10, 20, 30, 0], [10, 20, 30, 255]],
+                           [[10, 20, 30, 51], [200, 100, 0, 128]]],
+                          dtype=numpy.uint8)
+        numpy.testing.assert_array_equal(
+            ImageFile.alpha_blend(img),
+            [[[255, 255, 255], [10, 20, 30]],
+             [[206, 208, 210], [227, 177, 127]]])
+        numpy.testing.assert_array_equal(
+            ImageFile.alpha_blend(img, background=0),
+            [[[0, 0, 0], [10, 20, 30]],
+             [[2, 4, 6], [100, 50, 0]]])
+
+    def test_alpha_blend_out_and_chunks(self):
+        img = numpy.random.RandomState(0).randint(
+            0, 256, (50, 20, 4)).astype(numpy.uint8)
+        out = numpy.empty((50, 20, 3), dtype=numpy.uint8)
+        self.assertIs(ImageFile.alpha_blend(img, out=out, chunk_rows=7), out)
+        numpy.testing.assert_array_equal(out, ImageFile.alpha_blend(img))
+
+    def test_alpha_blend_float(self):
+        img = numpy.array([[[100.0, 0.0, 51.0]]])
+        numpy.testing.assert_allclose(ImageFile.alpha_blend(img),
+                                      [[[224.0, 204.0]]])
+
+    def test_alpha_blend_float_background(self):
+        for dtype in (numpy.uint8, numpy.uint16):
+            img = numpy.array([[[100, 200, 50, 51]]], dtype=dtype)
+            blended = ImageFile.alpha_blend(img, background=127.5)
+            self.assertEqual(blended.dtype, dtype)
+            numpy.testing.assert_array_equal(blended, [[[122, 142, 112]]])
+
 
 class ImageFileGeoLocation(unittest.TestCase):
 
@@ -31,6 +240,33 @@ class ImageFileGeoLocation(unittest.TestCase):
         self.assertEqual(int(data.get('Composite:GPSLongitude', 0) * 1e6),
                          135576661)
 
+    def test_geolocation_gazetteer_osaka(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'cities1000.txt')
+            with open(filename, 'w') as _file:
+                _file.write('1853295\tMoriguchi\tMoriguchi\t\t34.7375\t'
+                            '135.56417\tP\tPPL\tJP\t\t32\n')
+            _file = ImageFile(fetch_file('geotag_osaka.jpg'),
+                              gazetteer=filename)
+            data = _file.analyze_geolocation(use_nominatim=False)
+            self.assertEqual(data.get('Composite:GPSCountry'), 'JP')
+            self.assertEqual(data.get('Composite:GPSCity'), 'Moriguchi')
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_geolocation_resolvers(self):
+        missing, found = mock.Mock(), mock.Mock()
+        missing.reverse.return_value = None
+        found.reverse.return_value = {'country': 'Japan', 'state': None,
+                                      'city': 'Moriguchi'}
+        _file = ImageFile(fetch_file('geotag_osaka.jpg'))
+        data = _file.analyze_geolocation(resolvers=[missing, found])
+        self.assertEqual(data.get('Composite:GPSCity'), 'Moriguchi')
+        self.assertNotIn('Composite:GPSState', data)
+        missing.reverse.assert_called_once_with(
+            data['Composite:GPSLatitude'], data['Composite:GPSLongitude'])
+
     def test_geolocation_nominatim_osaka(self):
         _file = ImageFile(fetch_file('geotag_osaka.jpg'))
         data = _file.analyze_geolocation()
@@ -52,6 +288,32 @@ class ImageFileColorCalibrationTarget(unittest.TestCase):
             data = _file.analyze_color_calibration_target()
             self.assertIn('Color:IT8TopBar', data)
 
+    def test_color_it8_target_tall_scan(self):
+        from PIL import Image
+
+        # 20 dark and bright bars on top of a tall grey scan, with some
+        # colored rows which sampling every few rows would skip.
+        image_array = numpy.full((20000, 400, 3), 128, dtype=numpy.uint8)
+        stripes = numpy.where(numpy.arange(400) // 10 % 2, 200, 50)
+        image_array[:4000] = stripes[None, :, None]
+        image_array[4001::100, :, 0] = 255
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'tall_scan.png')
+            Image.fromarray(image_array).save(filename)
+            with ImageFile(filename) as _file:
+                data = _file.analyze_color_calibration_target()
+                grey = _file.fetch('ndarray_grey')[4000:]
+            # The mean squared difference over all the rows below the bar.
+            expected = numpy.mean(numpy.square(
+                image_array[4000:].astype(numpy.float64) -
+                grey[..., None]))
+            self.assertEqual(data['Color:IT8TopBar'], 21)
+            self.assertAlmostEqual(data['Color:IT8TopBarGreyMSE'], expected)
+            self.assertNotIn('Color:IT8BottomBar', data)
+        finally:
+            shutil.rmtree(tempdir)
+
 
 class ImageFileColorInfoTest(unittest.TestCase):
 
@@ -91,6 +353,17 @@ class ImageFileColorInfoTest(unittest.TestCase):
         self.assertEqual(round(data['Color:EdgeRatio'], 3), 0.268)
         self.assertEqual(data['Color:MeanSquareErrorFromGrey'], 0)
 
+    def test_pantone_palette(self):
+        palette = pantone_palette()
+        self.assertIs(palette, pantone_palette())
+        for color in ((227.326, 224.414, 224.414), (0, 0, 0), (12.5, 200, 90)):
+            self.assertEqual(palette.find_closest(color),
+                             PantonePaint().find_closest(color))
+        indices = palette.closest(numpy.zeros((2, 5, 3)))
+        self.assertEqual(indices.shape, (2, 5))
+        self.assertEqual(palette.names[indices[0, 0]],
+                         palette.find_closest((0, 0, 0))[0])
+
     def test_color_info_animated_image(self):
         data = ImageFile(fetch_file('animated.gif')).analyze_color_info()
         self.assertIn('Color:AverageRGB', data)
@@ -177,6 +450,25 @@ class ImageFileColorInfoTest(unittest.TestCase):
 
 class ImageFileFaceHAARCascadesTest(unittest.TestCase):
 
+    def test_haarcascade_classifier_reused(self):
+        if haarcascade_directory() is None:
+            self.skipTest('OpenCV haarcascades not found.')
+        filename = HAARCASCADES['frontal_face']
+        with haarcascade_classifier(filename) as first:
+            self.assertIsNotNone(first)
+
+        # Threads started later use the classifier which was parsed.
+        found = []
+
+        def detect():
+            with haarcascade_classifier(filename) as classifier:
+                found.append(classifier)
+
+        thread = threading.Thread(target=detect)
+        thread.start()
+        thread.join()
+        self.assertIs(found[0], first)
+
     def test_face_haarcascade_charlie_chaplin(self):
         with ImageFile(fetch_file('charlie_chaplin.jpg')) as uut:
             data = uut.analyze_face_haarcascades()
@@ -223,6 +515,37 @@ class ImageFileFaceHAARCascadesTest(unittest.TestCase):
 @pytest.mark.timeout(300)
 class ImageFileFaceLandmarksTest(unittest.TestCase):
 
+    def test_face_detector_reused(self):
+        with dlib_face_detector() as first:
+            pass
+        found = []
+
+        def detect():
+            with dlib_face_detector() as detector:
+                found.append(detector)
+
+        thread = threading.Thread(target=detect)
+        thread.start()
+        thread.join()
+        self.assertIs(found[0], first)
+
+    @mock.patch('file_metadata.image.image_file._dlib_models', {})
+    @mock.patch('file_metadata.image.image_file.dlib.shape_predictor',
+                side_effect=RuntimeError)
+    @mock.patch('file_metadata.image.image_file.app_dir')
+    def test_shape_predictor_corrupt(self, mock_app_dir, _):
+        data_dir = tempfile.mkdtemp()
+        try:
+            mock_app_dir.side_effect = (
+                lambda dirtype, *args: os.path.join(data_dir, *args))
+            dat_path = os.path.join(data_dir, SHAPE_PREDICTOR_DAT)
+            with open(dat_path, 'wb') as dat_file:
+                dat_file.write(b'corrupt')
+            self.assertRaises(RuntimeError, dlib_shape_predictor)
+            self.assertFalse(os.path.exists(dat_path))
+        finally:
+            shutil.rmtree(data_dir)
+
     def test_facial_landmarks_monkey_face(self):
         _file = ImageFile(fetch_file('monkey_face.jpg'))
         data = _file.analyze_facial_landmarks()
@@ -341,3 +664,44 @@ class ImageFileBarcodeZBarTest(unittest.TestCase):
                          'http://www.wikipedia.com')
         self.assertEqual(data['zbar:Barcodes'][0]['bounding box'],
                          {'width': 350, 'top': 9, 'height': 350, 'left': 7})
+
+    def test_barcode_zbar_regions(self):
+        _file = ImageFile(fetch_file('qrcode.jpg'))
+        data = _file.analyze_barcode_zbar(regions=[(0, 400, 0, 400)])
+        self.assertEqual(data['zbar:Barcodes'][0]['data'],
+                         'http://www.wikipedia.com')
+        self.assertEqual(data['zbar:Barcodes'][0]['bounding box'],
+                         {'width': 350, 'top': 9, 'height': 350, 'left': 7})
+        self.assertEqual(_file.analyze_barcode_zbar(regions=[(0, 5, 0, 5)]),
+                         {})
+
+    def test_barcode_zbar_first_pass(self):
+        _file = ImageFile(fetch_file('qrcode.jpg'))
+        data = _file.analyze_barcode_zbar(first_pass_max_side=100)
+        self.assertEqual(len(data['zbar:Barcodes']), 1)
+        self.assertEqual(data['zbar:Barcodes'][0]['data'],
+                         'http://www.wikipedia.com')
+
+    def test_barcode_zbar_first_pass_without_fallback(self):
+        _file = ImageFile(fetch_file('mona_lisa.jpg'))
+        with mock.patch.object(_file, '_zbar_scan',
+                               return_value=[]) as mock_scan:
+            data = _file.analyze_barcode_zbar(first_pass_max_side=100,
+                                              full_scan_fallback=False)
+        self.assertEqual(data, {})
+        self.assertEqual(mock_scan.call_count, 1)
+        self.assertLessEqual(max(mock_scan.call_args[0][0].shape), 200)
+
+    def test_zbar_scanner_reused(self):
+        with zbar_scanner() as first:
+            pass
+        found = []
+
+        def scan():
+            with zbar_scanner() as scanner:
+                found.append(scanner)
+
+        thread = threading.Thread(target=scan)
+        thread.start()
+        thread.join()
+        self.assertIs(found[0], first)
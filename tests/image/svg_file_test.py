@@ -6,7 +6,7 @@ from __future__ import (division, absolute_import, unicode_literals,
 import os
 
 from file_metadata.image.svg_file import SVGFile
-from tests import fetch_file, unittest
+from tests import fetch_file, mock, unittest
 
 
 class SVGFileTest(unittest.TestCase):
@@ -21,6 +21,28 @@ class SVGFileTest(unittest.TestCase):
         uut.close()
         self.assertFalse(os.path.exists(name))
 
+    def test_fetch_svg_ndarray_no_temp_file(self):
+        with SVGFile(fetch_file('image_svg_xml.svg')) as uut:
+            self.assertEqual(uut.fetch('pillow').size, (100, 100))
+            self.assertEqual(uut.temp_filenames, set())
+
+    def test_svg_size_not_rendered(self):
+        with SVGFile(fetch_file('image_svg_xml.svg')) as uut, \
+                mock.patch('file_metadata.mixins.wand_ndarray') as mock_nd:
+            self.assertEqual(uut.fetch('size'), (100, 100))
+            self.assertFalse(uut.is_type('too_large'))
+            self.assertFalse(uut.is_type('animated'))
+            self.assertFalse(mock_nd.called)
+
+    def test_svg_too_large_not_rendered(self):
+        with SVGFile(fetch_file('text_html.svg'),
+                     max_decompressed_size=1000) as uut, \
+                mock.patch('file_metadata.mixins.wand_ndarray') as mock_nd:
+            self.assertTrue(uut.is_type('too_large'))
+            self.assertTrue(uut.is_type('alpha'))
+            self.assertEqual(uut.fetch('ndarray').size, 0)
+            self.assertFalse(mock_nd.called)
+
     def test_fetch_svg_ndarray_application_xml(self):
         with SVGFile(fetch_file('application_xml.svg')) as uut:
             self.assertEqual(uut.fetch('ndarray').shape, (369, 445, 4))
@@ -29,6 +29,13 @@ class XCFFileTest(unittest.TestCase):
         with XCFFile(fetch_file('woman.xcf')) as uut:
             self.assertEqual(uut.fetch('ndarray').shape, (1024, 720, 4))
 
+    def test_xcf_fetch_ndarray_no_temp_file(self):
+        with XCFFile(fetch_file('woman.xcf')) as uut:
+            self.assertTrue(uut.is_type('alpha'))
+            self.assertEqual(uut.fetch('ndarray_noalpha').shape,
+                             (1024, 720, 3))
+            self.assertEqual(uut.temp_filenames, set())
+
 
 # Increase the timeout as the first time it will need to download the
 # shape predictor data ~60MB
@@ -3,9 +3,17 @@
 from __future__ import (division, absolute_import, unicode_literals,
                         print_function)
 
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
 from file_metadata._compat import which
 from file_metadata.generic_file import GenericFile
-from file_metadata.mixins import is_svg, FFProbeMixin
+from file_metadata.mixins import (is_svg, ffprobe_executable, FFProbeMixin,
+                                  FFPROBE_ENTRIES)
 from tests import fetch_file, mock, unittest, which_sideeffect
 
 
@@ -90,6 +98,7 @@ class FFProbeMixinTest(unittest.TestCase):
 @unittest.skipIf(which('ffprobe') is None, '`ffprobe` not found.')
 @mock.patch('file_metadata.mixins.which',
             side_effect=which_sideeffect(['avprobe']))
+@mock.patch.dict('file_metadata.mixins._ffprobe_tool', clear=True)
 class FFProbeMixinWithFFProbeTest(FFProbeMixinTest):
     __test__ = True
 
@@ -97,18 +106,100 @@ class FFProbeMixinWithFFProbeTest(FFProbeMixinTest):
 @unittest.skipIf(which('avprobe') is None, '`avprobe` not found.')
 @mock.patch('file_metadata.mixins.which',
             side_effect=which_sideeffect(['ffprobe']))
+@mock.patch.dict('file_metadata.mixins._ffprobe_tool', clear=True)
 class FFProbeMixinWithAVProbeTest(FFProbeMixinTest):
     __test__ = True
 
 
 @mock.patch('file_metadata.mixins.which',
             side_effect=which_sideeffect(['ffprobe', 'avprobe']))
+@mock.patch.dict('file_metadata.mixins._ffprobe_tool', clear=True)
 class FFProbeMixinWithoutBackendsTest(unittest.TestCase):
     def test_wav(self, mock_check_output, mock_system=None):
         _file = FFProbeTestFile(fetch_file('noise.wav'))
         self.assertRaises(OSError, _file.analyze_ffprobe)
 
 
+# A stand-in for ``ffprobe`` which logs its arguments and prints the help of
+# a version supporting ``-of`` and ``-show_entries``.
+FAKE_FFPROBE = """#!{python}
+import json
+import sys
+
+with open({log!r}, 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\\n')
+if sys.argv[1] == '-h':
+    print('-of format           alias for -print_format')
+    print('-show_entries entry_list  show a set of specified entries')
+else:
+    print(json.dumps({{'format': {{'format_name': 'wav', 'duration': '1.0',
+                                  'nb_streams': 1}},
+                      'streams': []}}))
+"""
+
+
+class FFProbeExecutableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.testdir, 'log')
+        self.executable = os.path.join(self.testdir, 'ffprobe')
+        with open(self.executable, 'w') as _file:
+            _file.write(FAKE_FFPROBE.format(python=sys.executable,
+                                            log=str(self.log)))
+        os.chmod(self.executable, stat.S_IRWXU)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def calls(self):
+        with open(self.log) as log:
+            return log.read().splitlines()
+
+    @mock.patch.dict('file_metadata.mixins._ffprobe_tool', clear=True)
+    def test_capabilities_cached(self):
+        with mock.patch('file_metadata.mixins.app_dir',
+                        return_value=os.path.join(self.testdir, 'caps')), \
+                mock.patch('file_metadata.mixins.which',
+                           side_effect=lambda cmd: self.executable):
+            self.assertEqual(ffprobe_executable(), (
+                self.executable, {'json': True, 'show_entries': True}))
+            self.assertEqual(ffprobe_executable()[0], self.executable)
+            data = FFProbeTestFile(fetch_file('noise.wav')).analyze_ffprobe()
+            self.assertEqual(data['FFProbe:Format'], 'wav')
+
+        self.assertEqual(len(self.calls()), 2)
+        self.assertEqual(self.calls()[0], '-h')
+        self.assertIn('-show_entries ' + FFPROBE_ENTRIES, self.calls()[1])
+
+        # Another process reads the capabilities from the cache directory
+        with mock.patch('file_metadata.mixins.app_dir',
+                        return_value=os.path.join(self.testdir, 'caps')), \
+                mock.patch('file_metadata.mixins.which',
+                           side_effect=lambda cmd: self.executable), \
+                mock.patch('file_metadata.mixins._ffprobe_tool', {}):
+            ffprobe_executable()
+        self.assertEqual(len(self.calls()), 2)
+
+    @mock.patch.dict('file_metadata.mixins._ffprobe_tool', clear=True)
+    def test_capabilities_cache_truncated(self):
+        cache_path = os.path.join(self.testdir, 'caps')
+        with open(cache_path, 'w') as cache_file:
+            cache_file.write('{"' + self.executable)
+        with mock.patch('file_metadata.mixins.app_dir',
+                        return_value=cache_path), \
+                mock.patch('file_metadata.mixins.which',
+                           side_effect=lambda cmd: self.executable):
+            self.assertEqual(ffprobe_executable()[1],
+                             {'json': True, 'show_entries': True})
+        self.assertEqual(self.calls(), ['-h'])
+        with open(cache_path) as cache_file:
+            self.assertIn(self.executable, json.load(cache_file))
+        self.assertEqual(os.listdir(self.testdir).count('caps'), 1)
+        self.assertFalse([name for name in os.listdir(self.testdir)
+                          if name.startswith('tmp_file_metadata')])
+
+
 class IsSvgTest(unittest.TestCase):
 
     def test_is_svg_application_xml(self):
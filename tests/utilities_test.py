@@ -9,13 +9,15 @@ import os
 import shutil
 import socket
 import tempfile
+import threading
+import time
 from io import StringIO
 
 from six.moves.urllib.error import URLError
 
 from file_metadata.utilities import (app_dir, bz2_decompress, make_temp,
                                      download, md5sum, memoized, retry,
-                                     DictNoNone)
+                                     DictNoNone, ObjectPool)
 from tests import mock, unittest
 
 
@@ -169,6 +171,176 @@ class MemoizedTest(unittest.TestCase):
         self.assertEqual(uut.inc_val(2), uut.inc_val(2))
         self.assertNotEqual(AbcClass.inc_val(uut, 2), AbcClass.inc_val(uut, 2))
 
+    def test_memoized_threads(self):
+
+        class AbcClass:
+            val = 0
+
+            @memoized
+            def inc_val(self, arg):
+                time.sleep(0.1)
+                self.val += 1
+                return self.val + arg
+
+        uut = AbcClass()
+        threads = [threading.Thread(target=uut.inc_val, args=(2,))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(uut.val, 1)
+        self.assertEqual(uut.inc_val(2), 3)
+        # The locks of the keys are dropped once they are computed.
+        self.assertEqual(memoized._cache(uut).locks, {})
+
+    def test_set_cache(self):
+
+        class AbcClass:
+            val = 0
+
+            @memoized
+            def inc_val(self, arg):
+                self.val += 1
+                return self.val + arg
+
+        uut = AbcClass()
+        AbcClass.__dict__['inc_val'].set_cache(uut, 10, 2)
+        self.assertEqual(uut.inc_val(2), 10)
+        self.assertEqual(uut.val, 0)
+        self.assertEqual(uut.inc_val(3), 4)
+
+    def test_lookup(self):
+
+        class AbcClass(object):
+
+            @memoized
+            def val(self):
+                return 1
+
+        class DefClass(AbcClass):
+            pass
+
+        uut = DefClass()
+        memoized.lookup(DefClass, 'val').set_cache(uut, 10)
+        self.assertEqual(uut.val(), 10)
+        self.assertIs(memoized.lookup(DefClass, 'val'),
+                      AbcClass.__dict__['val'])
+        self.assertRaises(AttributeError, memoized.lookup, DefClass, 'other')
+
+
+class ObjectPoolTest(unittest.TestCase):
+
+    def test_reuse(self):
+        uut = ObjectPool(object)
+        with uut.get() as first:
+            with uut.get() as second:
+                self.assertIsNot(first, second)
+        with uut.get() as obj:
+            self.assertIn(obj, (first, second))
+
+        # Other threads use the same objects.
+        found = []
+
+        def use():
+            with uut.get() as obj:
+                found.append(obj)
+
+        thread = threading.Thread(target=use)
+        thread.start()
+        thread.join()
+        self.assertIn(found[0], (first, second))
+
+    def test_put_back_after_error(self):
+        uut = ObjectPool(object)
+        with self.assertRaises(ValueError):
+            with uut.get() as first:
+                raise ValueError
+        with uut.get() as obj:
+            self.assertIs(obj, first)
+
+    def test_fill(self):
+        factory = mock.Mock(side_effect=object)
+        uut = ObjectPool(factory)
+        uut.fill(2)
+        uut.fill(2)
+        self.assertEqual(factory.call_count, 2)
+        with uut.get():
+            with uut.get():
+                pass
+        self.assertEqual(factory.call_count, 2)
+
+
+class SizedValue(object):
+
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+
+class SizedClass(object):
+
+    def __init__(self, max_cache_bytes=None):
+        self.max_cache_bytes = max_cache_bytes
+        self.calls = []
+
+    @memoized
+    def fetch(self, key):
+        self.calls.append(key)
+        return SizedValue(60) if key != 'small' else key
+
+
+class MemoizedBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.max_bytes = memoized.max_bytes
+
+    def tearDown(self):
+        memoized.max_bytes = self.max_bytes
+
+    def test_instance_budget(self):
+        uut = SizedClass(max_cache_bytes=130)
+        uut.fetch('a'), uut.fetch('b'), uut.fetch('small')
+        uut.fetch('a')  # Makes 'b' the least recently used
+        uut.fetch('c')
+        self.assertEqual(uut.calls, ['a', 'b', 'small', 'c'])
+        uut.fetch('a'), uut.fetch('small')
+        uut.fetch('b')
+        self.assertEqual(uut.calls, ['a', 'b', 'small', 'c', 'b'])
+
+    def test_keep_latest_value(self):
+        uut = SizedClass(max_cache_bytes=10)
+        value = uut.fetch('a')
+        self.assertIs(uut.fetch('a'), value)
+        uut.fetch('b')
+        uut.fetch('a')
+        self.assertEqual(uut.calls, ['a', 'b', 'a'])
+
+    def test_global_budget(self):
+        memoized.max_bytes = 130
+        uut1, uut2 = SizedClass(), SizedClass()
+        uut1.fetch('a'), uut2.fetch('a'), uut1.fetch('a')
+        uut2.fetch('b')
+        uut1.fetch('a'), uut2.fetch('a')
+        self.assertEqual(uut1.calls, ['a'])
+        self.assertEqual(uut2.calls, ['a', 'b', 'a'])
+
+    def test_clear_cache(self):
+        uut = SizedClass()
+        uut.fetch('a'), uut.fetch('small')
+        memoized.clear_cache(uut)
+        uut.fetch('a'), uut.fetch('small')
+        self.assertEqual(uut.calls, ['a', 'small', 'a', 'small'])
+
+    def test_no_lock_left(self):
+        # Evicted values and errors do not leave a lock behind.
+        uut = SizedClass(max_cache_bytes=60)
+        for key in range(10):
+            uut.fetch(key)
+        with mock.patch.object(SizedValue, '__init__',
+                               side_effect=ValueError):
+            self.assertRaises(ValueError, uut.fetch, 'error')
+        self.assertEqual(memoized._cache(uut).locks, {})
+
 
 class RetryTest(unittest.TestCase):
 
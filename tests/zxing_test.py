@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy
+
+from file_metadata.zxing import ZXingServer, server_command
+from tests import mock, unittest
+
+# A small stand-in for ZXingServer.java which finds a QR code with the
+# requested URI as data, or a CODE_128 barcode with the number of pixels
+# given. The URIs "crash", "slow" and "error" make it misbehave.
+FAKE_SERVER = """
+import base64
+import sys
+import time
+
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+
+def encode(text):
+    return base64.b64encode(text.encode('utf-8'))
+
+
+stdout.write(b'ready\\n')
+stdout.flush()
+for line in iter(stdin.readline, b''):
+    request = line.decode('utf-8').rstrip('\\n').split(' ')
+    if request[0] == 'pixels':
+        num = len(stdin.read(int(request[1]) * int(request[2]) * 3)) // 3
+        stdout.write(b'result\\tCODE_128\\t' + encode(str(num)) + b'\\t' +
+                     encode(str(num)) + b'\\t1.5,2.0 10.0,2.0\\n')
+    elif request[1] == 'crash':
+        sys.exit(1)
+    elif request[1] == 'slow':
+        time.sleep(10)
+    elif request[1] == 'error':
+        stdout.write(b'error\\t' + encode('Could not load file') + b'\\n')
+    else:
+        stdout.write(b'result\\tQR_CODE\\t' + encode(request[1]) + b'\\t' +
+                     encode(request[1]) + b'\\t1.0,2.0 1.0,5.0 4.0,5.0\\n')
+    stdout.write(b'done\\n')
+    stdout.flush()
+"""
+
+
+class ZXingServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.testdir, 'zxing_server.py')
+        with open(self.script, 'w') as _file:
+            _file.write(FAKE_SERVER)
+        self.uut = ZXingServer(command=[sys.executable, self.script],
+                               timeout=5)
+
+    def tearDown(self):
+        self.uut.close()
+        shutil.rmtree(self.testdir)
+
+    def test_decode_file(self):
+        self.assertEqual(self.uut.decode_file('file:///a.png'), [{
+            'format': 'QR_CODE', 'raw_data': 'file:///a.png',
+            'data': 'file:///a.png',
+            'points': [(1.0, 2.0), (1.0, 5.0), (4.0, 5.0)]}])
+        pid = self.uut.process.pid
+        self.assertEqual(len(self.uut.decode_file('file:///b.png')), 1)
+        self.assertEqual(self.uut.process.pid, pid)
+
+    def test_decode_pixels(self):
+        image_array = numpy.zeros((3, 4), dtype=numpy.uint8)
+        result, = self.uut.decode_pixels(image_array)
+        self.assertEqual(result['data'], '12')
+        self.assertEqual(result['points'], [(1.5, 2.0), (10.0, 2.0)])
+
+    def test_error(self):
+        self.assertRaises(ValueError, self.uut.decode_file, 'error')
+        # The server can be used after an error.
+        self.assertEqual(len(self.uut.decode_file('a')), 1)
+
+    def test_restart_after_crash(self):
+        self.uut.decode_file('a')
+        self.uut.process.kill()
+        self.uut.process.wait()
+        self.assertEqual(len(self.uut.decode_file('b')), 1)
+        self.assertRaises(IOError, self.uut.decode_file, 'crash')
+        self.assertFalse(self.uut.failed)
+
+    def test_timeout(self):
+        self.uut.timeout = 0.5
+        self.assertRaises(IOError, self.uut.decode_file, 'slow')
+        self.assertIsNone(self.uut.process)
+        self.uut.timeout = 5
+        self.assertEqual(len(self.uut.decode_file('a')), 1)
+
+    def test_start_failure(self):
+        uut = ZXingServer(command=[sys.executable, '-c', 'print("java 8")'])
+        self.assertRaises(OSError, uut.decode_file, 'a')
+        self.assertTrue(uut.failed)
+        self.assertRaises(OSError, uut.decode_file, 'a')
+
+
+class ServerCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        patcher = mock.patch(
+            'file_metadata.zxing.app_dir',
+            side_effect=lambda dirtype, name: os.path.join(self.testdir,
+                                                           name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    @staticmethod
+    def javac(args, **kwargs):
+        outdir = args[args.index('-d') + 1]
+        with open(os.path.join(outdir, 'ZXingServer.class'), 'wb'):
+            pass
+
+    def test_compiled_once(self):
+        with mock.patch('subprocess.check_call',
+                        side_effect=self.javac) as mock_javac:
+            command = server_command()
+            self.assertEqual(server_command(), command)
+        self.assertEqual(mock_javac.call_count, 1)
+        self.assertEqual(command[-1], 'ZXingServer')
+        class_dir = command[2].split(os.pathsep)[0]
+        self.assertTrue(os.path.exists(
+            os.path.join(class_dir, 'ZXingServer.class')))
+        # Only the compiled class is left in the cache directory.
+        self.assertEqual(os.listdir(self.testdir),
+                         [os.path.basename(class_dir)])
+
+    def test_no_javac(self):
+        with mock.patch('subprocess.check_call', side_effect=OSError):
+            command = server_command()
+        self.assertTrue(command[-1].endswith('ZXingServer.java'))
+        self.assertEqual(os.listdir(self.testdir), [])